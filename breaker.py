@@ -0,0 +1,194 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from config import Config
+from catalog import catalog
+from scheduler import OVERLOADED_ERROR
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+UNAVAILABLE_ERROR = "Модель временно недоступна, попробуйте позже или выберите другую"
+
+class CircuitBreaker:
+    """Состояние одной модели: скользящее окно исходов (время, ошибка, медленный ответ)"""
+    
+    def __init__(self, window, min_calls, error_rate, slow_call_rate, slow_call_threshold, open_duration, half_open_calls):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_threshold = slow_call_threshold
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self.state = STATE_CLOSED
+        self.calls = deque()
+        self.errors = 0
+        self.slow = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.successes = 0
+        self.trips = 0
+        self.rejected = 0
+    
+    def allow(self, now=None):
+        now = now or time.monotonic()
+        if self.state == STATE_OPEN:
+            if now - self.opened_at < self.open_duration:
+                self.rejected += 1
+                return False
+            self.state = STATE_HALF_OPEN
+            self.probes = 0
+            self.successes = 0
+        
+        if self.state == STATE_HALF_OPEN:
+            # Пропускаем ограниченное число пробных запросов (занятый слот освобождает только отмена)
+            if self.probes >= self.half_open_calls:
+                self.rejected += 1
+                return False
+            self.probes += 1
+        return True
+    
+    def record(self, failed, latency, now=None):
+        now = now or time.monotonic()
+        slow = latency >= self.slow_call_threshold
+        
+        if self.state == STATE_HALF_OPEN:
+            if failed or slow:
+                self.trip(now)
+            else:
+                # Закрываемся, только когда успешны все half_open_calls пробных запросов
+                self.successes += 1
+                if self.successes >= self.half_open_calls:
+                    self.reset()
+            return
+        
+        self.calls.append((now, failed, slow))
+        self.errors += failed
+        self.slow += slow
+        self.expire(now)
+        
+        if self.state == STATE_CLOSED and len(self.calls) >= self.min_calls:
+            total = len(self.calls)
+            if self.errors / total >= self.error_rate or self.slow / total >= self.slow_call_rate:
+                self.trip(now)
+    
+    def cancel(self):
+        """Запрос отменен до получения исхода - освобождаем пробный слот"""
+        if self.state == STATE_HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+    
+    def expire(self, now):
+        while self.calls and now - self.calls[0][0] > self.window:
+            _, failed, slow = self.calls.popleft()
+            self.errors -= failed
+            self.slow -= slow
+    
+    def trip(self, now):
+        self.state = STATE_OPEN
+        self.opened_at = now
+        self.trips += 1
+        self.reset_window()
+    
+    def reset(self):
+        self.state = STATE_CLOSED
+        self.reset_window()
+    
+    def reset_window(self):
+        self.calls.clear()
+        self.errors = 0
+        self.slow = 0
+        self.probes = 0
+        self.successes = 0
+
+class ModelBreakers:
+    """Circuit breaker на каждую модель и переключение на запасные модели тарифа"""
+    
+    def __init__(self, fallbacks):
+        self.fallbacks = fallbacks
+        self.breakers = {}
+        self.rerouted = 0
+    
+    def get(self, model_id):
+        breaker = self.breakers.get(model_id)
+        if breaker is None:
+            breaker = self.breakers[model_id] = CircuitBreaker(
+                window=Config.BREAKER_WINDOW,
+                min_calls=Config.BREAKER_MIN_CALLS,
+                error_rate=Config.BREAKER_ERROR_RATE,
+                slow_call_rate=Config.BREAKER_SLOW_CALL_RATE,
+                slow_call_threshold=Config.BREAKER_SLOW_CALL_THRESHOLDS.get(model_id, Config.BREAKER_SLOW_CALL_THRESHOLD),
+                open_duration=Config.BREAKER_OPEN_DURATION,
+                half_open_calls=Config.BREAKER_HALF_OPEN_CALLS
+            )
+        return breaker
+    
+    def candidates(self, model_id, subscription, capability=0):
+        """Сама модель, затем запасные из доступных пользователю тарифов"""
+        yield model_id
+        
+        chain = self.fallbacks.get(model_id)
+        if chain is None:
+            # По умолчанию - модели подписки от старших тарифов к младшим
+            chain = [model['id'] for model in reversed(catalog.models_for(subscription))]
+        
+        for candidate in chain:
+            if candidate == model_id or not catalog.can_use(subscription, candidate):
+                continue
+            if capability and not catalog.supports(candidate, capability):
+                continue
+            yield candidate
+    
+    def pick(self, model_id, subscription, capability=0, fallback=True):
+        """Первая здоровая модель цепочки или None"""
+        candidates = self.candidates(model_id, subscription, capability) if fallback else (model_id,)
+        for candidate in candidates:
+            if self.get(candidate).allow():
+                return candidate
+        return None
+    
+    async def run(self, model_id, subscription, request, capability=0, fallback=True):
+        """request(model_id) -> результат RouterAIService; модель выбирается с учетом состояния breaker'ов.
+        
+        Медленный ответ определяется по result['latency'] (без очереди планировщика,
+        для стрима - до первого токена), если request его вернул.
+        """
+        candidate = self.pick(model_id, subscription, capability, fallback)
+        if candidate is None:
+            return {"success": False, "error": UNAVAILABLE_ERROR}
+        
+        if candidate != model_id:
+            self.rerouted += 1
+            logger.warning(f"Model {model_id} is unavailable, rerouting to {candidate}")
+        
+        breaker = self.get(candidate)
+        started = time.monotonic()
+        try:
+            result = await request(candidate)
+        except asyncio.CancelledError:
+            breaker.cancel()
+            raise
+        except Exception:
+            breaker.record(True, time.monotonic() - started)
+            raise
+        
+        # Перегрузка очереди - наш отказ, а не сбой модели
+        if result.get('error') == OVERLOADED_ERROR:
+            breaker.cancel()
+        else:
+            breaker.record(not result['success'], result.get('latency', time.monotonic() - started))
+        
+        result['model_id'] = candidate
+        return result
+    
+    def stats(self):
+        return {
+            model_id: {'state': breaker.state, 'trips': breaker.trips, 'rejected': breaker.rejected}
+            for model_id, breaker in self.breakers.items()
+        }
+
+model_breakers = ModelBreakers(Config.MODEL_FALLBACKS)
@@ -0,0 +1,76 @@
+import logging
+from catalog import catalog
+
+logger = logging.getLogger(__name__)
+
+def pack(action, arg=None):
+    """Собирает callback_data вида '<action>:<arg>'"""
+    return action if arg is None else f"{action}:{arg}"
+
+def pack_model(action, model_id):
+    """callback_data с коротким ключом модели вместо полного id"""
+    return pack(action, catalog.model_key(model_id))
+
+class CallbackRouter:
+    """Единый обработчик callback-запросов с маршрутизацией по коду действия за O(1).
+    
+    Новый формат: '<action>:<arg>'. Старые кнопки ('model_<id>', 'api_info_<id>', ...)
+    из уже отправленных сообщений разбираются по таблице legacy-префиксов.
+    """
+    
+    def __init__(self):
+        self.handlers = {}
+        self.legacy = {}
+        self.legacy_prefixes = []
+    
+    def action(self, code, legacy=None, model_arg=False):
+        """Регистрирует обработчик handler(callback, arg) для кода действия.
+        
+        legacy - старая callback_data: точное значение или префикс с '_' на конце.
+        model_arg - аргумент является ключом модели и передается как полный id.
+        """
+        def decorator(handler):
+            if code in self.handlers:
+                raise ValueError(f"Callback action already registered: {code}")
+            self.handlers[code] = (handler, model_arg)
+            
+            if legacy:
+                if legacy.endswith('_'):
+                    self.legacy_prefixes.append((legacy, handler))
+                    # Более длинные префиксы проверяем раньше: 'api_info_' до 'api_'
+                    self.legacy_prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+                else:
+                    self.legacy[legacy] = handler
+            return handler
+        return decorator
+    
+    def resolve(self, data):
+        """Возвращает (handler, arg) или (None, None)"""
+        action, _, arg = data.partition(':')
+        entry = self.handlers.get(action)
+        if entry is not None:
+            handler, model_arg = entry
+            if model_arg:
+                model = catalog.get_model_by_key(arg)
+                arg = model['id'] if model else None
+            return handler, arg
+        
+        handler = self.legacy.get(data)
+        if handler is not None:
+            return handler, None
+        
+        for prefix, handler in self.legacy_prefixes:
+            if data.startswith(prefix):
+                return handler, data[len(prefix):]
+        
+        return None, None
+    
+    async def dispatch(self, callback):
+        handler, arg = self.resolve(callback.data or "")
+        if handler is None:
+            logger.warning(f"Unknown callback data: {callback.data}")
+            await callback.answer()
+            return
+        await handler(callback, arg)
+
+callback_router = CallbackRouter()
@@ -0,0 +1,156 @@
+import logging
+import hashlib
+import functools
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Битовые флаги возможностей модели
+CAP_IMAGES = 1
+CAP_VIDEO = 2
+CAP_AUDIO = 4
+
+CAPABILITY_FLAGS = {
+    'supports_images': CAP_IMAGES,
+    'supports_video': CAP_VIDEO,
+    'supports_audio': CAP_AUDIO,
+}
+
+class Catalog:
+    """Индексы моделей и тарифов, построенные один раз из Config"""
+    
+    def __init__(self):
+        self.version = 0
+        self.rebuild()
+    
+    def rebuild(self):
+        models = {}
+        model_tiers = {}
+        capabilities = {}
+        model_keys = {}
+        models_by_key = {}
+        for tier, tier_models in Config.AI_MODELS.items():
+            for model in tier_models:
+                if model['id'] in models:
+                    raise ValueError(f"Duplicate model id in AI_MODELS: {model['id']}")
+                models[model['id']] = model
+                model_tiers[model['id']] = tier
+                capabilities[model['id']] = sum(
+                    flag for key, flag in CAPABILITY_FLAGS.items() if model.get(key)
+                )
+        
+        # Короткие стабильные ключи моделей для callback_data (лимит Telegram - 64 байта)
+        for model_id, model in models.items():
+            key = self.make_model_key(model_id)
+            if key in models_by_key:
+                raise ValueError(f"Model key collision: {model_id}")
+            model_keys[model_id] = key
+            models_by_key[key] = model
+        
+        plans = {}
+        plan_ranks = {}
+        for plan in Config.SUBSCRIPTION_PLANS:
+            if plan['id'] in plans:
+                raise ValueError(f"Duplicate plan id in SUBSCRIPTION_PLANS: {plan['id']}")
+            plans[plan['id']] = plan
+            # Тарифы перечислены от младшего к старшему
+            plan_ranks[plan['id']] = len(plan_ranks)
+        
+        tier_models = {}
+        subscription_models = {}
+        for subscription, tiers in Config.SUBSCRIPTION_ACCESS.items():
+            unknown = [tier for tier in tiers if tier not in Config.AI_MODELS]
+            if unknown:
+                raise ValueError(f"SUBSCRIPTION_ACCESS[{subscription}] references unknown tiers: {unknown}")
+            subscription_models[subscription] = tuple(
+                model for tier in tiers for model in Config.AI_MODELS[tier]
+            )
+            tier_models[subscription] = frozenset(model['id'] for model in subscription_models[subscription])
+        
+        missing_access = [plan_id for plan_id in plans if plan_id not in tier_models]
+        if missing_access:
+            raise ValueError(f"Plans without SUBSCRIPTION_ACCESS entry: {missing_access}")
+        
+        if Config.IMAGE_GENERATION_MODEL not in models:
+            raise ValueError(f"IMAGE_GENERATION_MODEL is not in AI_MODELS: {Config.IMAGE_GENERATION_MODEL}")
+        
+        for model_id, chain in Config.MODEL_FALLBACKS.items():
+            unknown = [fallback for fallback in [model_id] + chain if fallback not in models]
+            if unknown:
+                raise ValueError(f"MODEL_FALLBACKS references unknown models: {unknown}")
+        
+        # Ключи без описания модели просто не показываются в меню
+        for model_id in Config.API_KEY_PRICES:
+            if model_id not in models:
+                logger.warning(f"API_KEY_PRICES model is not in AI_MODELS and will be hidden: {model_id}")
+        
+        self.models = models
+        self.model_keys = model_keys
+        self.models_by_key = models_by_key
+        self.model_tiers = model_tiers
+        self.capabilities = capabilities
+        self.plans = plans
+        self.plan_ranks = plan_ranks
+        self.tier_models = tier_models
+        self.subscription_models = subscription_models
+        self.version += 1
+    
+    def make_model_key(self, model_id):
+        return hashlib.sha1(model_id.encode()).hexdigest()[:6]
+    
+    def model_key(self, model_id):
+        return self.model_keys.get(model_id) or self.make_model_key(model_id)
+    
+    def get_model(self, model_id):
+        return self.models.get(model_id)
+    
+    def get_model_by_key(self, key):
+        return self.models_by_key.get(key)
+    
+    def get_plan(self, plan_id):
+        return self.plans.get(plan_id)
+    
+    def plan_rank(self, plan_id):
+        return self.plan_ranks.get(plan_id, 0)
+    
+    def allowed_models(self, subscription):
+        return self.tier_models.get(subscription, self.tier_models['free'])
+    
+    def models_for(self, subscription):
+        """Модели подписки в порядке тарифов (для меню)"""
+        return self.subscription_models.get(subscription, self.subscription_models['free'])
+    
+    def can_use(self, subscription, model_id):
+        return model_id in self.allowed_models(subscription)
+    
+    def supports(self, model_id, capability):
+        return bool(self.capabilities.get(model_id, 0) & capability)
+
+catalog = Catalog()
+
+def catalog_cached(key=None):
+    """Мемоизирует результат (клавиатуры, тексты) по аргументам.
+    
+    Кеш сбрасывается при пересборке каталога (catalog.rebuild). key - функция,
+    превращающая аргументы в хешируемый ключ, если они сами не хешируются.
+    """
+    def decorator(func):
+        cache = {}
+        built_for = [catalog.version]
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if built_for[0] != catalog.version:
+                cache.clear()
+                built_for[0] = catalog.version
+            
+            cache_key = key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+            result = cache.get(cache_key)
+            if result is None:
+                result = func(*args, **kwargs)
+                cache[cache_key] = result
+            return result
+        
+        wrapper.cache = cache
+        return wrapper
+    return decorator
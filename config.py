@@ -10,6 +10,12 @@ class Config:
     ROUTERAI_API_KEY = os.getenv("ROUTERAI_API_KEY", "sk-q3x47IGel2Cv4g-DCxIEf4WNDbQiEAqG")
     ROUTERAI_ENDPOINT = os.getenv("ROUTERAI_ENDPOINT", "https://routerai.ru/api/v1")
     
+    # RouterAI connection pool (общая keep-alive сессия)
+    ROUTERAI_POOL_LIMIT = int(os.getenv("ROUTERAI_POOL_LIMIT", "100"))
+    ROUTERAI_POOL_LIMIT_PER_HOST = int(os.getenv("ROUTERAI_POOL_LIMIT_PER_HOST", "50"))
+    ROUTERAI_KEEPALIVE_TIMEOUT = int(os.getenv("ROUTERAI_KEEPALIVE_TIMEOUT", "60"))
+    ROUTERAI_DNS_CACHE_TTL = int(os.getenv("ROUTERAI_DNS_CACHE_TTL", "300"))
+    
     # YooKassa (тестовый режим)
     YUKASSA_SHOP_ID = os.getenv("YUKASSA_SHOP_ID", "1241024")
     YUKASSA_SECRET_KEY = os.getenv("YUKASSA_SECRET_KEY", "test_dovNMVr5Rjt6Ez5W5atO2a1RDpzNKLlQh6dcp-fDpsI")
@@ -18,6 +24,172 @@ class Config:
     PORT = int(os.getenv("PORT", "8000"))
     WEBHOOK_DOMAIN = os.getenv("WEBHOOK_DOMAIN", "corresponding-coletta-erikos-8a82819d.koyeb.app")
     
+    # Streaming (потоковые ответы с редактированием сообщения)
+    STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "true").lower() == "true"
+    STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+    
+    # Write-behind счетчики: сброс в БД раз в USAGE_FLUSH_INTERVAL секунд
+    # (или сразу при USAGE_FLUSH_MAX_PENDING пользователях в буфере)
+    USAGE_WRITE_BEHIND = os.getenv("USAGE_WRITE_BEHIND", "true").lower() == "true"
+    USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+    USAGE_FLUSH_MAX_PENDING = int(os.getenv("USAGE_FLUSH_MAX_PENDING", "1000"))
+    
+    # SQLite storage profile (применяется при подключении)
+    DATABASE_PATH = os.getenv("DATABASE_PATH", "bot.db")
+    SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+    SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+    SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))  # отрицательное - в KiB
+    SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY")
+    SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "256"))
+    
+    # Кеш записей пользователей в Database
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+    
+    # История диалогов (in-memory)
+    CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "10"))
+    CONVERSATION_MAX_USERS = int(os.getenv("CONVERSATION_MAX_USERS", "50000"))
+    CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", str(256 * 1024 * 1024)))
+    CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "3600"))
+    
+    # Бюджет токенов на историю диалога (вместе с текущим сообщением)
+    DEFAULT_HISTORY_TOKEN_BUDGET = int(os.getenv("DEFAULT_HISTORY_TOKEN_BUDGET", "4000"))
+    HISTORY_TOKEN_BUDGETS = {
+        "google/gemma-3-4b-it": 2000,
+        "openai/gpt-oss-20b": 3000,
+        "google/gemini-3-pro-preview": 8000,
+        "openai/o1-pro": 8000,
+    }
+    
+    # Одновременные AI-запросы одного пользователя: queue / reject / cancel_previous
+    USER_CONCURRENCY_POLICY = os.getenv("USER_CONCURRENCY_POLICY", "queue")
+    USER_MAX_INFLIGHT = int(os.getenv("USER_MAX_INFLIGHT", "1"))
+    USER_MAX_QUEUED = int(os.getenv("USER_MAX_QUEUED", "2"))
+    
+    # Общий планировщик запросов к RouterAI: лимит одновременных запросов на модель и очередь
+    UPSTREAM_DEFAULT_CONCURRENCY = int(os.getenv("UPSTREAM_DEFAULT_CONCURRENCY", "8"))
+    UPSTREAM_MODEL_CONCURRENCY = {
+        "google/gemma-3-4b-it": 16,
+        "openai/gpt-oss-20b": 12,
+        "google/gemini-2.5-flash-image": 4,
+        "openai/o1-pro": 4,
+    }
+    UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "50"))
+    UPSTREAM_MAX_WAIT = float(os.getenv("UPSTREAM_MAX_WAIT", "30"))
+    UPSTREAM_PRIORITY_AGING = float(os.getenv("UPSTREAM_PRIORITY_AGING", "0.5"))  # ранг тарифа за секунду ожидания
+    
+    # Повторы запросов к RouterAI
+    ROUTERAI_MAX_ATTEMPTS = int(os.getenv("ROUTERAI_MAX_ATTEMPTS", "3"))
+    ROUTERAI_RETRY_BASE_DELAY = float(os.getenv("ROUTERAI_RETRY_BASE_DELAY", "0.5"))
+    ROUTERAI_RETRY_MAX_DELAY = float(os.getenv("ROUTERAI_RETRY_MAX_DELAY", "8"))
+    # Сколько попытка открыть стрим может ждать первых данных (внутри общего таймаута запроса)
+    ROUTERAI_ATTEMPT_TIMEOUT = float(os.getenv("ROUTERAI_ATTEMPT_TIMEOUT", "60"))
+    ROUTERAI_ATTEMPT_TIMEOUTS = {
+        "openai/o1-pro": 120,
+        "openai/gpt-5.2": 120,
+        "google/gemini-3-pro-preview": 90,
+    }
+    
+    # Circuit breaker моделей: окно исходов, пороги и время в открытом состоянии
+    BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))
+    BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+    BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+    BREAKER_SLOW_CALL_RATE = float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.5"))
+    BREAKER_SLOW_CALL_THRESHOLD = float(os.getenv("BREAKER_SLOW_CALL_THRESHOLD", "30"))
+    BREAKER_SLOW_CALL_THRESHOLDS = {
+        "google/gemini-3-pro-preview": 60,
+        "openai/o1-pro": 90,
+    }
+    BREAKER_OPEN_DURATION = float(os.getenv("BREAKER_OPEN_DURATION", "30"))
+    BREAKER_HALF_OPEN_CALLS = int(os.getenv("BREAKER_HALF_OPEN_CALLS", "2"))
+    
+    # Запасные модели при недоступности основной (берутся только доступные по подписке).
+    # Для моделей без записи - все модели подписки от старших тарифов к младшим
+    MODEL_FALLBACKS = {
+        "google/gemini-3-pro-preview": ["openai/gpt-5.2", "openai/o1-pro", "google/gemini-2.0-flash-lite-001"],
+        "openai/o1-pro": ["openai/gpt-5.2", "google/gemini-3-pro-preview"],
+        "openai/gpt-5.2": ["google/gemini-3-pro-preview", "google/gemini-2.0-flash-lite-001"],
+        "google/gemma-3-4b-it": [],
+    }
+    
+    # Хеджирование: дублирующий запрос к дешевым моделям, если ответа нет дольше p95
+    HEDGED_MODELS = [model for model in os.getenv("HEDGED_MODELS", "google/gemma-3-4b-it,openai/gpt-oss-20b").split(",") if model]
+    HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))  # доля запросов, которые можно дублировать
+    HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+    HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "5"))  # пока замеров меньше HEDGE_MIN_SAMPLES
+    HEDGE_LATENCY_WINDOW = int(os.getenv("HEDGE_LATENCY_WINDOW", "500"))
+    
+    # Кеш ответов на одинаковые запросы (модели, для которых повтор ответа допустим)
+    RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+    RESPONSE_CACHE_MODELS = [model for model in os.getenv("RESPONSE_CACHE_MODELS", "google/gemma-3-4b-it,openai/gpt-oss-20b").split(",") if model]
+    RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+    RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+    RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.db")  # пусто - только в памяти
+    RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "100000"))
+    
+    # Семантический кеш: ответы на перефразированные однократные запросы (включается по моделям)
+    SEMANTIC_CACHE_MODELS = [model for model in os.getenv("SEMANTIC_CACHE_MODELS", "").split(",") if model]
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+    SEMANTIC_CACHE_DIMENSIONS = int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", str(2 ** 18)))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "20000"))
+    SEMANTIC_CACHE_MAX_BYTES = int(os.getenv("SEMANTIC_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+    SEMANTIC_CACHE_MAX_POSTINGS = int(os.getenv("SEMANTIC_CACHE_MAX_POSTINGS", "500"))  # слишком частые признаки не просматриваем
+    SEMANTIC_CACHE_MAX_FEATURES = int(os.getenv("SEMANTIC_CACHE_MAX_FEATURES", "16"))  # самых редких признаков запроса
+    SEMANTIC_CACHE_CANDIDATES = int(os.getenv("SEMANTIC_CACHE_CANDIDATES", "8"))  # кандидатов с точным косинусом
+    
+    # Подготовка изображений перед отправкой в модель
+    IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1568"))  # по большей стороне
+    IMAGE_MAX_DIMENSIONS = {
+        "google/gemma-3-4b-it": 896,
+        "google/gemini-2.0-flash-lite-001": 1024,
+        "bytedance-seed/seed-1.6-flash": 1024,
+    }
+    IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG")  # JPEG или WEBP
+    IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+    
+    # Загрузка медиа: размер куска и порог, после которого временный файл уходит на диск
+    MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(64 * 1024)))
+    MEDIA_SPOOL_MAX_SIZE = int(os.getenv("MEDIA_SPOOL_MAX_SIZE", str(1024 * 1024)))
+    
+    # Анализ видео по ключевым кадрам (нужен ffmpeg, иначе - только превью Telegram)
+    FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+    VIDEO_MAX_SIZE = int(os.getenv("VIDEO_MAX_SIZE", str(20 * 1024 * 1024)))  # Bot API отдает файлы до 20 МБ
+    VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", "6"))
+    VIDEO_CANDIDATE_FRAMES = int(os.getenv("VIDEO_CANDIDATE_FRAMES", "24"))
+    VIDEO_FRAME_MAX_DIMENSION = int(os.getenv("VIDEO_FRAME_MAX_DIMENSION", "768"))
+    VIDEO_EXTRACT_TIMEOUT = float(os.getenv("VIDEO_EXTRACT_TIMEOUT", "60"))
+    VIDEO_WORKERS = int(os.getenv("VIDEO_WORKERS", "2"))
+    VIDEO_FRAME_CACHE_BYTES = int(os.getenv("VIDEO_FRAME_CACHE_BYTES", str(64 * 1024 * 1024)))
+    
+    # Анализ документов: txt, md, csv и pdf (pdf - при установленном pypdf)
+    DOCUMENT_MAX_SIZE = int(os.getenv("DOCUMENT_MAX_SIZE", str(10 * 1024 * 1024)))
+    DOCUMENT_MAX_CHARS = int(os.getenv("DOCUMENT_MAX_CHARS", "400000"))
+    DOCUMENT_CHUNK_TOKENS = int(os.getenv("DOCUMENT_CHUNK_TOKENS", "3000"))
+    DOCUMENT_MAX_CHUNKS = int(os.getenv("DOCUMENT_MAX_CHUNKS", "20"))
+    DOCUMENT_MAP_CONCURRENCY = int(os.getenv("DOCUMENT_MAP_CONCURRENCY", "3"))  # параллельных запросов на один документ
+    DOCUMENT_WORKERS = int(os.getenv("DOCUMENT_WORKERS", "2"))
+    DOCUMENT_CACHE_CHARS = int(os.getenv("DOCUMENT_CACHE_CHARS", "20000000"))
+    DOCUMENT_ADMIT_TOKENS = int(os.getenv("DOCUMENT_ADMIT_TOKENS", "1000"))  # резерв до извлечения текста
+    
+    # Дисковый кеш медиа (входящие фото и сгенерированные изображения)
+    MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "media_cache")
+    MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+    
+    # Очередь генерации изображений: воркеры на модель, длина очереди и задачи на пользователя
+    IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", "2"))
+    IMAGE_JOB_MODEL_WORKERS = {
+        "google/gemini-2.5-flash-image": 4,
+    }
+    IMAGE_JOB_MAX_QUEUED = int(os.getenv("IMAGE_JOB_MAX_QUEUED", "50"))  # на модель
+    IMAGE_JOB_MAX_PER_USER = int(os.getenv("IMAGE_JOB_MAX_PER_USER", "2"))
+    IMAGE_JOB_MAX_ATTEMPTS = int(os.getenv("IMAGE_JOB_MAX_ATTEMPTS", "3"))  # с учетом перезапусков
+    IMAGE_JOB_NOTIFY_POSITIONS = int(os.getenv("IMAGE_JOB_NOTIFY_POSITIONS", "10"))  # кому обновлять место в очереди
+    IMAGE_JOB_RETENTION_DAYS = int(os.getenv("IMAGE_JOB_RETENTION_DAYS", "7"))
+    
     # Limits
     FREE_DAILY_LIMIT = 1000
     TRIAL_MONTHS = 3
@@ -0,0 +1,134 @@
+import sys
+import time
+from collections import OrderedDict, deque
+from config import Config
+from tokens import estimate_message_tokens
+
+class Conversation:
+    """История одного пользователя: кольцевой буфер (role, content, tokens)"""
+    __slots__ = ('messages', 'last_access', 'size')
+    
+    def __init__(self, max_messages):
+        self.messages = deque(maxlen=max_messages)
+        self.last_access = time.monotonic()
+        self.size = 0
+
+class ConversationStore:
+    """Хранилище истории диалогов с общим лимитом памяти, LRU-вытеснением и TTL"""
+    
+    def __init__(self, max_messages, max_users, max_bytes, ttl):
+        self.max_messages = max_messages
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.evicted = 0
+    
+    def message_size(self, role, content):
+        return sys.getsizeof(role) + sys.getsizeof(content)
+    
+    def append(self, user_id, role, content):
+        now = time.monotonic()
+        self.evict_expired(now)
+        
+        conversation = self.items.get(user_id)
+        if conversation is None:
+            conversation = Conversation(self.max_messages)
+            self.items[user_id] = conversation
+        else:
+            self.items.move_to_end(user_id)
+        
+        # deque сам выкинет самое старое сообщение - учитываем его размер
+        if len(conversation.messages) == self.max_messages:
+            old_role, old_content, _ = conversation.messages[0]
+            removed = self.message_size(old_role, old_content)
+            conversation.size -= removed
+            self.bytes -= removed
+        
+        size = self.message_size(role, content)
+        # Оценка токенов считается один раз и хранится вместе с сообщением
+        conversation.messages.append((role, content, estimate_message_tokens(content)))
+        conversation.size += size
+        conversation.last_access = now
+        self.bytes += size
+        
+        self.evict_overflow(keep=user_id)
+    
+    def get(self, user_id):
+        conversation = self.items.get(user_id)
+        if conversation is None:
+            return None
+        
+        now = time.monotonic()
+        if now - conversation.last_access > self.ttl:
+            self.drop(user_id)
+            return None
+        
+        conversation.last_access = now
+        self.items.move_to_end(user_id)
+        return conversation
+    
+    def history(self, user_id):
+        """Возвращает историю в формате messages для API"""
+        conversation = self.get(user_id)
+        if conversation is None:
+            return []
+        return [{"role": role, "content": content} for role, content, _ in conversation.messages]
+    
+    def fit_history(self, user_id, max_tokens):
+        """Последние сообщения, укладывающиеся в бюджет токенов: (messages, tokens)"""
+        conversation = self.get(user_id)
+        if conversation is None:
+            return [], 0
+        
+        selected = []
+        total = 0
+        for role, content, tokens in reversed(conversation.messages):
+            if total + tokens > max_tokens:
+                break
+            selected.append({"role": role, "content": content})
+            total += tokens
+        
+        selected.reverse()
+        # История не должна начинаться с ответа ассистента
+        while selected and selected[0]["role"] == "assistant":
+            total -= estimate_message_tokens(selected.pop(0)["content"])
+        return selected, total
+    
+    def drop(self, user_id):
+        conversation = self.items.pop(user_id, None)
+        if conversation is not None:
+            self.bytes -= conversation.size
+            self.evicted += 1
+    
+    def evict_expired(self, now=None):
+        # Записи упорядочены по последнему обращению - просроченные всегда в начале
+        now = now or time.monotonic()
+        while self.items:
+            user_id, conversation = next(iter(self.items.items()))
+            if now - conversation.last_access <= self.ttl:
+                break
+            self.drop(user_id)
+    
+    def evict_overflow(self, keep=None):
+        while self.items and (len(self.items) > self.max_users or self.bytes > self.max_bytes):
+            user_id = next(iter(self.items))
+            if user_id == keep:
+                break
+            self.drop(user_id)
+    
+    def stats(self):
+        return {
+            'entries': len(self.items),
+            'messages': sum(len(c.messages) for c in self.items.values()),
+            'bytes': self.bytes,
+            'evicted': self.evicted
+        }
+
+conversation_store = ConversationStore(
+    max_messages=Config.CONVERSATION_MAX_MESSAGES,
+    max_users=Config.CONVERSATION_MAX_USERS,
+    max_bytes=Config.CONVERSATION_MAX_BYTES,
+    ttl=Config.CONVERSATION_TTL
+)
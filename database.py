@@ -1,15 +1,182 @@
 import sqlite3
+import asyncio
+import functools
 import logging
-from datetime import datetime, timedelta
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from config import Config
+from catalog import catalog
 
 logger = logging.getLogger(__name__)
 
+# Колонки счетчиков медиа по типу
+MEDIA_COUNTERS = {
+    'image_generate': 'images_generated_today',
+    'image_send': 'images_sent_today',
+    'video_send': 'videos_sent_today',
+}
+
+def get_monthly_token_limits(subscription):
+    """Возвращает (всего, вход, выход) месячных токенов для подписки"""
+    # Лимиты для разных подписок (60% на ответы, 40% на вопросы)
+    max_total = 15000 if subscription == 'free' else 850000
+    return max_total, int(max_total * 0.4), int(max_total * 0.6)
+
+class UsageBuffer:
+    """Write-behind буфер счетчиков использования.
+    
+    Инкременты копятся в памяти и периодически сбрасываются в SQLite одной
+    транзакцией (flush). Проверки лимитов читают БД + несброшенные дельты.
+    """
+    
+    DAILY_FIELDS = ('daily_used', 'images_generated_today', 'images_sent_today', 'videos_sent_today')
+    MONTHLY_FIELDS = ('monthly_input_tokens', 'monthly_output_tokens')
+    
+    def __init__(self):
+        self.pending = {}
+    
+    def __len__(self):
+        return len(self.pending)
+    
+    def add(self, user_id, day, month, **deltas):
+        entry = self.pending.get(user_id)
+        if entry is None:
+            entry = dict.fromkeys(self.DAILY_FIELDS + self.MONTHLY_FIELDS, 0)
+            entry['day'] = day
+            entry['month'] = month
+            self.pending[user_id] = entry
+        
+        # Наступили новые сутки/месяц - старые дельты больше не нужны, счетчики обнулятся при сбросе
+        if entry['day'] != day:
+            entry.update(dict.fromkeys(self.DAILY_FIELDS, 0), day=day)
+        if entry['month'] != month:
+            entry.update(dict.fromkeys(self.MONTHLY_FIELDS, 0), month=month)
+        
+        for field, value in deltas.items():
+            entry[field] += value
+    
+    def apply(self, user, day, month):
+        """Возвращает запись пользователя с учетом сброса счетчиков и несброшенных дельт"""
+        if not user:
+            return user
+        
+        if user['last_reset'] != day:
+            user.update(dict.fromkeys(self.DAILY_FIELDS, 0), last_reset=day)
+        if user['last_cost_reset'] != month:
+            user.update(dict.fromkeys(self.MONTHLY_FIELDS, 0), monthly_tokens_used=0, is_blocked=False, last_cost_reset=month)
+        
+        entry = self.pending.get(user['user_id'])
+        if entry:
+            if entry['day'] == day:
+                for field in self.DAILY_FIELDS:
+                    user[field] += entry[field]
+            if entry['month'] == month:
+                for field in self.MONTHLY_FIELDS:
+                    user[field] += entry[field]
+                user['monthly_tokens_used'] += entry['monthly_input_tokens'] + entry['monthly_output_tokens']
+        
+        return user
+    
+    def drain(self):
+        rows = [dict(entry, user_id=user_id) for user_id, entry in self.pending.items()]
+        self.pending = {}
+        return rows
+
+class UserCache:
+    """Ограниченный LRU/TTL кеш записей пользователей со счетчиками попаданий.
+    
+    Ключи приводятся к int: id из метаданных платежа приходят строками.
+    """
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id):
+        user_id = int(user_id)
+        item = self.items.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.items[user_id]
+            self.misses += 1
+            return None
+        
+        self.items.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+    
+    def put(self, user_id, user):
+        if not self.max_size:
+            return
+        user_id = int(user_id)
+        self.items[user_id] = (time.monotonic() + self.ttl, user)
+        self.items.move_to_end(user_id)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+    
+    def peek(self, user_id):
+        """Запись без учета в статистике и без продления LRU"""
+        item = self.items.get(int(user_id))
+        return item[1] if item is not None else None
+    
+    def update(self, user_id, **fields):
+        item = self.items.get(int(user_id))
+        if item is not None:
+            item[1].update(fields)
+    
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            if user_id is not None:
+                self.items.pop(int(user_id), None)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
 class Database:
     def __init__(self):
-        self.conn = sqlite3.connect('bot.db', check_same_thread=False)
+        self.conn = sqlite3.connect(
+            Config.DATABASE_PATH,
+            check_same_thread=False,
+            timeout=Config.SQLITE_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=Config.SQLITE_CACHED_STATEMENTS
+        )
+        self.apply_pragmas()
+        self.usage = UsageBuffer() if Config.USAGE_WRITE_BEHIND else None
+        self.users = UserCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
         self.init_db()
     
+    def apply_pragmas(self):
+        """Применяет профиль SQLite из Config и логирует фактические значения"""
+        cursor = self.conn.cursor()
+        cursor.execute(f'PRAGMA journal_mode = {Config.SQLITE_JOURNAL_MODE}')
+        cursor.execute(f'PRAGMA synchronous = {Config.SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout = {int(Config.SQLITE_BUSY_TIMEOUT_MS)}')
+        cursor.execute(f'PRAGMA mmap_size = {int(Config.SQLITE_MMAP_SIZE)}')
+        cursor.execute(f'PRAGMA cache_size = {int(Config.SQLITE_CACHE_SIZE)}')
+        cursor.execute(f'PRAGMA temp_store = {Config.SQLITE_TEMP_STORE}')
+        
+        logger.info(f"SQLite profile: {self.pragma_report()}")
+    
+    def pragma_report(self):
+        cursor = self.conn.cursor()
+        report = {}
+        for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size', 'temp_store'):
+            cursor.execute(f'PRAGMA {pragma}')
+            report[pragma] = cursor.fetchone()[0]
+        report['cached_statements'] = Config.SQLITE_CACHED_STATEMENTS
+        return report
+    
     def init_db(self):
         cursor = self.conn.cursor()
         
@@ -53,17 +220,73 @@ class Database:
             )
         ''')
         
+        # Лимиты тарифов дублируются в БД, чтобы проверять их прямо в UPDATE
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS plan_limits (
+                plan_id TEXT PRIMARY KEY,
+                daily_limit INTEGER,
+                image_send INTEGER,
+                image_generate INTEGER,
+                video_send INTEGER,
+                max_tokens INTEGER,
+                max_input_tokens INTEGER,
+                max_output_tokens INTEGER
+            )
+        ''')
+        
+        # Очередь генерации изображений: задачи переживают перезапуск бота
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS image_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                model_id TEXT,
+                prompt TEXT,
+                status TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('DELETE FROM plan_limits')
+        cursor.executemany('''
+            INSERT INTO plan_limits 
+            (plan_id, daily_limit, image_send, image_generate, video_send, max_tokens, max_input_tokens, max_output_tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (plan['id'], plan['daily_limit'], plan['image_send'], plan['image_generate'], plan['video_send'])
+            + get_monthly_token_limits(plan['id'])
+            for plan in Config.SUBSCRIPTION_PLANS
+        ])
+        
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_subscription ON users(subscription)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments(user_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_image_jobs_status ON image_jobs(status, model_id, job_id)')
         
         self.conn.commit()
     
     def get_user(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
+        user = self.users.get(user_id)
+        if user is None:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            user = self.user_from_row(cursor.fetchone())
+            if not user:
+                return None
+            self.users.put(user_id, user)
         
+        # Отдаем копию, чтобы вызывающий код не портил кеш
+        user = dict(user)
+        if self.usage is not None:
+            today, month = self.usage_period()
+            user = self.usage.apply(user, today, month)
+        return user
+    
+    def user_from_row(self, user):
         if user:
             return {
                 'user_id': user[0],
@@ -129,6 +352,7 @@ class Database:
         ''', (user_id, username, language, subscription, subscription_end, trial_end, ref_code, referred_by))
         
         self.conn.commit()
+        self.users.invalidate(user_id, referred_by)
         return self.get_user(user_id)
     
     def update_user_subscription(self, user_id, subscription, duration_days=30):
@@ -142,13 +366,64 @@ class Database:
         ''', (subscription, subscription_end, user_id))
         
         self.conn.commit()
+        self.users.update(user_id, subscription=subscription, subscription_end=subscription_end)
     
     def update_user_model(self, user_id, model_id):
         cursor = self.conn.cursor()
         cursor.execute('UPDATE users SET current_model = ? WHERE user_id = ?', (model_id, user_id))
         self.conn.commit()
+        self.users.update(user_id, current_model=model_id)
+    
+    def usage_period(self):
+        now = datetime.now()
+        return now.strftime('%Y-%m-%d'), now.replace(day=1).strftime('%Y-%m-%d')
+    
+    def buffer_usage(self, user_id, **deltas):
+        today, month = self.usage_period()
+        self.usage.add(user_id, today, month, **deltas)
+        
+        # Ограничиваем объем несброшенных данных
+        if len(self.usage) >= Config.USAGE_FLUSH_MAX_PENDING:
+            self.flush_usage()
+    
+    def flush_usage(self):
+        """Сбрасывает накопленные счетчики в БД одной транзакцией"""
+        if not self.usage:
+            return 0
+        
+        # Переносим дельты в кешированные записи, чтобы после сброса не перечитывать их из БД
+        today, month = self.usage_period()
+        for user_id in self.usage.pending:
+            user = self.users.peek(user_id)
+            if user is not None:
+                self.usage.apply(user, today, month)
+        
+        rows = self.usage.drain()
+        cursor = self.conn.cursor()
+        cursor.executemany('''
+            UPDATE users SET
+                daily_used = (CASE WHEN last_reset = :day THEN daily_used ELSE 0 END) + :daily_used,
+                -- Возвраты квоты (release_media_usage) не опускают счетчик ниже нуля
+                images_generated_today = MAX((CASE WHEN last_reset = :day THEN images_generated_today ELSE 0 END) + :images_generated_today, 0),
+                images_sent_today = MAX((CASE WHEN last_reset = :day THEN images_sent_today ELSE 0 END) + :images_sent_today, 0),
+                videos_sent_today = MAX((CASE WHEN last_reset = :day THEN videos_sent_today ELSE 0 END) + :videos_sent_today, 0),
+                last_reset = :day,
+                monthly_tokens_used = (CASE WHEN last_cost_reset = :month THEN monthly_tokens_used ELSE 0 END)
+                    + :monthly_input_tokens + :monthly_output_tokens,
+                monthly_input_tokens = (CASE WHEN last_cost_reset = :month THEN monthly_input_tokens ELSE 0 END) + :monthly_input_tokens,
+                monthly_output_tokens = (CASE WHEN last_cost_reset = :month THEN monthly_output_tokens ELSE 0 END) + :monthly_output_tokens,
+                is_blocked = CASE WHEN last_cost_reset = :month THEN is_blocked ELSE FALSE END,
+                last_cost_reset = :month
+            WHERE user_id = :user_id
+        ''', rows)
+        self.conn.commit()
+        return len(rows)
     
     def increment_daily_usage(self, user_id):
+        if self.usage is not None:
+            self.buffer_usage(user_id, daily_used=1)
+            return
+        
         cursor = self.conn.cursor()
         
         cursor.execute('SELECT last_reset FROM users WHERE user_id = ?', (user_id,))
@@ -170,9 +445,15 @@ class Database:
         
         cursor.execute('UPDATE users SET daily_used = daily_used + 1 WHERE user_id = ?', (user_id,))
         self.conn.commit()
+        self.users.invalidate(user_id)
     
     def update_media_usage(self, user_id, media_type):
         """Обновляет счетчики медиафайлов"""
+        if self.usage is not None:
+            if media_type in MEDIA_COUNTERS:
+                self.buffer_usage(user_id, **{MEDIA_COUNTERS[media_type]: 1})
+            return
+        
         cursor = self.conn.cursor()
         
         cursor.execute('SELECT last_reset FROM users WHERE user_id = ?', (user_id,))
@@ -200,6 +481,29 @@ class Database:
             cursor.execute('UPDATE users SET videos_sent_today = videos_sent_today + 1 WHERE user_id = ?', (user_id,))
         
         self.conn.commit()
+        self.users.invalidate(user_id)
+    
+    def release_media_usage(self, user_id, media_type, reserved_on=None):
+        """Возвращает медиа-лимит, зарезервированный admit_request, если операция не удалась.
+        
+        reserved_on - день резервирования (по умолчанию сегодня): после смены суток
+        счетчик уже обнулен и возвращать нечего.
+        """
+        column = MEDIA_COUNTERS[media_type]
+        today, _ = self.usage_period()
+        if reserved_on is not None and reserved_on != today:
+            return
+        
+        if self.usage is not None:
+            self.buffer_usage(user_id, **{column: -1})
+            return
+        
+        self.conn.execute(f'''
+            UPDATE users SET {column} = MAX({column} - 1, 0)
+            WHERE user_id = ? AND last_reset = ?
+        ''', (user_id, today))
+        self.conn.commit()
+        self.users.invalidate(user_id)
     
     def can_use_model(self, user_id):
         user = self.get_user(user_id)
@@ -213,7 +517,7 @@ class Database:
         if user['last_reset'] != today:
             return True, ""
         
-        plan = next((p for p in Config.SUBSCRIPTION_PLANS if p['id'] == user['subscription']), None)
+        plan = catalog.get_plan(user['subscription'])
         if not plan:
             return False, "Subscription plan not found"
         
@@ -228,7 +532,7 @@ class Database:
         if not user:
             return False, "User not found"
         
-        plan = next((p for p in Config.SUBSCRIPTION_PLANS if p['id'] == user['subscription']), None)
+        plan = catalog.get_plan(user['subscription'])
         if not plan:
             return False, "Plan not found"
         
@@ -243,7 +547,7 @@ class Database:
         if not user:
             return False, "User not found"
         
-        plan = next((p for p in Config.SUBSCRIPTION_PLANS if p['id'] == user['subscription']), None)
+        plan = catalog.get_plan(user['subscription'])
         if not plan:
             return False, "Plan not found"
         
@@ -258,7 +562,7 @@ class Database:
         if not user:
             return False, "User not found"
         
-        plan = next((p for p in Config.SUBSCRIPTION_PLANS if p['id'] == user['subscription']), None)
+        plan = catalog.get_plan(user['subscription'])
         if not plan:
             return False, "Plan not found"
         
@@ -288,23 +592,18 @@ class Database:
                 WHERE user_id = ?
             ''', (first_day_of_month.strftime('%Y-%m-%d'), user_id))
             self.conn.commit()
+            self.users.invalidate(user_id)
             user = self.get_user(user_id)
         
-        # Лимиты для разных подписок (60% на ответы, 40% на вопросы)
-        if user['subscription'] == 'free':
-            max_total = 15000
-            max_input = int(max_total * 0.4)  # 6K
-            max_output = int(max_total * 0.6)  # 9K
-        else:
-            max_total = 850000
-            max_input = int(max_total * 0.4)  # 340K
-            max_output = int(max_total * 0.6)  # 510K
+        max_total, max_input, max_output = get_monthly_token_limits(user['subscription'])
         
-        # Проверка лимитов
+        # Проверка лимитов; блокируем только при реально исчерпанном лимите
         if user['monthly_tokens_used'] + input_tokens + output_tokens > max_total:
-            cursor = self.conn.cursor()
-            cursor.execute('UPDATE users SET is_blocked = TRUE WHERE user_id = ?', (user_id,))
-            self.conn.commit()
+            if user['monthly_tokens_used'] >= max_total:
+                cursor = self.conn.cursor()
+                cursor.execute('UPDATE users SET is_blocked = TRUE WHERE user_id = ?', (user_id,))
+                self.conn.commit()
+                self.users.invalidate(user_id)
             return False, f"Monthly token limit reached ({max_total} tokens)"
         
         if user['monthly_input_tokens'] + input_tokens > max_input:
@@ -317,6 +616,10 @@ class Database:
     
     def update_token_usage(self, user_id, input_tokens, output_tokens):
         """Обновляет счетчики использованных токенов"""
+        if self.usage is not None:
+            self.buffer_usage(user_id, monthly_input_tokens=input_tokens, monthly_output_tokens=output_tokens)
+            return
+        
         cursor = self.conn.cursor()
         cursor.execute('''
             UPDATE users 
@@ -326,6 +629,168 @@ class Database:
             WHERE user_id = ?
         ''', (input_tokens + output_tokens, input_tokens, output_tokens, user_id))
         self.conn.commit()
+        self.users.invalidate(user_id)
+    
+    def admit_request(self, user_id, username=None, media_type=None, count_message=True, input_tokens=0, output_tokens=0):
+        """Атомарно пускает запрос: сброс дневных/месячных счетчиков, проверка лимитов
+        тарифа и резервирование использования одним UPDATE.
+        
+        Возвращает {'allowed': bool, 'error': str, 'user': dict}.
+        """
+        media_column = MEDIA_COUNTERS.get(media_type)
+        today, month = self.usage_period()
+        params = {
+            'user_id': user_id,
+            'today': today,
+            'month': month,
+            'daily_inc': 1 if count_message else 0,
+            'gen_inc': 1 if media_type == 'image_generate' else 0,
+            'img_inc': 1 if media_type == 'image_send' else 0,
+            'vid_inc': 1 if media_type == 'video_send' else 0,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+        }
+        
+        if self.usage is not None:
+            return self.admit_buffered(user_id, username, media_type, params)
+        
+        media_check = ''
+        if media_column:
+            media_check = f'''
+              AND (CASE WHEN users.last_reset = :today THEN users.{media_column} ELSE 0 END) + 1 <= p.{media_type}'''
+        
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            UPDATE users SET
+                daily_used = (CASE WHEN last_reset = :today THEN daily_used ELSE 0 END) + :daily_inc,
+                images_generated_today = (CASE WHEN last_reset = :today THEN images_generated_today ELSE 0 END) + :gen_inc,
+                images_sent_today = (CASE WHEN last_reset = :today THEN images_sent_today ELSE 0 END) + :img_inc,
+                videos_sent_today = (CASE WHEN last_reset = :today THEN videos_sent_today ELSE 0 END) + :vid_inc,
+                last_reset = :today,
+                monthly_tokens_used = CASE WHEN last_cost_reset = :month THEN monthly_tokens_used ELSE 0 END,
+                monthly_input_tokens = CASE WHEN last_cost_reset = :month THEN monthly_input_tokens ELSE 0 END,
+                monthly_output_tokens = CASE WHEN last_cost_reset = :month THEN monthly_output_tokens ELSE 0 END,
+                is_blocked = CASE WHEN last_cost_reset = :month THEN is_blocked ELSE FALSE END,
+                last_cost_reset = :month
+            FROM plan_limits AS p
+            WHERE users.user_id = :user_id
+              AND p.plan_id = users.subscription
+              AND NOT (CASE WHEN users.last_cost_reset = :month THEN users.is_blocked ELSE FALSE END)
+              AND (CASE WHEN users.last_reset = :today THEN users.daily_used ELSE 0 END) + :daily_inc <= p.daily_limit{media_check}
+              AND (CASE WHEN users.last_cost_reset = :month THEN users.monthly_tokens_used ELSE 0 END)
+                  + :input_tokens + :output_tokens <= p.max_tokens
+              AND (CASE WHEN users.last_cost_reset = :month THEN users.monthly_input_tokens ELSE 0 END)
+                  + :input_tokens <= p.max_input_tokens
+              AND (CASE WHEN users.last_cost_reset = :month THEN users.monthly_output_tokens ELSE 0 END)
+                  + :output_tokens <= p.max_output_tokens
+            RETURNING *
+        ''', params)
+        rows = cursor.fetchall()
+        
+        if rows:
+            self.conn.commit()
+            user = self.user_from_row(rows[0])
+            self.users.put(user_id, user)
+            return {'allowed': True, 'error': "", 'user': dict(user)}
+        
+        # Медленный путь: пользователя нет или лимит исчерпан - выясняем причину
+        user = self.get_user(user_id)
+        if not user:
+            self.create_user(user_id, username)
+            return self.admit_request(user_id, username, media_type, count_message, input_tokens, output_tokens)
+        
+        return {'allowed': False, 'error': self.admission_error(user, params, media_type) or "Request rejected", 'user': user}
+    
+    def admit_buffered(self, user_id, username, media_type, params):
+        """admit_request для write-behind режима: проверка по памяти, резерв в буфере"""
+        user = self.get_user(user_id)
+        if not user:
+            user = self.create_user(user_id, username)
+        
+        error = self.admission_error(user, params, media_type)
+        if error:
+            return {'allowed': False, 'error': error, 'user': user}
+        
+        deltas = {'daily_used': params['daily_inc']}
+        if media_type in MEDIA_COUNTERS:
+            deltas[MEDIA_COUNTERS[media_type]] = 1
+        self.buffer_usage(user_id, **deltas)
+        
+        for field, value in deltas.items():
+            user[field] += value
+        return {'allowed': True, 'error': "", 'user': user}
+    
+    def admission_error(self, user, params, media_type):
+        """Причина отказа или пустая строка, если запрос укладывается в лимиты"""
+        plan = catalog.get_plan(user['subscription'])
+        if not plan:
+            return "Subscription plan not found"
+        
+        new_day = user['last_reset'] != params['today']
+        new_month = user['last_cost_reset'] != params['month']
+        
+        if user['is_blocked'] and not new_month:
+            return "Account blocked"
+        
+        daily_used = 0 if new_day else user['daily_used']
+        if daily_used + params['daily_inc'] > plan['daily_limit']:
+            return f"Daily limit ({plan['daily_limit']} messages) exceeded"
+        
+        if media_type in MEDIA_COUNTERS:
+            media_used = 0 if new_day else user[MEDIA_COUNTERS[media_type]]
+            if media_used >= plan[media_type]:
+                return {
+                    'image_generate': f"Image generation limit reached ({plan['image_generate']}/day)",
+                    'image_send': f"Image send limit reached ({plan['image_send']}/day)",
+                    'video_send': f"Video send limit reached ({plan['video_send']}/day)",
+                }[media_type]
+        
+        max_total, max_input, max_output = get_monthly_token_limits(user['subscription'])
+        tokens_used = 0 if new_month else user['monthly_tokens_used']
+        input_used = 0 if new_month else user['monthly_input_tokens']
+        output_used = 0 if new_month else user['monthly_output_tokens']
+        
+        if tokens_used + params['input_tokens'] + params['output_tokens'] > max_total:
+            # Завышенная оценка одного запроса не должна блокировать аккаунт до конца месяца
+            if tokens_used < max_total:
+                return f"Monthly token limit reached ({max_total} tokens)"
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE users SET
+                    monthly_tokens_used = CASE WHEN last_cost_reset = :month THEN monthly_tokens_used ELSE 0 END,
+                    monthly_input_tokens = CASE WHEN last_cost_reset = :month THEN monthly_input_tokens ELSE 0 END,
+                    monthly_output_tokens = CASE WHEN last_cost_reset = :month THEN monthly_output_tokens ELSE 0 END,
+                    last_cost_reset = :month,
+                    is_blocked = TRUE
+                WHERE user_id = :user_id
+            ''', {'month': params['month'], 'user_id': user['user_id']})
+            self.conn.commit()
+            self.users.invalidate(user['user_id'])
+            return f"Monthly token limit reached ({max_total} tokens)"
+        
+        if input_used + params['input_tokens'] > max_input:
+            return f"Monthly input token limit reached ({max_input} tokens)"
+        
+        if output_used + params['output_tokens'] > max_output:
+            return f"Monthly output token limit reached ({max_output} tokens)"
+        
+        return ""
+    
+    def token_budget_error(self, user_id, input_tokens, output_tokens):
+        """Хватит ли месячных токенов на запрос (без резервирования). Пустая строка - хватит"""
+        user = self.get_user(user_id)
+        if not user:
+            return "User not found"
+        
+        today, month = self.usage_period()
+        params = {
+            'today': today,
+            'month': month,
+            'daily_inc': 0,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+        }
+        return self.admission_error(user, params, None)
     
     def create_payment(self, payment_id, user_id, payment_type, plan_id=None, model_id=None, amount=0):
         cursor = self.conn.cursor()
@@ -391,5 +856,171 @@ class Database:
                 'yookassa_payment_id': payment[7]
             }
         return None
+    
+    def image_job_from_row(self, job):
+        if not job:
+            return None
+        return {
+            'job_id': job[0],
+            'user_id': job[1],
+            'chat_id': job[2],
+            'message_id': job[3],
+            'model_id': job[4],
+            'prompt': job[5],
+            'status': job[6],
+            'attempts': job[7],
+            'error': job[8],
+            # Квота резервируется при постановке задачи; created_at - в UTC, сутки лимитов - локальные
+            'reserved_on': datetime.strptime(job[9], '%Y-%m-%d %H:%M:%S')
+                .replace(tzinfo=timezone.utc).astimezone().strftime('%Y-%m-%d')
+        }
+    
+    def create_image_job(self, user_id, chat_id, message_id, model_id, prompt, max_queued, max_per_user):
+        """Ставит задачу в очередь модели: {'job_id', 'position'} или {'error': 'queue_full'|'user_limit'}"""
+        cursor = self.conn.cursor()
+        
+        cursor.execute('''
+            SELECT COUNT(*) FROM image_jobs
+            WHERE user_id = ? AND status IN ('queued', 'running')
+        ''', (user_id,))
+        if cursor.fetchone()[0] >= max_per_user:
+            return {'error': 'user_limit'}
+        
+        cursor.execute('''
+            SELECT COUNT(*) FROM image_jobs
+            WHERE model_id = ? AND status = 'queued'
+        ''', (model_id,))
+        queued = cursor.fetchone()[0]
+        if queued >= max_queued:
+            return {'error': 'queue_full'}
+        
+        cursor.execute('''
+            INSERT INTO image_jobs (user_id, chat_id, message_id, model_id, prompt)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, message_id, model_id, prompt))
+        self.conn.commit()
+        return {'job_id': cursor.lastrowid, 'position': queued + 1}
+    
+    def claim_image_job(self, model_id):
+        """Забирает самую старую задачу модели в работу (соединение используется из одного потока)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT * FROM image_jobs
+            WHERE model_id = ? AND status = 'queued'
+            ORDER BY job_id LIMIT 1
+        ''', (model_id,))
+        job = self.image_job_from_row(cursor.fetchone())
+        if not job:
+            return None
+        
+        cursor.execute('''
+            UPDATE image_jobs
+            SET status = 'running', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        ''', (job['job_id'],))
+        self.conn.commit()
+        job['status'] = 'running'
+        job['attempts'] += 1
+        return job
+    
+    def finish_image_job(self, job_id, status, error=None):
+        self.conn.execute('''
+            UPDATE image_jobs
+            SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        ''', (status, error, job_id))
+        self.conn.commit()
+    
+    def queued_image_jobs(self, model_id, limit):
+        """Первые задачи в очереди модели (их позиция - индекс + 1)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT * FROM image_jobs
+            WHERE model_id = ? AND status = 'queued'
+            ORDER BY job_id LIMIT ?
+        ''', (model_id, limit))
+        return [self.image_job_from_row(job) for job in cursor.fetchall()]
+    
+    def recover_image_jobs(self, max_attempts, retention_days):
+        """После перезапуска: прерванные задачи - снова в очередь, старые завершенные - удаляем.
+        
+        Возвращает (число задач в очереди заново, задачи, исчерпавшие попытки, модели с очередью).
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT * FROM image_jobs
+            WHERE status = 'running' AND attempts >= ?
+        ''', (max_attempts,))
+        failed = [self.image_job_from_row(job) for job in cursor.fetchall()]
+        cursor.execute('''
+            UPDATE image_jobs
+            SET status = 'failed', error = 'Too many attempts', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND attempts >= ?
+        ''', (max_attempts,))
+        cursor.execute('''
+            UPDATE image_jobs
+            SET status = 'queued', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'running'
+        ''')
+        requeued = cursor.rowcount
+        cursor.execute('''
+            DELETE FROM image_jobs
+            WHERE status IN ('done', 'failed') AND updated_at < datetime('now', ?)
+        ''', (f'-{int(retention_days)} days',))
+        cursor.execute("SELECT DISTINCT model_id FROM image_jobs WHERE status = 'queued'")
+        models = [row[0] for row in cursor.fetchall()]
+        self.conn.commit()
+        return requeued, failed, models
+    
+    def image_job_counts(self):
+        """{model_id: {status: count}} по незавершенным задачам"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT model_id, status, COUNT(*) FROM image_jobs
+            WHERE status IN ('queued', 'running')
+            GROUP BY model_id, status
+        ''')
+        counts = {}
+        for model_id, status, count in cursor.fetchall():
+            counts.setdefault(model_id, {'queued': 0, 'running': 0})[status] = count
+        return counts
+    
+    def cache_stats(self):
+        return self.users.stats()
+    
+    def close(self):
+        self.flush_usage()
+        self.conn.close()
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database.
+    
+    Все обращения к SQLite выполняются в одном выделенном потоке, поэтому
+    commit/fsync больше не блокирует event loop, а соединение используется
+    строго последовательно. Методы те же, что у Database, но их нужно await-ить.
+    """
+    
+    def __init__(self, database):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+    
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(attr, *args, **kwargs))
+        
+        call.__name__ = name
+        # Кешируем обертку, чтобы не создавать ее на каждый вызов
+        setattr(self, name, call)
+        return call
+    
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown(wait=True)
 
-db = Database()
+db = AsyncDatabase(Database())
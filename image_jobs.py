@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from config import Config
+from database import db
+
+logger = logging.getLogger(__name__)
+
+class ModelWorkers:
+    __slots__ = ('tasks', 'wake')
+    
+    def __init__(self):
+        self.tasks = []
+        self.wake = asyncio.Event()
+
+class ImageJobQueue:
+    """Очередь генерации изображений с отдельным пулом воркеров на каждую модель.
+    
+    Задачи хранятся в таблице image_jobs: хендлер только ставит задачу и сразу
+    освобождается, результат отправляет воркер. Число одновременных генераций
+    модели ограничено числом ее воркеров, длина очереди - max_queued, поэтому
+    поток генераций не занимает хендлеры чата и пул соединений с RouterAI.
+    Задачи, прерванные остановкой бота, после перезапуска выполняются заново.
+    Квота генерации резервируется при постановке задачи (admit_request) и
+    возвращается, если задача не удалась.
+    """
+    
+    def __init__(self, default_workers, model_workers, max_queued, max_per_user, max_attempts, notify_positions, retention_days):
+        self.default_workers = default_workers
+        self.model_workers = model_workers
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.max_attempts = max_attempts
+        self.notify_positions = notify_positions
+        self.retention_days = retention_days
+        self.models = {}
+        self.process = None
+        self.notify = None
+        self.fail = None
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.requeued = 0
+    
+    async def start(self, process, notify=None, fail=None):
+        """process(job) выполняет задачу и возвращает {"success", "error"};
+        notify(job, position) сообщает пользователю новое место в очереди;
+        fail(job) сообщает о задаче, снятой после max_attempts перезапусков.
+        """
+        self.process = process
+        self.notify = notify
+        self.fail = fail
+        requeued, failed, models = await db.recover_image_jobs(self.max_attempts, self.retention_days)
+        self.requeued += requeued
+        if requeued:
+            logger.info(f"Image jobs requeued after restart: {requeued}")
+        for job in failed:
+            logger.warning(f"Image job {job['job_id']} failed after {job['attempts']} attempts")
+            await self.release(job)
+            if self.fail is not None:
+                try:
+                    await self.fail(job)
+                except Exception as e:
+                    logger.error(f"Image job {job['job_id']} failure notification error: {e}")
+        for model_id in models:
+            self.workers_for(model_id).wake.set()
+    
+    def workers_for(self, model_id):
+        workers = self.models.get(model_id)
+        if workers is None:
+            workers = self.models[model_id] = ModelWorkers()
+            count = self.model_workers.get(model_id, self.default_workers)
+            workers.tasks = [
+                asyncio.create_task(self.worker(model_id, workers))
+                for _ in range(count)
+            ]
+        return workers
+    
+    async def submit(self, user_id, chat_id, message_id, model_id, prompt):
+        """Ставит задачу; message_id - статусное сообщение, которое обновляет воркер.
+        
+        Возвращает {'job_id', 'position'} или {'error': 'queue_full'|'user_limit'}.
+        """
+        result = await db.create_image_job(
+            user_id, chat_id, message_id, model_id, prompt, self.max_queued, self.max_per_user
+        )
+        if 'error' in result:
+            self.rejected += 1
+            return result
+        
+        self.submitted += 1
+        self.workers_for(model_id).wake.set()
+        return result
+    
+    async def worker(self, model_id, workers):
+        while True:
+            # Сбрасываем флаг до выборки: задача, поставленная во время выборки, снова разбудит воркер
+            workers.wake.clear()
+            try:
+                job = await db.claim_image_job(model_id)
+            except Exception as e:
+                logger.error(f"Image job claim error: {e}")
+                job = None
+            if job is None:
+                await workers.wake.wait()
+                continue
+            
+            # Остальные воркеры тоже могут найти задачу
+            workers.wake.set()
+            await self.report_positions(model_id)
+            
+            # При остановке бота CancelledError не ловим: задача остается running
+            # и выполнится после перезапуска
+            try:
+                result = await self.process(job)
+            except Exception as e:
+                logger.error(f"Image job {job['job_id']} error: {e}")
+                result = {"success": False, "error": str(e)}
+            
+            try:
+                if result['success']:
+                    self.completed += 1
+                    await db.finish_image_job(job['job_id'], 'done')
+                else:
+                    await db.finish_image_job(job['job_id'], 'failed', result.get('error'))
+                    await self.release(job)
+            except Exception as e:
+                logger.error(f"Image job {job['job_id']} status update error: {e}")
+    
+    async def release(self, job):
+        """Задача не удалась - возвращаем зарезервированную квоту генерации"""
+        self.failed += 1
+        await db.release_media_usage(job['user_id'], 'image_generate', job['reserved_on'])
+    
+    async def report_positions(self, model_id):
+        """Обновляет место в очереди у первых notify_positions ожидающих"""
+        if self.notify is None or not self.notify_positions:
+            return
+        try:
+            queued = await db.queued_image_jobs(model_id, self.notify_positions)
+            for position, job in enumerate(queued, start=1):
+                await self.notify(job, position)
+        except Exception as e:
+            logger.debug(f"Image job position update skipped: {e}")
+    
+    async def stats(self):
+        counts = await db.image_job_counts()
+        return {
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed,
+            'requeued': self.requeued,
+            'models': {
+                model_id: dict(
+                    counts.get(model_id, {'queued': 0, 'running': 0}),
+                    workers=len(workers.tasks)
+                )
+                for model_id, workers in self.models.items()
+            }
+        }
+    
+    async def close(self):
+        tasks = [task for workers in self.models.values() for task in workers.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.models.clear()
+
+image_job_queue = ImageJobQueue(
+    default_workers=Config.IMAGE_JOB_WORKERS,
+    model_workers=Config.IMAGE_JOB_MODEL_WORKERS,
+    max_queued=Config.IMAGE_JOB_MAX_QUEUED,
+    max_per_user=Config.IMAGE_JOB_MAX_PER_USER,
+    max_attempts=Config.IMAGE_JOB_MAX_ATTEMPTS,
+    notify_positions=Config.IMAGE_JOB_NOTIFY_POSITIONS,
+    retention_days=Config.IMAGE_JOB_RETENTION_DAYS
+)
@@ -0,0 +1,122 @@
+import asyncio
+import functools
+from config import Config
+
+POLICY_QUEUE = "queue"
+POLICY_REJECT = "reject"
+POLICY_CANCEL_PREVIOUS = "cancel_previous"
+
+class UserBusy(Exception):
+    """У пользователя уже есть запрос в работе, а политика не позволяет ждать"""
+
+class UserSlot:
+    __slots__ = ('semaphore', 'tasks', 'waiting', 'latest')
+    
+    def __init__(self, max_inflight):
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.tasks = set()
+        self.waiting = 0
+        self.latest = 0
+
+class UserLimiter:
+    """Ограничение одновременных AI-запросов одного пользователя.
+    
+    Политики:
+    - queue: запросы сверх лимита ждут своей очереди (не больше max_queued);
+    - reject: запросы сверх лимита сразу отклоняются;
+    - cancel_previous: новый запрос отменяет предыдущие (asyncio.Task.cancel
+      прерывает и HTTP-запрос к RouterAI).
+    """
+    
+    def __init__(self, policy, max_inflight, max_queued):
+        if policy not in (POLICY_QUEUE, POLICY_REJECT, POLICY_CANCEL_PREVIOUS):
+            raise ValueError(f"Unknown concurrency policy: {policy}")
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.slots = {}
+        self.rejected = 0
+        self.cancelled = 0
+    
+    async def run(self, user_id, coro):
+        """Выполняет coro как отдельную задачу в слоте пользователя"""
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = self.slots[user_id] = UserSlot(self.max_inflight)
+        
+        busy = len(slot.tasks) >= self.max_inflight
+        if busy and (self.policy == POLICY_REJECT or (self.policy == POLICY_QUEUE and slot.waiting >= self.max_queued)):
+            coro.close()
+            self.rejected += 1
+            self.release_slot(user_id, slot)
+            raise UserBusy()
+        
+        slot.latest += 1
+        generation = slot.latest
+        if self.policy == POLICY_CANCEL_PREVIOUS:
+            for task in list(slot.tasks):
+                if not task.cancelling():
+                    task.cancel()
+                    self.cancelled += 1
+        
+        slot.waiting += 1
+        try:
+            await slot.semaphore.acquire()
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+        finally:
+            slot.waiting -= 1
+        
+        # Пока ждали слот, пришел более новый запрос - этот уже не нужен
+        if self.policy == POLICY_CANCEL_PREVIOUS and generation != slot.latest:
+            coro.close()
+            self.cancelled += 1
+            slot.semaphore.release()
+            self.release_slot(user_id, slot)
+            return None
+        
+        task = asyncio.create_task(coro)
+        slot.tasks.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # Отменили нас самих - отменяем и задачу; иначе ее вытеснил более новый запрос
+            if asyncio.current_task().cancelling():
+                task.cancel()
+                raise
+            return None
+        finally:
+            slot.tasks.discard(task)
+            slot.semaphore.release()
+            self.release_slot(user_id, slot)
+    
+    def release_slot(self, user_id, slot):
+        if not slot.tasks and not slot.waiting and self.slots.get(user_id) is slot:
+            del self.slots[user_id]
+    
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'active_users': len(self.slots),
+            'inflight': sum(len(slot.tasks) for slot in self.slots.values()),
+            'queued': sum(slot.waiting for slot in self.slots.values()),
+            'rejected': self.rejected,
+            'cancelled': self.cancelled
+        }
+
+user_limiter = UserLimiter(
+    policy=Config.USER_CONCURRENCY_POLICY,
+    max_inflight=Config.USER_MAX_INFLIGHT,
+    max_queued=Config.USER_MAX_QUEUED
+)
+
+def limit_per_user(handler):
+    """Декоратор хендлера: весь хендлер выполняется в слоте пользователя"""
+    @functools.wraps(handler)
+    async def wrapper(message, *args, **kwargs):
+        try:
+            return await user_limiter.run(message.from_user.id, handler(message, *args, **kwargs))
+        except UserBusy:
+            await message.answer("⏳ <b>Дождитесь ответа на предыдущий запрос</b>")
+    return wrapper
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import functools
 import uuid
 import json
 import base64
@@ -9,6 +10,7 @@ from datetime import datetime, timedelta
 from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import (
     InlineKeyboardMarkup, 
     InlineKeyboardButton, 
@@ -21,8 +23,25 @@ from aiogram.client.session.aiohttp import AiohttpSession
 
 from config import Config
 from database import db
+from catalog import catalog, catalog_cached, CAP_IMAGES, CAP_VIDEO
+from conversations import conversation_store
+from limiter import limit_per_user, user_limiter
+from scheduler import upstream_scheduler, UpstreamOverloaded, OVERLOADED_ERROR
+from breaker import model_breakers
+from callbacks import callback_router, pack, pack_model
+from tokens import estimate_message_tokens, get_history_budget, token_calibration
 from services.yookassa import yookassa_service
 from services.routerai import routerai_service
+from services.retry import retry_stats
+from services.hedging import hedge_policy
+from services.response_cache import response_cache, normalize_text
+from services.semantic_cache import semantic_cache
+from services.images import image_pipeline
+from services.media import spooled_file, download_to_file
+from services.video import video_pipeline
+from services.documents import document_pipeline
+from services.media_cache import media_cache
+from image_jobs import image_job_queue
 
 # Увеличиваем таймауты для работы на Heroku/Koyeb
 os.environ['AIOHTTP_TIMEOUT'] = '60'
@@ -42,9 +61,6 @@ bot = Bot(
 
 dp = Dispatcher()
 
-active_generations = {}
-user_conversations = {}
-
 # ========== ПОЛНЫЕ ЮРИДИЧЕСКИЕ ДОКУМЕНТЫ С ЛИМИТАМИ ==========
 LEGAL_DOCUMENTS = {
     'privacy': """
@@ -154,6 +170,9 @@ LEGAL_DOCUMENTS = {
 }
 
 # ========== МЕНЮ-ПАНЕЛЬ ==========
+# Клавиатуры и тексты зависят только от языка, подписки и каталога -
+# строим их один раз на ключ и переиспользуем (см. catalog_cached)
+@catalog_cached()
 def get_main_reply_keyboard(lang='ru'):
     if lang == 'ru':
         return ReplyKeyboardMarkup(
@@ -176,104 +195,100 @@ def get_main_reply_keyboard(lang='ru'):
             resize_keyboard=True
         )
 
+@catalog_cached()
 def get_models_keyboard(user_subscription, lang='ru'):
     keyboard = []
-    available_categories = Config.SUBSCRIPTION_ACCESS.get(user_subscription, ['free'])
-    
-    for category in available_categories:
-        if category in Config.AI_MODELS:
-            for model in Config.AI_MODELS[category]:
-                name = model['name'] if lang == 'ru' else model['name_en']
-                keyboard.append([
-                    InlineKeyboardButton(text=f"ℹ️ {name}", callback_data=f"info_{model['id']}"),
-                    InlineKeyboardButton(text="✅ Выбрать", callback_data=f"model_{model['id']}")
-                ])
-    
-    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
+    for model in catalog.models_for(user_subscription):
+        name = model['name'] if lang == 'ru' else model['name_en']
+        keyboard.append([
+            InlineKeyboardButton(text=f"ℹ️ {name}", callback_data=pack_model("mi", model['id'])),
+            InlineKeyboardButton(text="✅ Выбрать", callback_data=pack_model("m", model['id']))
+        ])
+    
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data=pack("b"))])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+@catalog_cached()
 def get_subscription_keyboard(lang='ru'):
     keyboard = []
     for plan in Config.SUBSCRIPTION_PLANS[1:]:
         name = plan['name'] if lang == 'ru' else plan['name_en']
         keyboard.append([
-            InlineKeyboardButton(text=f"ℹ️ {name}", callback_data=f"plan_info_{plan['id']}"),
-            InlineKeyboardButton(text="💳 Купить", callback_data=f"sub_{plan['id']}")
+            InlineKeyboardButton(text=f"ℹ️ {name}", callback_data=pack("pi", plan['id'])),
+            InlineKeyboardButton(text="💳 Купить", callback_data=pack("p", plan['id']))
         ])
     
-    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data=pack("b"))])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+@catalog_cached()
 def get_api_key_keyboard(lang='ru'):
     keyboard = []
     for model_id, price in Config.API_KEY_PRICES.items():
-        model = None
-        for category_models in Config.AI_MODELS.values():
-            for m in category_models:
-                if m['id'] == model_id:
-                    model = m
-                    break
-            if model: break
-        
+        model = catalog.get_model(model_id)
         if model:
             name = model['name'] if lang == 'ru' else model['name_en']
             keyboard.append([
-                InlineKeyboardButton(text=f"ℹ️ {name} - {price}₽", callback_data=f"api_info_{model_id}"),
-                InlineKeyboardButton(text="🔑 Купить", callback_data=f"api_{model_id}")
+                InlineKeyboardButton(text=f"ℹ️ {name} - {price}₽", callback_data=pack_model("ai", model_id)),
+                InlineKeyboardButton(text="🔑 Купить", callback_data=pack_model("a", model_id))
             ])
     
-    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data=pack("b"))])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+@catalog_cached()
 def get_referral_keyboard(lang='ru'):
     if lang == 'ru':
         return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📤 Поделиться ссылкой", callback_data="share_ref")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
+            [InlineKeyboardButton(text="📤 Поделиться ссылкой", callback_data=pack("s"))],
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("b"))]
         ])
     else:
         return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📤 Share link", callback_data="share_ref")],
-            [InlineKeyboardButton(text="🔙 Back", callback_data="back_to_menu")]
+            [InlineKeyboardButton(text="📤 Share link", callback_data=pack("s"))],
+            [InlineKeyboardButton(text="🔙 Back", callback_data=pack("b"))]
         ])
 
+@catalog_cached()
 def get_profile_keyboard(lang='ru'):
     if lang == 'ru':
         return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📄 Юридические документы", callback_data="legal_docs")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
+            [InlineKeyboardButton(text="📄 Юридические документы", callback_data=pack("l"))],
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("b"))]
         ])
     else:
         return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📄 Legal Documents", callback_data="legal_docs")],
-            [InlineKeyboardButton(text="🔙 Back", callback_data="back_to_menu")]
+            [InlineKeyboardButton(text="📄 Legal Documents", callback_data=pack("l"))],
+            [InlineKeyboardButton(text="🔙 Back", callback_data=pack("b"))]
         ])
 
+@catalog_cached()
 def get_legal_docs_keyboard(lang='ru'):
     if lang == 'ru':
         return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔒 Политика конфиденциальности", callback_data="doc_privacy")],
-            [InlineKeyboardButton(text="📋 Пользовательское соглашение", callback_data="doc_agreement")],
-            [InlineKeyboardButton(text="💳 Условия оплаты", callback_data="doc_payment")],
-            [InlineKeyboardButton(text="📄 Договор подписки", callback_data="doc_subscription")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
+            [InlineKeyboardButton(text="🔒 Политика конфиденциальности", callback_data=pack("d", "privacy"))],
+            [InlineKeyboardButton(text="📋 Пользовательское соглашение", callback_data=pack("d", "agreement"))],
+            [InlineKeyboardButton(text="💳 Условия оплаты", callback_data=pack("d", "payment"))],
+            [InlineKeyboardButton(text="📄 Договор подписки", callback_data=pack("d", "subscription"))],
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("b"))]
         ])
     else:
         return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔒 Privacy Policy", callback_data="doc_privacy")],
-            [InlineKeyboardButton(text="📋 User Agreement", callback_data="doc_agreement")],
-            [InlineKeyboardButton(text="💳 Payment Terms", callback_data="doc_payment")],
-            [InlineKeyboardButton(text="📄 Subscription Terms", callback_data="doc_subscription")],
-            [InlineKeyboardButton(text="🔙 Back", callback_data="back_to_menu")]
+            [InlineKeyboardButton(text="🔒 Privacy Policy", callback_data=pack("d", "privacy"))],
+            [InlineKeyboardButton(text="📋 User Agreement", callback_data=pack("d", "agreement"))],
+            [InlineKeyboardButton(text="💳 Payment Terms", callback_data=pack("d", "payment"))],
+            [InlineKeyboardButton(text="📄 Subscription Terms", callback_data=pack("d", "subscription"))],
+            [InlineKeyboardButton(text="🔙 Back", callback_data=pack("b"))]
         ])
 
 def get_payment_check_keyboard(payment_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=f"paid_{payment_id}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data="back_to_menu")]
+        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=pack("pd", payment_id))],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack("b"))]
     ])
 
 # ========== ТЕКСТЫ БЕЗ ЛИМИТОВ ==========
+@catalog_cached(key=lambda model, lang='ru': (model['id'], lang))
 def get_model_info_text(model, lang='ru'):
     if lang == 'ru':
         return f"""🤖 <b>{model['name']}</b>
@@ -300,6 +315,7 @@ def get_model_info_text(model, lang='ru'):
 {"✅ Video" if model['supports_video'] else "❌ Video"} 
 {"✅ Audio" if model['supports_audio'] else "❌ Audio"}"""
 
+@catalog_cached(key=lambda plan, lang='ru': (plan['id'], lang))
 def get_plan_info_text(plan, lang='ru'):
     if lang == 'ru':
         return f"""💎 <b>{plan['name']}</b>
@@ -322,13 +338,13 @@ async def check_payment_status(payment_id, yookassa_id, user_id):
     try:
         result = await yookassa_service.get_payment_status(yookassa_id)
         if result['success'] and result['status'] == 'succeeded':
-            db.update_payment_status(payment_id, 'succeeded', yookassa_id)
-            payment = db.get_payment(payment_id)
-            user = db.get_user(user_id)
+            await db.update_payment_status(payment_id, 'succeeded', yookassa_id)
+            payment = await db.get_payment(payment_id)
+            user = await db.get_user(user_id)
             lang = user['language'] if user else 'ru'
             
             if payment['type'] == 'subscription':
-                db.update_user_subscription(user_id, payment['plan_id'])
+                await db.update_user_subscription(user_id, payment['plan_id'])
                 success_text = {
                     'ru': "✅ <b>Платеж подтвержден! Подписка активирована на 30 дней.</b>",
                     'en': "✅ <b>Payment confirmed! Subscription activated for 30 days.</b>"
@@ -346,10 +362,63 @@ async def check_payment_status(payment_id, yookassa_id, user_id):
         logger.error(f"Payment check error: {e}")
         return False
 
+# ========== ЗАПРОСЫ К МОДЕЛЯМ ==========
+async def ask_model(model_id, subscription, request, capability=0, fallback=True):
+    """request(model_id) -> результат RouterAIService. Модель выбирается circuit breaker'ом
+    (с переключением на запасную), запрос выполняется в слоте планировщика."""
+    return await model_breakers.run(
+        model_id, subscription,
+        lambda candidate: upstream_scheduler.run(candidate, subscription, request, candidate),
+        capability=capability, fallback=fallback
+    )
+
+# ========== ПОТОКОВЫЕ ОТВЕТЫ ==========
+async def safe_edit(msg, text):
+    """Редактирует сообщение, игнорируя 'message is not modified' и флуд-контроль"""
+    try:
+        await msg.edit_text(text)
+    except (TelegramBadRequest, TelegramRetryAfter) as e:
+        logger.debug(f"Edit skipped: {e}")
+
+async def stream_response(msg, model_id, text, conversation_history=None, subscription='free', prefix="🤖 <b>Ответ:</b>\n\n"):
+    """Стримит ответ модели в msg, редактируя его не чаще STREAM_EDIT_INTERVAL секунд.
+    
+    result['latency'] - время до первого токена: длинный, но живой ответ не считается медленным.
+    """
+    loop = asyncio.get_running_loop()
+    last_edit = 0.0
+    chunks = []
+    result = {"success": False, "error": "Invalid response format from AI"}
+    first_token = None
+    
+    try:
+        # Слот модели занят на все время стрима
+        async with upstream_scheduler.slot(model_id, subscription):
+            started = loop.time()
+            async for event in routerai_service.stream_message(model_id, text, conversation_history):
+                if first_token is None:
+                    first_token = loop.time() - started
+                if "delta" not in event:
+                    result = event
+                    continue
+                
+                chunks.append(event["delta"])
+                now = loop.time()
+                if now - last_edit >= Config.STREAM_EDIT_INTERVAL:
+                    last_edit = now
+                    partial = routerai_service.clean_response("".join(chunks))
+                    if partial:
+                        await safe_edit(msg, f"{prefix}{partial} ▌")
+    except UpstreamOverloaded:
+        return {"success": False, "error": OVERLOADED_ERROR}
+    
+    result['latency'] = first_token if first_token is not None else loop.time() - started
+    return result
+
 # ========== ЮРИДИЧЕСКИЕ ДОКУМЕНТЫ ОБРАБОТЧИКИ ==========
-@dp.callback_query(F.data == "legal_docs")
-async def show_legal_docs(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+@callback_router.action("l", legacy="legal_docs")
+async def show_legal_docs(callback: types.CallbackQuery, arg=None):
+    user = await db.get_user(callback.from_user.id)
     lang = user['language'] if user else 'ru'
     
     text = {
@@ -359,10 +428,8 @@ async def show_legal_docs(callback: types.CallbackQuery):
     await callback.message.answer(text[lang], reply_markup=get_legal_docs_keyboard(lang))
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("doc_"))
-async def show_legal_doc(callback: types.CallbackQuery):
-    doc_type = callback.data.replace("doc_", "")
-    
+@callback_router.action("d", legacy="doc_")
+async def show_legal_doc(callback: types.CallbackQuery, doc_type):
     if doc_type in LEGAL_DOCUMENTS:
         await callback.message.answer(LEGAL_DOCUMENTS[doc_type])
     else:
@@ -373,9 +440,9 @@ async def show_legal_doc(callback: types.CallbackQuery):
 @dp.message(F.text == "🎨 Сгенерировать фото")
 @dp.message(F.text == "🎨 Generate image")
 async def handle_generate_image_menu(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
+        user = await db.create_user(message.from_user.id, message.from_user.username)
         
     lang = user['language']
     text = {
@@ -385,169 +452,285 @@ async def handle_generate_image_menu(message: types.Message):
     await message.answer(text[lang])
 
 @dp.message(F.text.startswith("/generate"))
+@limit_per_user
 async def handle_generate_command(message: types.Message):
-    # Автоматически создаем пользователя если не существует
-    user = db.get_user(message.from_user.id)
-    if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
-        
     prompt = message.text.replace("/generate", "").strip()
     if not prompt:
         await message.answer("❌ Укажите описание для генерации изображения")
         return
     
-    # Проверяем лимиты генерации изображений
-    can_generate, error_msg = db.can_generate_image(user['user_id'])
-    if not can_generate:
-        await message.answer(f"❌ {error_msg}")
+    # Резервируем генерацию сразу: задачи одного пользователя выполняются параллельно
+    # и не должны вместе превысить дневной лимит. Неудачная задача вернет квоту
+    admission = await db.admit_request(
+        message.from_user.id, message.from_user.username,
+        media_type='image_generate', count_message=False
+    )
+    if not admission['allowed']:
+        await message.answer(f"❌ {admission['error']}")
         return
+    user = admission['user']
     
-    lang = user['language']
-    msg = await message.answer("🎨 <b>Генерация изображения...</b>")
-    active_generations[message.from_user.id] = True
+    # Такое изображение уже генерировали - отправляем сразу, без очереди и запроса к модели
+    image_key = media_cache.key("generated", Config.IMAGE_GENERATION_MODEL, normalize_text(prompt))
+    if await send_cached_image(message.chat.id, image_key, generated_caption(prompt)):
+        return
+    
+    # Генерация идет в фоне: хендлер только ставит задачу, результат отправит воркер очереди
+    msg = await message.answer("🎨 <b>Ставим задачу в очередь...</b>")
+    job = await image_job_queue.submit(
+        user['user_id'], message.chat.id, msg.message_id,
+        Config.IMAGE_GENERATION_MODEL, prompt
+    )
+    if 'error' in job:
+        await db.release_media_usage(user['user_id'], 'image_generate')
+    
+    if job.get('error') == 'user_limit':
+        await safe_edit(msg, "⏳ <b>Дождитесь завершения предыдущих генераций</b>")
+    elif job.get('error') == 'queue_full':
+        await safe_edit(msg, "⏳ <b>Очередь генерации переполнена.</b> Попробуйте через несколько минут.")
+    else:
+        await safe_edit(msg, image_job_position_text(job['position']))
+
+def generated_caption(prompt):
+    return f"🎨 <b>Сгенерированное изображение</b>\n\nЗапрос: {prompt}"
+
+def image_job_position_text(position):
+    return f"🎨 <b>Генерация изображения в очереди</b>\n\nМесто в очереди: {position}"
+
+async def report_image_job_position(job, position):
+    """Обновляет место в очереди в статусном сообщении задачи"""
+    if job['message_id']:
+        try:
+            await bot.edit_message_text(image_job_position_text(position), chat_id=job['chat_id'], message_id=job['message_id'])
+        except (TelegramBadRequest, TelegramRetryAfter) as e:
+            logger.debug(f"Edit skipped: {e}")
+
+async def report_image_job_failure(job):
+    """Задача снята после нескольких прерванных перезапусками попыток"""
+    text = "❌ <b>Не удалось сгенерировать изображение.</b> Попробуйте еще раз."
+    if job['message_id']:
+        try:
+            await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'])
+            return
+        except (TelegramBadRequest, TelegramRetryAfter) as e:
+            logger.debug(f"Edit skipped: {e}")
+    await bot.send_message(job['chat_id'], text)
+
+async def run_image_job(job):
+    """Выполняет задачу из очереди генерации и отправляет результат в чат"""
+    chat_id = job['chat_id']
+    
+    async def status(text):
+        if job['message_id']:
+            try:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=job['message_id'])
+                return
+            except (TelegramBadRequest, TelegramRetryAfter) as e:
+                logger.debug(f"Edit skipped: {e}")
+        if not text.startswith("🎨"):
+            await bot.send_message(chat_id, text)
+    
+    async def done():
+        if job['message_id']:
+            try:
+                await bot.delete_message(chat_id, job['message_id'])
+            except TelegramBadRequest as e:
+                logger.debug(f"Delete skipped: {e}")
     
     try:
-        # Используем специальную модель для генерации изображений
-        result = await routerai_service.generate_image(prompt, model_id=Config.IMAGE_GENERATION_MODEL)
+        user = await db.get_user(job['user_id'])
+        if not user:
+            return {"success": False, "error": "User not found"}
         
-        if result['success'] and active_generations.get(message.from_user.id):
-            db.update_media_usage(user['user_id'], 'image_generate')
-            
+        prompt = job['prompt']
+        caption = generated_caption(prompt)
+        image_key = media_cache.key("generated", job['model_id'], normalize_text(prompt))
+        if await send_cached_image(chat_id, image_key, caption):
+            await done()
+            return {"success": True}
+        
+        await status("🎨 <b>Генерация изображения...</b>")
+        result = await ask_model(
+            job['model_id'], user['subscription'],
+            functools.partial(routerai_service.generate_image, prompt),
+            fallback=False
+        )
+        
+        if result['success']:
             if result.get('image_data'):
                 try:
                     image_data = base64.b64decode(result['image_data'])
-                    await message.answer_photo(
-                        types.BufferedInputFile(image_data, filename="generated_image.jpg"),
-                        caption=f"🎨 <b>Сгенерированное изображение</b>\n\nЗапрос: {prompt}"
-                    )
-                    await msg.delete()
                 except Exception as e:
                     logger.error(f"Image decode error: {e}")
-                    await msg.edit_text("❌ Ошибка декодирования изображения")
+                    await status("❌ Ошибка декодирования изображения")
+                    return {"success": False, "error": "Image decode error"}
+                await media_cache.put(image_key, image_data, "image/jpeg")
+                sent = await bot.send_photo(
+                    chat_id,
+                    types.BufferedInputFile(image_data, filename="generated_image.jpg"),
+                    caption=caption
+                )
+                await media_cache.set_file_id(image_key, sent.photo[-1].file_id)
+                await done()
             else:
-                await msg.edit_text(f"🤖 <b>Модель ответила:</b>\n\n{result['response']}")
-        elif not result['success']:
-            error_msg = result.get('error', 'Неизвестная ошибка')
-            if "timeout" in error_msg.lower():
-                error_msg = "⏳ Время генерации истекло. Попробуйте позже."
-            elif "connection" in error_msg.lower():
-                error_msg = "🔌 Ошибка соединения. Проверьте интернет."
-            else:
-                error_msg = f"❌ Ошибка: {error_msg}"
-            await msg.edit_text(error_msg)
-            
+                await status(f"🤖 <b>Модель ответила:</b>\n\n{result['response']}")
+            return {"success": True}
+        
+        error_msg = result.get('error', 'Неизвестная ошибка')
+        if "timeout" in error_msg.lower():
+            await status("⏳ Время генерации истекло. Попробуйте позже.")
+        elif "connection" in error_msg.lower():
+            await status("🔌 Ошибка соединения. Проверьте интернет.")
+        else:
+            await status(f"❌ Ошибка: {error_msg}")
+        return {"success": False, "error": error_msg}
     except Exception as e:
         logger.error(f"Image generation error: {e}")
-        await msg.edit_text("❌ <b>Ошибка при генерации изображения</b>")
-    finally:
-        active_generations.pop(message.from_user.id, None)
+        await status("❌ <b>Ошибка при генерации изображения</b>")
+        return {"success": False, "error": str(e)}
+
+async def send_cached_image(chat_id, image_key, caption):
+    """Отправляет изображение из кеша: по file_id Telegram или из файла. False - в кеше нет"""
+    file_id = media_cache.get_file_id(image_key)
+    if file_id:
+        try:
+            await bot.send_photo(chat_id, file_id, caption=caption)
+            media_cache.record_file_id_hit()
+            return True
+        except TelegramBadRequest as e:
+            logger.warning(f"Cached file_id rejected, re-uploading: {e}")
+    
+    # Файл отдается с диска по частям, без копии в памяти
+    path = await media_cache.locate(image_key)
+    if path is None:
+        return False
+    try:
+        sent = await bot.send_photo(
+            chat_id,
+            types.FSInputFile(path, filename="generated_image.jpg"),
+            caption=caption
+        )
+    except FileNotFoundError:
+        # Файл вытеснен из кеша во время отправки
+        return False
+    await media_cache.set_file_id(image_key, sent.photo[-1].file_id)
+    return True
 
 # ========== ОБРАБОТКА МЕДИАФАЙЛОВ ==========
 @dp.message(F.photo)
+@limit_per_user
 async def handle_photo(message: types.Message):
-    user = db.get_user(message.from_user.id)
-    if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
-        
-    # Проверяем лимиты отправки изображений
-    can_send, error_msg = db.can_send_image(user['user_id'])
-    if not can_send: 
-        await message.answer(f"❌ {error_msg}")
-        return
-        
-    # Проверяем общие лимиты
-    can_use, error_msg = db.can_use_model(user['user_id'])
-    if not can_use: 
-        await message.answer(f"❌ {error_msg}")
+    # Проверяем лимиты сообщений, изображений и токенов одной транзакцией
+    admission = await db.admit_request(
+        message.from_user.id, message.from_user.username,
+        media_type='image_send', input_tokens=500, output_tokens=1500
+    )
+    if not admission['allowed']:
+        await message.answer(f"❌ {admission['error']}")
         return
-        
-    db.increment_daily_usage(user['user_id'])
-    db.update_media_usage(user['user_id'], 'image_send')
+    user = admission['user']
     
     # Проверяем поддерживает ли текущая модель изображения
-    current_model_supports_images = False
-    for category_models in Config.AI_MODELS.values():
-        for model in category_models:
-            if model['id'] == user['current_model']:
-                current_model_supports_images = model['supports_images']
-                break
-    
-    if not current_model_supports_images:
+    if not catalog.supports(user['current_model'], CAP_IMAGES):
         await message.answer("❌ Текущая модель не поддерживает изображения")
         return
     
-    # Скачиваем изображение
-    try:
-        file = await bot.get_file(message.photo[-1].file_id)
-        file_bytes = await bot.download_file(file.file_path)
-        image_data = base64.b64encode(file_bytes.read()).decode('utf-8')
-    except Exception as e:
-        await message.answer("❌ Ошибка при загрузке изображения")
-        return
-    
-    msg = await message.answer("⏳ <b>Обработка изображения...</b>")
-    active_generations[message.from_user.id] = True
+    # Фото, которое уже присылали, берем из дискового кеша (mmap) без скачивания
+    photo_key = media_cache.key("file", message.photo[-1].file_unique_id)
+    cached = await media_cache.open(photo_key)
+    source = cached if cached is not None else spooled_file()
     
-    try:
-        # Проверяем месячные лимиты токенов
-        can_use, error_msg = db.check_monthly_token_limits(message.from_user.id, 500, 1500)
-        if not can_use:
-            await msg.edit_text(f"❌ {error_msg}")
+    # Файлы живут до конца запроса: тело к RouterAI кодируется из них по частям
+    with source, spooled_file() as prepared, spooled_file() as rerouted:
+        # Скачиваем изображение по частям во временный файл
+        try:
+            if cached is None:
+                file = await bot.get_file(message.photo[-1].file_id)
+                await download_to_file(bot, file.file_path, source)
+                await media_cache.put(photo_key, source, "image/jpeg")
+            # Уменьшаем под модель и пережимаем без метаданных
+            images = {
+                image_pipeline.get_max_dimension(user['current_model']):
+                    await image_pipeline.prepare(source, prepared, user['current_model'])
+            }
+        except Exception as e:
+            await message.answer("❌ Ошибка при загрузке изображения")
             return
         
-        result = await routerai_service.send_message(
-            user['current_model'], 
-            message.caption or "Опиши это изображение",
-            extra_data={"image": image_data}
-        )
+        msg = await message.answer("⏳ <b>Обработка изображения...</b>")
         
-        if result['success'] and active_generations.get(message.from_user.id):
-            response_text = f"🤖 <b>Ответ:</b>\n\n{result['response']}"
-            await msg.edit_text(response_text)
-            
-            # Обновляем счетчики токенов
-            db.update_token_usage(message.from_user.id, 500, 1500)
-        elif not result['success']:
-            error_msg = result.get('error', 'Неизвестная ошибка')
-            await msg.edit_text(f"❌ Ошибка: {error_msg}")
+        async def request(model_id):
+            # Breaker мог переключить на запасную модель с другим пределом размера изображения
+            dimension = image_pipeline.get_max_dimension(model_id)
+            if dimension not in images:
+                images[dimension] = await image_pipeline.prepare(source, rerouted, model_id)
+            image_file, image_mime = images[dimension]
+            return await routerai_service.send_message(
+                model_id,
+                message=message.caption or "Опиши это изображение",
+                extra_data={"image_file": image_file, "image_mime": image_mime}
+            )
+        
+        try:
+            started = asyncio.get_running_loop().time()
+            result = await ask_model(user['current_model'], user['subscription'], request, capability=CAP_IMAGES)
+            image_pipeline.record_upload(asyncio.get_running_loop().time() - started)
             
-    except Exception as e:
-        logger.error(f"Photo processing error: {e}")
-        await msg.edit_text("❌ <b>Ошибка обработки изображения</b>")
-    finally:
-        active_generations.pop(message.from_user.id, None)
+            if result['success']:
+                response_text = f"🤖 <b>Ответ:</b>\n\n{result['response']}"
+                await msg.edit_text(response_text)
+                
+                # Обновляем счетчики токенов
+                await db.update_token_usage(message.from_user.id, 500, 1500)
+            elif not result['success']:
+                error_msg = result.get('error', 'Неизвестная ошибка')
+                await msg.edit_text(f"❌ Ошибка: {error_msg}")
+                
+        except Exception as e:
+            logger.error(f"Photo processing error: {e}")
+            await msg.edit_text("❌ <b>Ошибка обработки изображения</b>")
+        except asyncio.CancelledError:
+            # Запрос вытеснен новым сообщением пользователя (политика cancel_previous)
+            await safe_edit(msg, "⛔ <b>Запрос отменен</b>")
+            raise
 
 @dp.message(F.video)
+@limit_per_user
 async def handle_video(message: types.Message):
-    user = db.get_user(message.from_user.id)
-    if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
-        
-    # Проверяем лимиты отправки видео
-    can_send, error_msg = db.can_send_video(user['user_id'])
-    if not can_send: 
-        await message.answer(f"❌ {error_msg}")
-        return
-        
-    # Проверяем общие лимиты
-    can_use, error_msg = db.can_use_model(user['user_id'])
-    if not can_use: 
-        await message.answer(f"❌ {error_msg}")
+    # Проверяем лимиты сообщений и видео одной транзакцией
+    admission = await db.admit_request(message.from_user.id, message.from_user.username, media_type='video_send')
+    if not admission['allowed']:
+        await message.answer(f"❌ {admission['error']}")
         return
-        
-    db.increment_daily_usage(user['user_id'])
-    db.update_media_usage(user['user_id'], 'video_send')
+    user = admission['user']
     
     msg = await message.answer("⏳ <b>Обработка видео...</b>")
-    active_generations[message.from_user.id] = True
     
     try:
-        result = await routerai_service.send_message(
-            user['current_model'], 
-            f"Пользователь отправил видео. Описание: {message.caption or 'нет описания'}. Проанализируй видео на основе запроса."
+        # Модели с поддержкой видео получают ключевые кадры, остальные - только описание
+        frames = []
+        if catalog.supports(user['current_model'], CAP_VIDEO):
+            frames = await video_pipeline.get_frames(bot, message.video)
+        
+        if frames:
+            prompt = (f"Пользователь отправил видео. Ниже {len(frames)} ключевых кадров из него по порядку. "
+                      f"Описание: {message.caption or 'нет описания'}. Проанализируй видео на основе запроса.")
+            extra_data = {"images": [base64.b64encode(frame).decode('utf-8') for frame in frames]}
+        else:
+            prompt = f"Пользователь отправил видео. Описание: {message.caption or 'нет описания'}. Проанализируй видео на основе запроса."
+            extra_data = None
+        
+        result = await ask_model(
+            user['current_model'], user['subscription'],
+            functools.partial(
+                routerai_service.send_message,
+                message=prompt,
+                extra_data=extra_data
+            ),
+            capability=CAP_VIDEO if frames else 0
         )
         
-        if result['success'] and active_generations.get(message.from_user.id):
+        if result['success']:
             response_text = f"🤖 <b>Анализ видео:</b>\n\n{result['response']}"
             await msg.edit_text(response_text)
         elif not result['success']:
@@ -557,32 +740,67 @@ async def handle_video(message: types.Message):
     except Exception as e:
         logger.error(f"Video processing error: {e}")
         await msg.edit_text("❌ <b>Ошибка обработки видео</b>")
-    finally:
-        active_generations.pop(message.from_user.id, None)
+    except asyncio.CancelledError:
+        # Запрос вытеснен новым сообщением пользователя (политика cancel_previous)
+        await safe_edit(msg, "⛔ <b>Запрос отменен</b>")
+        raise
 
 @dp.message(F.document)
+@limit_per_user
 async def handle_document(message: types.Message):
-    user = db.get_user(message.from_user.id)
-    if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
-        
-    can_use, error_msg = db.can_use_model(user['user_id'])
-    if not can_use: 
-        await message.answer(f"❌ {error_msg}")
+    await process_document(message, message.document, message.caption)
+
+async def process_document(message, document, question):
+    """Анализ документа: по его тексту, если формат поддерживается, иначе - по названию"""
+    supported = document_pipeline.supports(document)
+    if supported and (document.file_size or 0) > Config.DOCUMENT_MAX_SIZE:
+        await message.answer(f"❌ Файл слишком большой (максимум {Config.DOCUMENT_MAX_SIZE // 1024 // 1024} МБ)")
         return
-        
-    db.increment_daily_usage(user['user_id'])
+    
+    # До извлечения текста размер файла ничего не говорит о числе токенов (особенно у PDF):
+    # пускаем с небольшим резервом, а по тексту проверяем еще раз
+    admission = await db.admit_request(
+        message.from_user.id, message.from_user.username,
+        input_tokens=Config.DOCUMENT_ADMIT_TOKENS if supported else 0, output_tokens=1500 if supported else 0
+    )
+    if not admission['allowed']:
+        await message.answer(f"❌ {admission['error']}")
+        return
+    user = admission['user']
     
     msg = await message.answer("⏳ <b>Обработка документа...</b>")
-    active_generations[message.from_user.id] = True
     
-    try:
-        result = await routerai_service.send_message(
-            user['current_model'], 
-            f"Пользователь отправил документ. Название: {message.document.file_name}. Описание: {message.caption or 'нет описания'}."
+    def request(prompt):
+        return ask_model(
+            user['current_model'], user['subscription'],
+            functools.partial(routerai_service.send_message, message=prompt)
         )
+    
+    try:
+        prepared = await document_pipeline.get_document(bot, document) if supported else None
+        if prepared and prepared['chunks']:
+            budget_error = await db.token_budget_error(user['user_id'], prepared['tokens'], 1500)
+            if budget_error:
+                await msg.edit_text(f"❌ {budget_error}")
+                return
+            
+            result = await document_pipeline.analyze(
+                prepared, question or "Кратко перескажи документ", document.file_name, request
+            )
+        else:
+            result = await request(
+                f"Пользователь отправил документ. Название: {document.file_name}. Описание: {question or 'нет описания'}."
+            )
         
-        if result['success'] and active_generations.get(message.from_user.id):
+        # Токены частей, обработанных до ошибки, тоже потрачены
+        if result.get('usage'):
+            await db.update_token_usage(
+                user['user_id'],
+                result['usage'].get('prompt_tokens', 0),
+                result['usage'].get('completion_tokens', 0)
+            )
+        
+        if result['success']:
             response_text = f"🤖 <b>Анализ документа:</b>\n\n{result['response']}"
             await msg.edit_text(response_text)
         elif not result['success']:
@@ -592,8 +810,10 @@ async def handle_document(message: types.Message):
     except Exception as e:
         logger.error(f"Document processing error: {e}")
         await msg.edit_text("❌ <b>Ошибка обработки документа</b>")
-    finally:
-        active_generations.pop(message.from_user.id, None)
+    except asyncio.CancelledError:
+        # Запрос вытеснен новым сообщением пользователя (политика cancel_previous)
+        await safe_edit(msg, "⛔ <b>Запрос отменен</b>")
+        raise
 
 # ========== ОСНОВНЫЕ ОБРАБОТЧИКИ ==========
 @dp.message(Command("start"))
@@ -602,9 +822,9 @@ async def cmd_start(message: types.Message):
     if len(message.text.split()) > 1:
         referral_code = message.text.split()[1]
     
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username, 'ru', referral_code)
+        user = await db.create_user(message.from_user.id, message.from_user.username, 'ru', referral_code)
         
         welcome_text = f"""👋 <b>Добро пожаловать в GobiAI!</b>
 
@@ -617,12 +837,134 @@ async def cmd_start(message: types.Message):
     else:
         await message.answer("👋 <b>С возвращением!</b>", reply_markup=get_main_reply_keyboard(user['language']))
 
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    if message.from_user.id != Config.ADMIN_ID:
+        return
+    
+    cache = await db.cache_stats()
+    conversations = conversation_store.stats()
+    limiter = user_limiter.stats()
+    stats_text = f"""📊 <b>Статистика</b>
+
+<b>Кеш пользователей:</b>
+Записей: {cache['size']}
+Попаданий: {cache['hits']}
+Промахов: {cache['misses']}
+Hit rate: {cache['hit_rate']:.1%}
+
+<b>История диалогов:</b>
+Пользователей: {conversations['entries']}
+Сообщений: {conversations['messages']}
+Память: {conversations['bytes'] / 1024 / 1024:.1f} MB
+Вытеснено: {conversations['evicted']}
+
+<b>Запросы пользователей ({limiter['policy']}):</b>
+В работе: {limiter['inflight']}
+В очереди: {limiter['queued']}
+Отклонено: {limiter['rejected']}
+Отменено: {limiter['cancelled']}"""
+    
+    calibration = token_calibration.stats()
+    if calibration:
+        stats_text += "\n\n<b>Оценка токенов (факт/оценка):</b>"
+        for model_id, model_stats in calibration.items():
+            stats_text += f"\n{model_id}: {model_stats['ratio']:.2f} ({model_stats['requests']} запросов)"
+    
+    retries = retry_stats.stats()
+    if retries:
+        stats_text += "\n\n<b>Повторы RouterAI (попытки/восстановлено/отказ):</b>"
+        for model_id, model_stats in retries.items():
+            stats_text += f"\n{model_id}: {model_stats['attempts']}/{model_stats['recovered']}/{model_stats['giveups']} ({model_stats['requests']} запросов)"
+    
+    images = image_pipeline.stats()
+    if images['images']:
+        stats_text += f"""
+
+<b>Изображения:</b>
+Обработано: {images['images']} (ошибок {images['failed']})
+Сэкономлено: {images['saved'] / 1024 / 1024:.1f} MB из {images['bytes_in'] / 1024 / 1024:.1f} MB
+Обработка: {images['avg_process_ms']:.0f} мс, запрос к модели: {images['avg_upload']:.1f} с"""
+    
+    videos = video_pipeline.stats()
+    if videos['extracted'] or videos['thumbnails'] or videos['cache_hits']:
+        stats_text += f"""
+
+<b>Видео:</b>
+Извлечено кадров: {videos['extracted']} видео (превью: {videos['thumbnails']}, ошибок: {videos['failed']})
+Из кеша: {videos['cache_hits']}, в кеше {videos['cached']} ({videos['cache_bytes'] / 1024 / 1024:.1f} MB)"""
+    
+    documents = document_pipeline.stats()
+    if documents['extracted'] or documents['cache_hits']:
+        stats_text += f"""
+
+<b>Документы:</b>
+Извлечено: {documents['extracted']}, из кеша: {documents['cache_hits']} (в кеше {documents['cached']})
+Запросов по частям: {documents['map_requests']}"""
+    
+    jobs = await image_job_queue.stats()
+    if jobs['models']:
+        stats_text += f"""
+
+<b>Очередь генерации (очередь/в работе/воркеры):</b>
+Поставлено: {jobs['submitted']}, отклонено: {jobs['rejected']}
+Готово: {jobs['completed']}, ошибок: {jobs['failed']}, после перезапуска: {jobs['requeued']}"""
+        for model_id, model_jobs in jobs['models'].items():
+            stats_text += f"\n{model_id}: {model_jobs['queued']}/{model_jobs['running']}/{model_jobs['workers']}"
+    
+    media = media_cache.stats()
+    stats_text += f"""
+
+<b>Кеш медиа:</b>
+Файлов: {media['entries']} ({media['bytes'] / 1024 / 1024:.1f} MB), вытеснено {media['evicted']}
+Hit rate: {media['hit_rate']:.1%}, повторов по file_id: {media['file_id_hits']}"""
+    
+    responses = response_cache.stats()
+    stats_text += f"""
+
+<b>Кеш ответов:</b>
+Записей: {responses['entries']}
+Попаданий: {responses['hits']} (с диска {responses['disk_hits']})
+Промахов: {responses['misses']}
+Hit rate: {responses['hit_rate']:.1%}"""
+    
+    if semantic_cache.models:
+        semantic = semantic_cache.stats()
+        stats_text += f"""
+
+<b>Семантический кеш:</b>
+Записей: {semantic['entries']} ({semantic['bytes'] / 1024 / 1024:.1f} MB)
+Hit rate: {semantic['hit_rate']:.1%}
+Вытеснено: {semantic['evicted']}"""
+    
+    hedging = hedge_policy.stats()
+    if hedging:
+        stats_text += "\n\n<b>Хеджирование (p99 без/с дублями):</b>"
+        for model_id, model_stats in hedging.items():
+            stats_text += (f"\n{model_id}: {model_stats['p99_primary'] or 0:.2f}/{model_stats['p99'] or 0:.2f} с, "
+                           f"дублей {model_stats['hedged']}/{model_stats['requests']}, выиграли {model_stats['hedge_wins']}, "
+                           f"лишних токенов {model_stats['extra_tokens']}")
+    
+    breakers = model_breakers.stats()
+    if breakers:
+        stats_text += f"\n\n<b>Circuit breaker (переключений на запасные: {model_breakers.rerouted}):</b>"
+        for model_id, breaker in breakers.items():
+            stats_text += f"\n{model_id}: {breaker['state']}, срабатываний {breaker['trips']}, отказов {breaker['rejected']}"
+    
+    upstream = upstream_scheduler.stats()
+    if upstream:
+        stats_text += "\n\n<b>Очереди к моделям (в работе/очередь, ожидание):</b>"
+        for model_id, lane in upstream.items():
+            stats_text += (f"\n{model_id}: {lane['active']}/{lane['limit']}, очередь {lane['queued']} (макс. {lane['max_depth']}), "
+                           f"ожидание {lane['avg_wait']:.2f}/{lane['max_wait']:.2f} с, сброшено {lane['shed']}")
+    await message.answer(stats_text)
+
 @dp.message(F.text == "🧠 Выбрать модель")
 @dp.message(F.text == "🧠 Choose model")
 async def handle_models(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
+        user = await db.create_user(message.from_user.id, message.from_user.username)
         
     lang = user['language']
     await message.answer("🤖 <b>Выберите AI-модель</b>", reply_markup=get_models_keyboard(user['subscription'], lang))
@@ -630,12 +972,12 @@ async def handle_models(message: types.Message):
 @dp.message(F.text == "👤 Мой профиль")
 @dp.message(F.text == "👤 My profile")
 async def handle_profile(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
+        user = await db.create_user(message.from_user.id, message.from_user.username)
         
     lang = user['language']
-    plan = next((p for p in Config.SUBSCRIPTION_PLANS if p['id'] == user['subscription']), None)
+    plan = catalog.get_plan(user['subscription'])
     
     days_left = 0
     if user['subscription_end']:
@@ -682,9 +1024,9 @@ Videos sent: {user['videos_sent_today']}
 @dp.message(F.text == "💳 Купить подписку")
 @dp.message(F.text == "💳 Buy subscription")
 async def handle_buy_subscription(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
+        user = await db.create_user(message.from_user.id, message.from_user.username)
         
     lang = user['language']
     await message.answer("💎 <b>Выберите подписку</b>", reply_markup=get_subscription_keyboard(lang))
@@ -692,9 +1034,9 @@ async def handle_buy_subscription(message: types.Message):
 @dp.message(F.text == "🔑 Купить API")
 @dp.message(F.text == "🔑 Buy API")
 async def handle_buy_api(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
+        user = await db.create_user(message.from_user.id, message.from_user.username)
         
     lang = user['language']
     await message.answer("🔑 <b>Купить API-ключ</b>", reply_markup=get_api_key_keyboard(lang))
@@ -702,9 +1044,9 @@ async def handle_buy_api(message: types.Message):
 @dp.message(F.text == "📤 Рефералка")
 @dp.message(F.text == "📤 Referral")
 async def handle_referral(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
+        user = await db.create_user(message.from_user.id, message.from_user.username)
         
     lang = user['language']
     ref_text = {
@@ -730,7 +1072,7 @@ https://t.me/{(await bot.get_me()).username}?start={user['referral_code']}
 @dp.message(F.text == "🆘 Помощь")
 @dp.message(F.text == "🆘 Help")
 async def handle_help(message: types.Message):
-    user = db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id)
     lang = user['language'] if user else 'ru'
     
     help_text = {
@@ -770,54 +1112,44 @@ async def handle_help(message: types.Message):
     await message.answer(help_text[lang])
 
 # ========== CALLBACK ОБРАБОТЧИКИ ==========
-@dp.callback_query(F.data == "back_to_menu")
-async def back_to_menu(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+# Все callback-запросы проходят через один обработчик и callback_router
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery):
+    await callback_router.dispatch(callback)
+
+@callback_router.action("b", legacy="back_to_menu")
+async def back_to_menu(callback: types.CallbackQuery, arg=None):
+    user = await db.get_user(callback.from_user.id)
     lang = user['language'] if user else 'ru'
     await callback.message.answer("🔙 <b>Возврат в главное меню</b>", reply_markup=get_main_reply_keyboard(lang))
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("info_"))
-async def show_model_info(callback: types.CallbackQuery):
-    model_id = callback.data.replace("info_", "")
-    model = None
-    for category_models in Config.AI_MODELS.values():
-        for m in category_models:
-            if m['id'] == model_id:
-                model = m
-                break
-        if model: break
+@callback_router.action("mi", legacy="info_", model_arg=True)
+async def show_model_info(callback: types.CallbackQuery, model_id):
+    model = catalog.get_model(model_id)
     
     if model:
-        user = db.get_user(callback.from_user.id)
+        user = await db.get_user(callback.from_user.id)
         lang = user['language'] if user else 'ru'
         await callback.message.answer(get_model_info_text(model, lang))
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("plan_info_"))
-async def show_plan_info(callback: types.CallbackQuery):
-    plan_id = callback.data.replace("plan_info_", "")
-    plan = next((p for p in Config.SUBSCRIPTION_PLANS if p['id'] == plan_id), None)
+@callback_router.action("pi", legacy="plan_info_")
+async def show_plan_info(callback: types.CallbackQuery, plan_id):
+    plan = catalog.get_plan(plan_id)
     
     if plan:
-        user = db.get_user(callback.from_user.id)
+        user = await db.get_user(callback.from_user.id)
         lang = user['language'] if user else 'ru'
         await callback.message.answer(get_plan_info_text(plan, lang))
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("api_info_"))
-async def show_api_info(callback: types.CallbackQuery):
-    model_id = callback.data.replace("api_info_", "")
-    model = None
-    for category_models in Config.AI_MODELS.values():
-        for m in category_models:
-            if m['id'] == model_id:
-                model = m
-                break
-        if model: break
+@callback_router.action("ai", legacy="api_info_", model_arg=True)
+async def show_api_info(callback: types.CallbackQuery, model_id):
+    model = catalog.get_model(model_id)
     
     if model:
-        user = db.get_user(callback.from_user.id)
+        user = await db.get_user(callback.from_user.id)
         lang = user['language'] if user else 'ru'
         price = Config.API_KEY_PRICES.get(model_id, 0)
         api_text = {
@@ -827,46 +1159,44 @@ async def show_api_info(callback: types.CallbackQuery):
         await callback.message.answer(api_text[lang])
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("model_"))
-async def select_model(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+@callback_router.action("m", legacy="model_", model_arg=True)
+async def select_model(callback: types.CallbackQuery, model_id):
+    user = await db.get_user(callback.from_user.id)
     if not user: 
         await callback.answer("Сначала используйте /start")
         return
         
-    model_id = callback.data.replace("model_", "")
-    db.update_user_model(user['user_id'], model_id)
+    if not catalog.can_use(user['subscription'], model_id):
+        await callback.answer("❌ Модель недоступна в вашей подписке")
+        return
     
-    model_name = model_id
-    for category_models in Config.AI_MODELS.values():
-        for m in category_models:
-            if m['id'] == model_id:
-                model_name = m['name'] if user['language'] == 'ru' else m['name_en']
-                break
+    await db.update_user_model(user['user_id'], model_id)
+    
+    model = catalog.get_model(model_id)
+    model_name = model['name'] if user['language'] == 'ru' else model['name_en']
     
     lang = user['language']
     await callback.message.answer(f"✅ <b>Модель {model_name} выбрана!</b>")
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("sub_"))
-async def process_subscription(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+@callback_router.action("p", legacy="sub_")
+async def process_subscription(callback: types.CallbackQuery, plan_id):
+    user = await db.get_user(callback.from_user.id)
     if not user: 
         await callback.answer("Сначала используйте /start")
         return
         
-    plan_id = callback.data.replace("sub_", "")
-    plan = next((p for p in Config.SUBSCRIPTION_PLANS if p['id'] == plan_id), None)
+    plan = catalog.get_plan(plan_id)
     if not plan: 
         await callback.answer("❌ План не найден")
         return
     
     payment_id = str(uuid.uuid4())
-    db.create_payment(payment_id, user['user_id'], 'subscription', plan_id, None, plan['price'])
+    await db.create_payment(payment_id, user['user_id'], 'subscription', plan_id, None, plan['price'])
     result = await yookassa_service.create_subscription_payment(user['user_id'], plan_id, plan['name'], plan['price'], user['language'])
     
     if result['success']:
-        db.update_payment_status(payment_id, 'pending', result['yookassa_id'])
+        await db.update_payment_status(payment_id, 'pending', result['yookassa_id'])
         payment_text = {
             'ru': f"""💳 <b>Оплата подписки {plan['name']}</b>
 
@@ -890,34 +1220,30 @@ async def process_subscription(callback: types.CallbackQuery):
         await callback.message.answer("❌ <b>Ошибка при создании платежа</b>\n\nПопробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("api_"))
-async def process_api(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+@callback_router.action("a", legacy="api_", model_arg=True)
+async def process_api(callback: types.CallbackQuery, model_id):
+    user = await db.get_user(callback.from_user.id)
     if not user: 
         await callback.answer("Сначала используйте /start")
         return
         
-    model_id = callback.data.replace("api_", "")
     price = Config.API_KEY_PRICES.get(model_id)
     if not price: 
         await callback.answer("❌ Модель не найдена")
         return
     
-    model = None
-    for category_models in Config.AI_MODELS.values():
-        for m in category_models:
-            if m['id'] == model_id:
-                model = m
-                break
-        if model: break
+    model = catalog.get_model(model_id)
+    if not model:
+        await callback.answer("❌ Модель не найдена")
+        return
     
     payment_id = str(uuid.uuid4())
-    db.create_payment(payment_id, user['user_id'], 'api_key', None, model_id, price)
+    await db.create_payment(payment_id, user['user_id'], 'api_key', None, model_id, price)
     model_name = model['name'] if user['language'] == 'ru' else model['name_en']
     result = await yookassa_service.create_api_key_payment(user['user_id'], model_id, model_name, price, user['language'])
     
     if result['success']:
-        db.update_payment_status(payment_id, 'pending', result['yookassa_id'])
+        await db.update_payment_status(payment_id, 'pending', result['yookassa_id'])
         payment_text = {
             'ru': f"""🔑 <b>Покупка API-ключа {model_name}</b>
 
@@ -943,15 +1269,14 @@ async def process_api(callback: types.CallbackQuery):
         await callback.message.answer("❌ <b>Ошибка при создании платежа</b>\n\nПопробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("paid_"))
-async def check_payment(callback: types.CallbackQuery):
-    payment_id = callback.data.replace("paid_", "")
-    payment = db.get_payment(payment_id)
+@callback_router.action("pd", legacy="paid_")
+async def check_payment(callback: types.CallbackQuery, payment_id):
+    payment = await db.get_payment(payment_id)
     if not payment: 
         await callback.answer("❌ Платеж не найден")
         return
     
-    user = db.get_user(callback.from_user.id)
+    user = await db.get_user(callback.from_user.id)
     lang = user['language'] if user else 'ru'
     
     await callback.message.answer("⏳ <b>Проверяем статус платежа...</b>")
@@ -961,9 +1286,9 @@ async def check_payment(callback: types.CallbackQuery):
         await callback.message.answer("❌ <b>Платеж еще не подтвержден</b>\n\nПопробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data == "share_ref")
-async def share_referral(callback: types.CallbackQuery):
-    user = db.get_user(callback.from_user.id)
+@callback_router.action("s", legacy="share_ref")
+async def share_referral(callback: types.CallbackQuery, arg=None):
+    user = await db.get_user(callback.from_user.id)
     if not user: 
         await callback.answer("Сначала используйте /start")
         return
@@ -987,6 +1312,7 @@ https://t.me/{(await bot.get_me()).username}?start={user['referral_code']}
 
 # ========== ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ ==========
 @dp.message(F.text)
+@limit_per_user
 async def handle_message(message: types.Message):
     # Пропускаем команды меню
     menu_commands = ["🧠 Выбрать модель", "👤 Мой профиль", "💳 Купить подписку", "🔑 Купить API", 
@@ -997,59 +1323,82 @@ async def handle_message(message: types.Message):
     if message.text in menu_commands:
         return
     
-    user = db.get_user(message.from_user.id)
-    if not user:
-        user = db.create_user(message.from_user.id, message.from_user.username)
-        
-    # Проверяем общие лимиты
-    can_use, error_msg = db.can_use_model(user['user_id'])
-    if not can_use: 
-        lang = user['language']
-        await message.answer(f"❌ {error_msg}")
+    # Вопрос ответом на документ: текст документа берется из кеша по file_unique_id
+    if message.reply_to_message and message.reply_to_message.document:
+        await process_document(message, message.reply_to_message.document, message.text)
         return
-        
-    db.increment_daily_usage(user['user_id'])
     
     user_id = message.from_user.id
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
     
-    user_conversations[user_id].append({"role": "user", "content": message.text})
-    if len(user_conversations[user_id]) > 10:
-        user_conversations[user_id] = user_conversations[user_id][-10:]
+    # Подбираем историю под бюджет токенов текущей модели
+    user = await db.get_user(user_id)
+    model_id = user['current_model'] if user else Config.AI_MODELS['free'][0]['id']
+    message_tokens = estimate_message_tokens(message.text)
+    history_budget = max(get_history_budget(model_id) - message_tokens, 0)
+    conversation_history, history_tokens = conversation_store.fit_history(user_id, history_budget)
+    
+    # Оцениваем токены для запроса
+    input_tokens = history_tokens + message_tokens
+    output_estimate = 1500
+    
+    # Сброс счетчиков, проверка дневных и месячных лимитов и резервирование - одной транзакцией
+    admission = await db.admit_request(
+        user_id, message.from_user.username,
+        input_tokens=input_tokens, output_tokens=output_estimate
+    )
+    if not admission['allowed']:
+        await message.answer(f"❌ {admission['error']}")
+        return
+    user = admission['user']
+    
+    conversation_store.append(user_id, "user", message.text)
     
     lang = user['language']
     msg = await message.answer("⏳ <b>Генерация началась...</b>")
-    active_generations[user_id] = True
     
     try:
-        # Оцениваем токены для запроса
-        input_tokens = len(message.text) * 2
-        output_estimate = 1500
-        total_tokens = input_tokens + output_estimate
-        
-        # Проверяем месячные лимиты
-        can_use, error_msg = db.check_monthly_token_limits(user_id, input_tokens, output_estimate)
-        if not can_use:
-            await msg.edit_text(f"❌ {error_msg}")
-            return
+        if Config.STREAMING_ENABLED:
+            # stream_response сам занимает слот планировщика на время стрима
+            result = await model_breakers.run(
+                user['current_model'], user['subscription'],
+                functools.partial(
+                    stream_response,
+                    msg,
+                    text=message.text,
+                    conversation_history=conversation_history,
+                    subscription=user['subscription']
+                )
+            )
+        else:
+            result = await ask_model(
+                user['current_model'], user['subscription'],
+                functools.partial(
+                    routerai_service.send_message,
+                    message=message.text,
+                    conversation_history=conversation_history
+                )
+            )
         
-        result = await routerai_service.send_message(
-            user['current_model'], 
-            message.text,
-            user_conversations[user_id][:-1]
-        )
-        
-        if result['success'] and active_generations.get(user_id):
-            user_conversations[user_id].append({"role": "assistant", "content": result['response']})
+        if result['success']:
+            conversation_store.append(user_id, "assistant", result['response'])
             cleaned_response = result['response']
-            await msg.edit_text(f"🤖 <b>Ответ:</b>\n\n{cleaned_response}")
+            response_text = f"🤖 <b>Ответ:</b>\n\n{cleaned_response}"
+            if result['model_id'] != user['current_model']:
+                fallback_model = catalog.get_model(result['model_id'])
+                fallback_name = fallback_model['name'] if lang == 'ru' else fallback_model['name_en']
+                note = {
+                    'ru': f"ℹ️ <i>Модель временно недоступна, ответила {fallback_name}</i>",
+                    'en': f"ℹ️ <i>Model is temporarily unavailable, answered by {fallback_name}</i>"
+                }
+                response_text = f"{note[lang]}\n\n{response_text}"
+            await msg.edit_text(response_text)
             
             # Оцениваем реальное количество токенов
             if 'usage' in result:
                 actual_input = result['usage'].get('prompt_tokens', 0)
                 actual_output = result['usage'].get('completion_tokens', 0)
-                db.update_token_usage(user_id, actual_input, actual_output)
+                await db.update_token_usage(user_id, actual_input, actual_output)
+                token_calibration.record(result['model_id'], input_tokens, actual_input)
             
         elif not result['success']:
             error_msg = result.get('error', 'Неизвестная ошибка')
@@ -1062,8 +1411,10 @@ async def handle_message(message: types.Message):
     except Exception as e:
         logger.error(f"Message processing error: {e}")
         await msg.edit_text("❌ <b>Ошибка соединения</b>\n\nПопробуйте позже.")
-    finally:
-        active_generations.pop(user_id, None)
+    except asyncio.CancelledError:
+        # Запрос вытеснен новым сообщением пользователя (политика cancel_previous)
+        await safe_edit(msg, "⛔ <b>Запрос отменен</b>")
+        raise
 
 # ========== ВЕБХУК YOOKASSA ==========
 async def yookassa_webhook(request):
@@ -1078,15 +1429,17 @@ async def yookassa_webhook(request):
             user_id = metadata.get('user_id')
             
             if user_id:
-                payment = db.get_payment_by_yookassa_id(yookassa_id)
+                # В метаданных платежа id строкой, а в БД и кешах - int
+                user_id = int(user_id)
+                payment = await db.get_payment_by_yookassa_id(yookassa_id)
                 if payment and payment['status'] != 'succeeded':
-                    db.update_payment_status(payment['payment_id'], 'succeeded', yookassa_id)
+                    await db.update_payment_status(payment['payment_id'], 'succeeded', yookassa_id)
                     
-                    user = db.get_user(user_id)
+                    user = await db.get_user(user_id)
                     lang = user['language'] if user else 'ru'
                     
                     if payment['type'] == 'subscription':
-                        db.update_user_subscription(user_id, payment['plan_id'])
+                        await db.update_user_subscription(user_id, payment['plan_id'])
                         success_text = {
                             'ru': "✅ <b>Платеж автоматически подтвержден! Подписка активирована.</b>",
                             'en': "✅ <b>Payment automatically confirmed! Subscription activated.</b>"
@@ -1114,6 +1467,17 @@ async def start_webhook_server():
     logger.info(f"Webhook server started on port {Config.PORT}")
     return runner
 
+async def usage_flush_loop():
+    """Периодически сбрасывает буфер счетчиков использования в БД"""
+    while True:
+        await asyncio.sleep(Config.USAGE_FLUSH_INTERVAL)
+        try:
+            flushed = await db.flush_usage()
+            if flushed:
+                logger.debug(f"Usage counters flushed for {flushed} users")
+        except Exception as e:
+            logger.error(f"Usage flush error: {e}")
+
 async def main():
     logger.info("Starting GobiAI bot with all features...")
     
@@ -1125,14 +1489,29 @@ async def main():
         logger.error(f"Bot connection failed: {e}")
         return
     
+    # Открываем пул соединений с RouterAI
+    await routerai_service.start()
+    await media_cache.start()
+    # Воркеры очереди генерации; задачи, прерванные прошлой остановкой, выполняются заново
+    await image_job_queue.start(run_image_job, report_image_job_position, report_image_job_failure)
+    
     # Запускаем сервер для вебхуков
     runner = await start_webhook_server()
+    flush_task = asyncio.create_task(usage_flush_loop())
     
     logger.info("Starting bot in polling mode...")
     try:
         await dp.start_polling(bot, skip_updates=True)
     finally:
+        flush_task.cancel()
+        await image_job_queue.close()
         await runner.cleanup()
+        await routerai_service.close()
+        await response_cache.close()
+        video_pipeline.close()
+        document_pipeline.close()
+        await media_cache.close()
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
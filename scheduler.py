@@ -0,0 +1,159 @@
+import time
+import asyncio
+import heapq
+import itertools
+import contextlib
+from config import Config
+from catalog import catalog
+
+OVERLOADED_ERROR = "Сервис перегружен, попробуйте через минуту"
+
+class UpstreamOverloaded(Exception):
+    """Очередь к модели переполнена или ожидание слишком долгое"""
+
+class ModelLane:
+    """Слоты и очередь ожидания одной модели"""
+    __slots__ = ('limit', 'active', 'waiters', 'queued', 'admitted', 'shed', 'wait_total', 'wait_max', 'max_depth')
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiters = []  # куча [key, seq, future]
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.max_depth = 0
+
+class UpstreamScheduler:
+    """Ограничение одновременных запросов к RouterAI по моделям с приоритетом по тарифу.
+    
+    Свободный слот отдается ожидающему с наибольшим rank тарифа + aging * время ожидания.
+    Так как время ожидания растет у всех одинаково, ключ кучи aging * t_enqueue - rank
+    не меняется со временем, и бесплатные запросы не голодают бесконечно.
+    """
+    
+    def __init__(self, default_limit, model_limits, max_queue, max_wait, aging):
+        self.default_limit = default_limit
+        self.model_limits = model_limits
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.aging = aging
+        self.lanes = {}
+        self.sequence = itertools.count()
+    
+    def lane(self, model_id):
+        lane = self.lanes.get(model_id)
+        if lane is None:
+            lane = self.lanes[model_id] = ModelLane(self.model_limits.get(model_id, self.default_limit))
+        return lane
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, model_id, subscription='free'):
+        await self.acquire(model_id, subscription)
+        try:
+            yield
+        finally:
+            self.release(model_id)
+    
+    async def run(self, model_id, subscription, func, *args, **kwargs):
+        """Вызывает func в слоте модели; при перегрузке возвращает ошибку в формате RouterAIService.
+        
+        В result['latency'] - время выполнения без ожидания в очереди: по нему breaker
+        судит о медленных ответах модели, а не о перегрузке на нашей стороне.
+        """
+        try:
+            async with self.slot(model_id, subscription):
+                started = time.monotonic()
+                result = await func(*args, **kwargs)
+                result.setdefault('latency', time.monotonic() - started)
+                return result
+        except UpstreamOverloaded:
+            return {"success": False, "error": OVERLOADED_ERROR}
+    
+    async def acquire(self, model_id, subscription):
+        lane = self.lane(model_id)
+        if lane.active < lane.limit and not lane.queued:
+            lane.active += 1
+            lane.admitted += 1
+            return
+        
+        loop = asyncio.get_running_loop()
+        enqueued = loop.time()
+        key = self.aging * enqueued - catalog.plan_rank(subscription)
+        
+        if lane.queued >= self.max_queue:
+            # Очередь полна: вытесняем худшего ожидающего, если новый запрос важнее
+            worst = max((entry for entry in lane.waiters if not entry[2].done()), default=None)
+            if worst is None or worst[0] <= key:
+                lane.shed += 1
+                raise UpstreamOverloaded()
+            worst[2].set_exception(UpstreamOverloaded())
+            lane.queued -= 1
+            lane.shed += 1
+        
+        future = loop.create_future()
+        heapq.heappush(lane.waiters, [key, next(self.sequence), future])
+        lane.queued += 1
+        lane.max_depth = max(lane.max_depth, lane.queued)
+        
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                lane.queued -= 1
+                lane.shed += 1
+                raise UpstreamOverloaded()
+        except asyncio.CancelledError:
+            if not future.done():
+                future.cancel()
+                lane.queued -= 1
+                raise
+            # Слот уже выдан, но ждавший отменен - возвращаем слот
+            if not future.cancelled() and future.exception() is None:
+                self.release(model_id)
+            raise
+        
+        # Слот передан из release(): lane.active уже увеличен
+        future.result()
+        waited = loop.time() - enqueued
+        lane.wait_total += waited
+        lane.wait_max = max(lane.wait_max, waited)
+        lane.admitted += 1
+    
+    def release(self, model_id):
+        lane = self.lanes[model_id]
+        while lane.waiters:
+            _, _, future = heapq.heappop(lane.waiters)
+            if future.done():
+                continue
+            # Передаем слот напрямую, не уменьшая active
+            lane.queued -= 1
+            future.set_result(None)
+            return
+        lane.active -= 1
+    
+    def stats(self):
+        result = {}
+        for model_id, lane in self.lanes.items():
+            result[model_id] = {
+                'limit': lane.limit,
+                'active': lane.active,
+                'queued': lane.queued,
+                'max_depth': lane.max_depth,
+                'admitted': lane.admitted,
+                'shed': lane.shed,
+                'avg_wait': lane.wait_total / lane.admitted if lane.admitted else 0.0,
+                'max_wait': lane.wait_max
+            }
+        return result
+
+upstream_scheduler = UpstreamScheduler(
+    default_limit=Config.UPSTREAM_DEFAULT_CONCURRENCY,
+    model_limits=Config.UPSTREAM_MODEL_CONCURRENCY,
+    max_queue=Config.UPSTREAM_MAX_QUEUE,
+    max_wait=Config.UPSTREAM_MAX_WAIT,
+    aging=Config.UPSTREAM_PRIORITY_AGING
+)
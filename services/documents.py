@@ -0,0 +1,240 @@
+import io
+import os
+import re
+import csv
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from tokens import count_tokens
+from pypdf import PdfReader
+from services.media import download_to_file
+
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = {".txt", ".md", ".markdown", ".log"}
+CSV_EXTENSIONS = {".csv", ".tsv"}
+PDF_EXTENSIONS = {".pdf"}
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?…])\s+')
+
+def document_kind(file_name, mime_type=None):
+    extension = os.path.splitext(file_name or "")[1].lower()
+    if extension in CSV_EXTENSIONS or mime_type == "text/csv":
+        return "csv"
+    if extension in PDF_EXTENSIONS or mime_type == "application/pdf":
+        return "pdf"
+    if extension in TEXT_EXTENSIONS or (mime_type or "").startswith("text/"):
+        return "text"
+    return None
+
+def decode_text(data):
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace")
+
+def extract_text(path, kind, max_chars):
+    """Текст документа, не длиннее max_chars. Выполняется в пуле процессов"""
+    if kind == "pdf":
+        parts = []
+        length = 0
+        for page in PdfReader(path).pages:
+            page_text = page.extract_text() or ""
+            parts.append(page_text)
+            length += len(page_text)
+            if length >= max_chars:
+                break
+        return "\n\n".join(parts)[:max_chars]
+    
+    with open(path, "rb") as f:
+        text = decode_text(f.read(max_chars * 4))[:max_chars]
+    
+    if kind == "csv":
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096])
+        except csv.Error:
+            dialect = csv.excel
+        # Таблицу отдаем строками "a | b | c" - так модель тратит меньше токенов на кавычки
+        text = "\n".join(" | ".join(cell.strip() for cell in row) for row in csv.reader(io.StringIO(text), dialect))
+    return text
+
+def split_chunks(text, max_tokens):
+    """Делит текст на куски по абзацам (длинные абзацы - по предложениям) в пределах max_tokens"""
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in SENTENCE_PATTERN.split(paragraph):
+            # Предложение длиннее бюджета режем по символам (~2 символа на токен - с запасом)
+            while count_tokens(sentence) > max_tokens:
+                pieces.append(sentence[:max_tokens * 2])
+                sentence = sentence[max_tokens * 2:]
+            if sentence:
+                pieces.append(sentence)
+    
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def prepare_document(path, kind, max_chars, chunk_tokens, max_chunks):
+    """Извлекает текст и делит его на куски. Выполняется в пуле процессов.
+    
+    Возвращает {'chunks', 'truncated', 'tokens'}: не больше max_chunks кусков,
+    отброшены ли остальные и оценку входных токенов оставшихся кусков.
+    """
+    chunks = split_chunks(extract_text(path, kind, max_chars), chunk_tokens)
+    return {
+        'chunks': chunks[:max_chunks],
+        'truncated': len(chunks) > max_chunks,
+        'tokens': sum(count_tokens(chunk) for chunk in chunks[:max_chunks])
+    }
+
+class DocumentPipeline:
+    """Извлечение текста документов и анализ длинных документов по частям (map-reduce)"""
+    
+    def __init__(self, max_size, max_chars, chunk_tokens, max_chunks, map_concurrency, workers, cache_chars):
+        self.max_size = max_size
+        self.max_chars = max_chars
+        self.chunk_tokens = chunk_tokens
+        self.max_chunks = max_chunks
+        self.map_concurrency = map_concurrency
+        self.workers = workers
+        self.executor = None
+        self.cache = OrderedDict()
+        self.cache_chars = cache_chars
+        self.chars = 0
+        self.hits = 0
+        self.extracted = 0
+        self.map_requests = 0
+    
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+    
+    def supports(self, document):
+        return document_kind(document.file_name, document.mime_type) is not None
+    
+    async def get_document(self, bot, document):
+        """Куски текста документа (из кеша по file_unique_id или подготовленные заново)"""
+        prepared = self.cache.get(document.file_unique_id)
+        if prepared is not None:
+            self.cache.move_to_end(document.file_unique_id)
+            self.hits += 1
+            return prepared
+        
+        kind = document_kind(document.file_name, document.mime_type)
+        with tempfile.TemporaryDirectory(prefix="document-") as workdir:
+            path = os.path.join(workdir, "document")
+            file = await bot.get_file(document.file_id)
+            with open(path, "wb") as destination:
+                await download_to_file(bot, file.file_path, destination)
+            
+            loop = asyncio.get_running_loop()
+            prepared = await loop.run_in_executor(
+                self.get_executor(), prepare_document,
+                path, kind, self.max_chars, self.chunk_tokens, self.max_chunks
+            )
+        
+        self.extracted += 1
+        self.remember(document.file_unique_id, prepared)
+        return prepared
+    
+    async def analyze(self, prepared, question, file_name, request):
+        """Ответ на вопрос по документу. request(prompt) -> результат RouterAIService.
+        
+        Короткий документ уходит одним запросом. Длинный делится на куски, куски
+        пересказываются параллельно (не больше map_concurrency запросов сразу),
+        затем пересказы сводятся в один ответ. usage суммируется по всем сделанным
+        запросам, в том числе когда часть из них завершилась ошибкой.
+        """
+        chunks = prepared['chunks']
+        truncated = prepared['truncated']
+        
+        if len(chunks) <= 1:
+            return await request(
+                f"Пользователь отправил документ «{file_name}».\n\n"
+                f"Содержимое документа:\n{chunks[0] if chunks else ''}\n\n"
+                f"Запрос пользователя: {question}"
+            )
+        
+        semaphore = asyncio.Semaphore(self.map_concurrency)
+        
+        async def summarize(index, chunk):
+            async with semaphore:
+                self.map_requests += 1
+                return await request(
+                    f"Это часть {index} из {len(chunks)} документа «{file_name}». "
+                    f"Кратко изложи ее содержание, сохраняя факты, цифры и все, что относится к запросу: {question}\n\n{chunk}"
+                )
+        
+        summaries = await asyncio.gather(*(summarize(index, chunk) for index, chunk in enumerate(chunks, 1)))
+        failed = [summary for summary in summaries if not summary['success']]
+        if failed:
+            return self.with_usage(dict(failed[0]), summaries)
+        
+        combined = "\n\n".join(f"Часть {index}:\n{summary['response']}" for index, summary in enumerate(summaries, 1))
+        note = "\n\n(Документ длинный, проанализировано только начало.)" if truncated else ""
+        result = await request(
+            f"Ниже пересказ частей документа «{file_name}» по порядку.{note}\n\n{combined}\n\n"
+            f"Используя его, ответь на запрос пользователя: {question}"
+        )
+        return self.with_usage(result, summaries + [result])
+    
+    def with_usage(self, result, responses):
+        """Записывает в result суммарный usage всех запросов"""
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+        for item in responses:
+            for key in usage:
+                usage[key] += (item.get('usage') or {}).get(key, 0)
+        result['usage'] = usage
+        return result
+    
+    def remember(self, key, prepared):
+        self.cache[key] = prepared
+        self.chars += sum(len(chunk) for chunk in prepared['chunks'])
+        while self.chars > self.cache_chars and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.chars -= sum(len(chunk) for chunk in evicted['chunks'])
+    
+    def stats(self):
+        return {
+            'extracted': self.extracted,
+            'cache_hits': self.hits,
+            'cached': len(self.cache),
+            'map_requests': self.map_requests
+        }
+    
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+document_pipeline = DocumentPipeline(
+    max_size=Config.DOCUMENT_MAX_SIZE,
+    max_chars=Config.DOCUMENT_MAX_CHARS,
+    chunk_tokens=Config.DOCUMENT_CHUNK_TOKENS,
+    max_chunks=Config.DOCUMENT_MAX_CHUNKS,
+    map_concurrency=Config.DOCUMENT_MAP_CONCURRENCY,
+    workers=Config.DOCUMENT_WORKERS,
+    cache_chars=Config.DOCUMENT_CACHE_CHARS
+)
@@ -0,0 +1,117 @@
+import math
+import asyncio
+from collections import deque
+from config import Config
+
+class LatencyWindow:
+    """Последние N задержек модели и перцентили по ним"""
+    
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.sorted = None
+    
+    def add(self, latency):
+        self.samples.append(latency)
+        self.sorted = None
+    
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        if self.sorted is None:
+            self.sorted = sorted(self.samples)
+        index = min(len(self.sorted) - 1, max(0, math.ceil(q * len(self.sorted)) - 1))
+        return self.sorted[index]
+    
+    def __len__(self):
+        return len(self.samples)
+
+class HedgeStats:
+    """Статистика одной модели в одном режиме: полный ответ или первое событие стрима"""
+    __slots__ = ('requests', 'hedged', 'hedge_wins', 'extra_tokens', 'latency', 'delay_latency', 'baseline_latency')
+    
+    def __init__(self, window):
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.extra_tokens = 0
+        # Задержка, которую видит пользователь
+        self.latency = LatencyWindow(window)
+        # Для выбора задержки дубля: любые завершенные запросы и отмененные первые (нижняя оценка)
+        self.delay_latency = LatencyWindow(window)
+        # База для сравнения: только первые запросы, выполненные до конца без ошибки
+        self.baseline_latency = LatencyWindow(window)
+
+class HedgePolicy:
+    """Когда отправлять дублирующий запрос: после p95 задержки модели, не чаще бюджета"""
+    
+    def __init__(self, models, budget, min_samples, default_delay, window):
+        self.models = models
+        self.budget = budget
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.window = window
+        self.stats_by_model = {}
+    
+    def get_stats(self, model_id, stream=False):
+        """stream - задержка до первого события стрима, иначе - до полного ответа"""
+        key = (model_id, stream)
+        stats = self.stats_by_model.get(key)
+        if stats is None:
+            stats = self.stats_by_model[key] = HedgeStats(self.window)
+        return stats
+    
+    def enabled(self, model_id):
+        return model_id in self.models
+    
+    def hedge_delay(self, stats):
+        if len(stats.delay_latency) < self.min_samples:
+            return self.default_delay
+        return stats.delay_latency.percentile(0.95)
+    
+    def track_latency(self, stats, task, started, primary=True):
+        """Записывает задержку запроса, когда задача завершится.
+        
+        Ошибки не учитываются. Отмененный первый запрос попадает только в окно задержки
+        дубля (нижней оценкой), дублирующий - только если завершился сам.
+        """
+        loop = asyncio.get_running_loop()
+        
+        def record(task):
+            latency = loop.time() - started
+            if task.cancelled():
+                if primary:
+                    stats.delay_latency.add(latency)
+                return
+            if task.exception() is not None or task.result().get('success') is False:
+                return
+            stats.delay_latency.add(latency)
+            if primary:
+                stats.baseline_latency.add(latency)
+        
+        task.add_done_callback(record)
+    
+    def can_hedge(self, stats):
+        """Доля хеджированных запросов не превышает budget (+1 запрос на старте)"""
+        return stats.hedged < self.budget * stats.requests + 1
+    
+    def stats(self):
+        result = {}
+        for (model_id, stream), stats in self.stats_by_model.items():
+            result[f"{model_id} (stream)" if stream else model_id] = {
+                'requests': stats.requests,
+                'hedged': stats.hedged,
+                'hedge_wins': stats.hedge_wins,
+                'extra_tokens': stats.extra_tokens,
+                'p95': stats.delay_latency.percentile(0.95),
+                'p99_primary': stats.baseline_latency.percentile(0.99),
+                'p99': stats.latency.percentile(0.99)
+            }
+        return result
+
+hedge_policy = HedgePolicy(
+    models=Config.HEDGED_MODELS,
+    budget=Config.HEDGE_BUDGET,
+    min_samples=Config.HEDGE_MIN_SAMPLES,
+    default_delay=Config.HEDGE_DEFAULT_DELAY,
+    window=Config.HEDGE_LATENCY_WINDOW
+)
@@ -0,0 +1,123 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from config import Config
+from services.media import file_size
+
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+def preprocess_image(source, destination, max_dimension, image_format, quality):
+    """Уменьшает изображение из файла source до max_dimension по большей стороне и пережимает
+    без метаданных в destination.
+    
+    Возвращает (converted, mime): converted=False - лучше отправить source как есть
+    (только если в нем нет метаданных: EXIF с геопозицией, ICC-профиля, XMP).
+    Выполняется в пуле потоков: Pillow отпускает GIL на декодировании, ресайзе и кодировании.
+    """
+    source.seek(0)
+    with Image.open(source) as image:
+        source_format = image.format
+        has_metadata = any(image.info.get(key) for key in ("exif", "icc_profile", "xmp"))
+        # Для JPEG декодер сразу уменьшает в 2/4/8 раз - быстрее и меньше памяти
+        image.draft("RGB", (max_dimension, max_dimension))
+        # Поворот из EXIF применяем до того, как выбросим метаданные
+        image = ImageOps.exif_transpose(image)
+        resized = max(image.size) > max_dimension
+        if resized:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if image_format == "WEBP" and has_alpha:
+            image = image.convert("RGBA")
+        elif image.mode != "RGB":
+            if has_alpha:
+                # JPEG без прозрачности: подкладываем белый фон
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image.convert("RGBA"), mask=image.convert("RGBA").split()[-1])
+                image = background
+            else:
+                image = image.convert("RGB")
+        
+        destination.seek(0)
+        destination.truncate()
+        if image_format == "WEBP":
+            image.save(destination, "WEBP", quality=quality, method=4)
+        else:
+            image.save(destination, "JPEG", quality=quality, optimize=True, progressive=True)
+    
+    # Уже маленький JPEG/WebP без ресайза и метаданных не раздуваем перекодированием
+    if not resized and not has_metadata and source_format in MIME_TYPES and file_size(source) <= file_size(destination):
+        return False, MIME_TYPES[source_format]
+    return True, MIME_TYPES[image_format]
+
+class ImagePipeline:
+    """Подготовка изображений перед отправкой в модель и метрики экономии"""
+    
+    def __init__(self, max_dimension, model_max_dimensions, image_format, quality, workers):
+        self.max_dimension = max_dimension
+        self.model_max_dimensions = model_max_dimensions
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+        self.images = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.process_time = 0.0
+        self.uploads = 0
+        self.upload_time = 0.0
+    
+    def get_max_dimension(self, model_id):
+        return self.model_max_dimensions.get(model_id, self.max_dimension)
+    
+    async def prepare(self, source, destination, model_id):
+        """(файл, mime) для модели: destination с результатом или source, если он уже подходит
+        или не декодируется"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            converted, mime = await loop.run_in_executor(
+                self.executor, preprocess_image,
+                source, destination, self.get_max_dimension(model_id), self.image_format, self.quality
+            )
+        except Exception as e:
+            logger.warning(f"Image preprocessing failed, sending original: {e}")
+            self.failed += 1
+            source.seek(0)
+            return source, "image/jpeg"
+        
+        result = destination if converted else source
+        result.seek(0)
+        self.images += 1
+        self.bytes_in += file_size(source)
+        self.bytes_out += file_size(result)
+        self.process_time += time.perf_counter() - started
+        return result, mime
+    
+    def record_upload(self, seconds):
+        """Время запроса к модели с изображением"""
+        self.uploads += 1
+        self.upload_time += seconds
+    
+    def stats(self):
+        return {
+            'images': self.images,
+            'failed': self.failed,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'saved': self.bytes_in - self.bytes_out,
+            'avg_process_ms': self.process_time / self.images * 1000 if self.images else 0.0,
+            'avg_upload': self.upload_time / self.uploads if self.uploads else 0.0
+        }
+
+image_pipeline = ImagePipeline(
+    max_dimension=Config.IMAGE_MAX_DIMENSION,
+    model_max_dimensions=Config.IMAGE_MAX_DIMENSIONS,
+    image_format=Config.IMAGE_FORMAT,
+    quality=Config.IMAGE_QUALITY,
+    workers=Config.IMAGE_WORKERS
+)
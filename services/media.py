@@ -0,0 +1,63 @@
+import json
+import uuid
+import base64
+import tempfile
+from config import Config
+
+def spooled_file():
+    """Временный файл: в памяти до MEDIA_SPOOL_MAX_SIZE, дальше - на диске"""
+    return tempfile.SpooledTemporaryFile(max_size=Config.MEDIA_SPOOL_MAX_SIZE)
+
+async def download_to_file(bot, file_path, destination):
+    """Скачивает файл Telegram по частям прямо в destination, без копии целиком в памяти"""
+    await bot.download_file(file_path, destination=destination, chunk_size=Config.MEDIA_CHUNK_SIZE)
+    destination.seek(0)
+    return destination
+
+def file_size(fileobj):
+    position = fileobj.tell()
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size
+
+def base64_size(size):
+    return (size + 2) // 3 * 4
+
+class JsonStreamBody:
+    """JSON-тело запроса, в котором одна строка - base64 от файла, кодируемый по частям.
+    
+    В памяти одновременно только один кусок файла и его base64. Каждый вызов chunks()
+    отдает тело заново (для повторов и хеджирования) и читает файл по своему смещению,
+    поэтому несколько запросов могут читать один файл параллельно.
+    """
+    
+    def __init__(self, payload, marker, fileobj, prefix=""):
+        serialized = json.dumps(payload, ensure_ascii=False)
+        quoted_marker = json.dumps(marker)[1:-1]
+        head, tail = serialized.split(quoted_marker)
+        self.head = (head + prefix).encode('utf-8')
+        self.tail = tail.encode('utf-8')
+        self.fileobj = fileobj
+        self.size = file_size(fileobj)
+        # Кусок кратен 3 байтам, чтобы base64 частей склеивался без паддинга посередине
+        self.chunk_size = Config.MEDIA_CHUNK_SIZE // 3 * 3 or 3
+    
+    def content_length(self):
+        return len(self.head) + base64_size(self.size) + len(self.tail)
+    
+    async def chunks(self):
+        yield self.head
+        offset = 0
+        while offset < self.size:
+            # seek + read без await между ними - другие корутины не собьют позицию
+            self.fileobj.seek(offset)
+            chunk = self.fileobj.read(self.chunk_size)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield base64.b64encode(chunk)
+        yield self.tail
+
+def new_marker():
+    return f"@@media-{uuid.uuid4().hex}@@"
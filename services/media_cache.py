@@ -0,0 +1,250 @@
+import os
+import mmap
+import time
+import json
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class MediaEntry:
+    __slots__ = ('size', 'mime', 'file_id', 'used_at')
+    
+    def __init__(self, size, mime, file_id, used_at):
+        self.size = size
+        self.mime = mime
+        self.file_id = file_id
+        self.used_at = used_at
+
+class MediaCache:
+    """Дисковый кеш медиа с адресацией по ключу содержимого и LRU-вытеснением по размеру.
+    
+    Ключи: file_unique_id для входящих файлов Telegram и хеш (модель, запрос) для
+    сгенерированных изображений. Файлы читаются через mmap. Для отправленных
+    изображений запоминается file_id Telegram, чтобы повтор уходил без загрузки байтов.
+    Индекс хранится в SQLite рядом с файлами; все операции с диском - в одном потоке.
+    """
+    
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.file_id_hits = 0
+        self.evicted = 0
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='media-cache')
+        self.loaded = False
+    
+    @staticmethod
+    def key(kind, *parts):
+        """Ключ: sha256 от вида и частей - безопасное имя файла для любых id и запросов"""
+        raw = json.dumps([kind, *parts], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+    
+    async def run(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args))
+    
+    def load(self):
+        """Открывает индекс и восстанавливает LRU-порядок после перезапуска"""
+        if self.loaded:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.root, "index.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS media (
+                key TEXT PRIMARY KEY,
+                size INTEGER,
+                mime TEXT,
+                file_id TEXT,
+                used_at REAL
+            )
+        ''')
+        for key, size, mime, file_id, used_at in self.conn.execute(
+            "SELECT key, size, mime, file_id, used_at FROM media ORDER BY used_at"
+        ):
+            if os.path.exists(self.path(key)):
+                self.entries[key] = MediaEntry(size, mime, file_id, used_at)
+                self.bytes += size
+            else:
+                self.conn.execute("DELETE FROM media WHERE key = ?", (key,))
+        self.conn.commit()
+        self.loaded = True
+    
+    def touch(self, key):
+        entry = self.entries[key]
+        entry.used_at = time.time()
+        self.entries.move_to_end(key)
+        self.conn.execute("UPDATE media SET used_at = ? WHERE key = ?", (entry.used_at, key))
+        self.conn.commit()
+    
+    def open_sync(self, key):
+        self.load()
+        if key not in self.entries:
+            return None
+        try:
+            with open(self.path(key), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Media cache entry is unreadable, dropping: {e}")
+            self.remove(key)
+            return None
+        self.touch(key)
+        return mapped
+    
+    async def open(self, key):
+        """mmap содержимого (закрывает вызывающий) или None"""
+        mapped = await self.run(self.open_sync, key)
+        if mapped is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return mapped
+    
+    def locate_sync(self, key):
+        self.load()
+        if key not in self.entries:
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            logger.warning("Media cache entry is missing on disk, dropping")
+            self.remove(key)
+            return None
+        self.touch(key)
+        return path
+    
+    async def locate(self, key):
+        """Путь к файлу в кеше (для отправки с диска без чтения в память) или None"""
+        path = await self.run(self.locate_sync, key)
+        if path is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return path
+    
+    def put_sync(self, key, source, mime):
+        self.load()
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        size = 0
+        with open(temp_path, "wb") as destination:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                destination.write(source)
+                size = len(source)
+            else:
+                source.seek(0)
+                while True:
+                    chunk = source.read(Config.MEDIA_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    destination.write(chunk)
+                    size += len(chunk)
+                source.seek(0)
+        if not size:
+            os.remove(temp_path)
+            return
+        os.replace(temp_path, path)
+        
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old.size
+        entry = MediaEntry(size, mime, old.file_id if old else None, time.time())
+        self.entries[key] = entry
+        self.bytes += size
+        self.conn.execute(
+            "INSERT OR REPLACE INTO media (key, size, mime, file_id, used_at) VALUES (?, ?, ?, ?, ?)",
+            (key, size, mime, entry.file_id, entry.used_at)
+        )
+        self.evict(keep=key)
+        self.conn.commit()
+    
+    async def put(self, key, source, mime="application/octet-stream"):
+        """Сохраняет bytes или файл (читается по частям)"""
+        try:
+            await self.run(self.put_sync, key, source, mime)
+        except OSError as e:
+            logger.error(f"Media cache write error: {e}")
+    
+    def evict(self, keep=None):
+        while self.bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            if key == keep:
+                break
+            self.remove(key)
+            self.evicted += 1
+    
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        self.conn.execute("DELETE FROM media WHERE key = ?", (key,))
+    
+    def get_file_id(self, key):
+        """file_id Telegram для уже отправленного файла (без обращения к диску)"""
+        entry = self.entries.get(key)
+        if entry is None or not entry.file_id:
+            return None
+        return entry.file_id
+    
+    def record_file_id_hit(self):
+        """Telegram принял сохраненный file_id - файл повторно не загружался"""
+        self.file_id_hits += 1
+    
+    def set_file_id_sync(self, key, file_id):
+        self.load()
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry.file_id = file_id
+        self.conn.execute("UPDATE media SET file_id = ? WHERE key = ?", (file_id, key))
+        self.conn.commit()
+    
+    async def set_file_id(self, key, file_id):
+        await self.run(self.set_file_id_sync, key, file_id)
+    
+    async def start(self):
+        await self.run(self.load)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'file_id_hits': self.file_id_hits,
+            'evicted': self.evicted,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+    
+    def close_sync(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+            self.loaded = False
+    
+    async def close(self):
+        await self.run(self.close_sync)
+        self.executor.shutdown(wait=True)
+
+media_cache = MediaCache(root=Config.MEDIA_CACHE_DIR, max_bytes=Config.MEDIA_CACHE_MAX_BYTES)
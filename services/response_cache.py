@@ -0,0 +1,188 @@
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+def normalize_text(text):
+    """Регистр и пробелы не влияют на ответ - убираем их из ключа"""
+    return " ".join(text.split()).casefold()
+
+class DiskResponseCache:
+    """SQLite-копия кеша ответов, чтобы он переживал перезапуск. Все вызовы - в одном потоке"""
+    
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = None
+        self.writes = 0
+    
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(f"PRAGMA mmap_size={int(Config.SQLITE_MMAP_SIZE)}")
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model_id TEXT,
+                    response TEXT,
+                    expires_at REAL,
+                    used_at REAL
+                )
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_used_at ON responses(used_at)")
+        return self.conn
+    
+    def get(self, key, now):
+        conn = self.connect()
+        row = conn.execute("SELECT response, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            conn.commit()
+            return None
+        conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        return row[0], row[1]
+    
+    def put(self, key, model_id, response, expires_at, now):
+        conn = self.connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model_id, response, expires_at, used_at) VALUES (?, ?, ?, ?, ?)",
+            (key, model_id, response, expires_at, now)
+        )
+        self.writes += 1
+        # Чистим просроченные и самые давно используемые записи не на каждой записи
+        if self.writes % 100 == 0:
+            self.prune(now)
+        conn.commit()
+    
+    def prune(self, now):
+        conn = self.connect()
+        conn.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+        conn.execute('''
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+class ResponseCache:
+    """Кеш ответов на одинаковые запросы: LRU в памяти с TTL и необязательная копия на диске.
+    
+    Ключ - sha256 от модели, нормализованного запроса и истории. Кешируются только
+    текстовые запросы к моделям из списка RESPONSE_CACHE_MODELS.
+    """
+    
+    def __init__(self, enabled, models, max_entries, ttl, disk_path=None, disk_max_entries=0):
+        self.enabled = enabled
+        self.models = models
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.disk = DiskResponseCache(disk_path, disk_max_entries) if disk_path else None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='response-cache') if self.disk else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    def key_for(self, model_id, message, conversation_history=None, extra_data=None):
+        """Ключ кеша или None, если запрос нельзя кешировать"""
+        if not self.enabled or extra_data or model_id not in self.models or not isinstance(message, str):
+            return None
+        
+        history = []
+        for item in conversation_history or []:
+            if not isinstance(item.get("content"), str):
+                return None
+            history.append((item["role"], normalize_text(item["content"])))
+        
+        raw = json.dumps([model_id, normalize_text(message), history], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    async def run_disk(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args))
+    
+    async def get(self, key):
+        now = time.time()
+        entry = self.items.get(key)
+        if entry is not None:
+            expires_at, response = entry
+            if expires_at >= now:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return response
+            del self.items[key]
+        
+        if self.disk:
+            try:
+                row = await self.run_disk(self.disk.get, key, now)
+            except sqlite3.Error as e:
+                logger.error(f"Response cache read error: {e}")
+                row = None
+            if row is not None:
+                response, expires_at = row
+                self.store(key, response, expires_at)
+                self.hits += 1
+                self.disk_hits += 1
+                return response
+        
+        self.misses += 1
+        return None
+    
+    async def put(self, key, model_id, response):
+        now = time.time()
+        expires_at = now + self.ttl
+        self.store(key, response, expires_at)
+        
+        if self.disk:
+            try:
+                await self.run_disk(self.disk.put, key, model_id, response, expires_at, now)
+            except sqlite3.Error as e:
+                logger.error(f"Response cache write error: {e}")
+    
+    def store(self, key, response, expires_at):
+        self.items[key] = (expires_at, response)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_entries:
+            self.items.popitem(last=False)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.items),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+    
+    async def close(self):
+        if self.disk:
+            await self.run_disk(self.disk.close)
+            self.executor.shutdown(wait=True)
+
+response_cache = ResponseCache(
+    enabled=Config.RESPONSE_CACHE_ENABLED,
+    models=Config.RESPONSE_CACHE_MODELS,
+    max_entries=Config.RESPONSE_CACHE_SIZE,
+    ttl=Config.RESPONSE_CACHE_TTL,
+    disk_path=Config.RESPONSE_CACHE_PATH,
+    disk_max_entries=Config.RESPONSE_CACHE_DISK_MAX_ENTRIES
+)
@@ -0,0 +1,78 @@
+import time
+import random
+import asyncio
+import email.utils
+import aiohttp
+from config import Config
+
+# Запрос гарантированно не обработан - повтор безопасен всегда
+RETRYABLE_STATUSES = {429, 503}
+# Результат неизвестен (модель могла выполнить генерацию) - повторяем только открытие стрима,
+# пока не получено ни байта ответа; обычный запрос повторно не запускаем, чтобы не платить дважды
+AMBIGUOUS_STATUSES = {408, 500, 502, 504}
+
+class RetryStats:
+    """Счетчики повторов по моделям"""
+    
+    def __init__(self):
+        self.models = {}
+    
+    def record(self, model_id, key):
+        stats = self.models.setdefault(model_id, {'requests': 0, 'attempts': 0, 'recovered': 0, 'giveups': 0})
+        stats[key] += 1
+    
+    def stats(self):
+        return {model_id: dict(stats) for model_id, stats in self.models.items()}
+
+class RetryPolicy:
+    """Экспоненциальная задержка с полным jitter и учетом Retry-After"""
+    
+    def __init__(self, max_attempts, base_delay, max_delay, attempt_timeout, model_attempt_timeouts=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.model_attempt_timeouts = model_attempt_timeouts or {}
+    
+    def get_attempt_timeout(self, model_id):
+        return self.model_attempt_timeouts.get(model_id, self.attempt_timeout)
+    
+    def is_retryable_status(self, status, retry_ambiguous):
+        return status in RETRYABLE_STATUSES or (retry_ambiguous and status in AMBIGUOUS_STATUSES)
+    
+    def is_retryable_error(self, error, retry_ambiguous):
+        # Соединение не установлено - запрос точно не отправлен
+        if isinstance(error, aiohttp.ClientConnectorError):
+            return True
+        # Обрыв или таймаут после отправки: модель могла начать генерацию
+        return retry_ambiguous and isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+    
+    def backoff(self, attempt, retry_after=None):
+        """Задержка перед попыткой attempt + 1 (attempt считается с 1)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+    
+    def parse_retry_after(self, value):
+        """Retry-After: число секунд или HTTP-дата"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            moment = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(moment.timestamp() - time.time(), 0.0)
+
+retry_policy = RetryPolicy(
+    max_attempts=Config.ROUTERAI_MAX_ATTEMPTS,
+    base_delay=Config.ROUTERAI_RETRY_BASE_DELAY,
+    max_delay=Config.ROUTERAI_RETRY_MAX_DELAY,
+    attempt_timeout=Config.ROUTERAI_ATTEMPT_TIMEOUT,
+    model_attempt_timeouts=Config.ROUTERAI_ATTEMPT_TIMEOUTS
+)
+retry_stats = RetryStats()
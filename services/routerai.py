@@ -1,8 +1,28 @@
 import aiohttp
 import asyncio
 import base64
+import json
+import uuid
+import logging
+import contextlib
 from io import BytesIO
 from config import Config
+from services.retry import retry_policy, retry_stats
+from services.hedging import hedge_policy
+from services.response_cache import response_cache
+from services.semantic_cache import semantic_cache
+from services.media import JsonStreamBody, new_marker
+
+# Заглушка в JSON, вместо которой в тело запроса потоком подставляется base64 файла
+MEDIA_MARKER = new_marker()
+
+logger = logging.getLogger(__name__)
+
+async def prepend_event(first, events):
+    """Генератор: сначала first, затем события events"""
+    yield first
+    async for event in events:
+        yield event
 
 class RouterAIService:
     def __init__(self):
@@ -12,8 +32,111 @@ class RouterAIService:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        self.session = None
     
-    async def send_message(self, model_id, message, conversation_history=None, extra_data=None):
+    async def start(self):
+        """Открывает общий пул соединений с RouterAI"""
+        if self.session and not self.session.closed:
+            return
+        
+        connector = aiohttp.TCPConnector(
+            limit=Config.ROUTERAI_POOL_LIMIT,
+            limit_per_host=Config.ROUTERAI_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=Config.ROUTERAI_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=Config.ROUTERAI_DNS_CACHE_TTL,
+            use_dns_cache=True
+        )
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+    
+    async def close(self):
+        """Закрывает пул соединений"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+    
+    async def get_session(self):
+        if not self.session or self.session.closed:
+            await self.start()
+        return self.session
+    
+    @contextlib.asynccontextmanager
+    async def open_completion(self, model_id, payload, total_timeout, retry_ambiguous=False):
+        """POST в chat/completions с повторами временных ошибок.
+        
+        payload - dict или JsonStreamBody (тело с файлом, кодируемым по частям).
+        Отдает ответ со статусом 200 или последний неуспешный ответ. Повтор возможен
+        только до начала чтения ответа: ошибки при чтении тела не повторяются.
+        
+        Неоднозначные сбои (таймаут, обрыв, 500/502/504) повторяются только при
+        retry_ambiguous - для открытия стрима, когда ни одного байта ответа еще нет.
+        Обычный запрос мог уже выполниться у модели, поэтому его не перезапускаем;
+        таймаут попытки для него не нужен - ждем ответа до общего дедлайна.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + total_timeout
+        session = await self.get_session()
+        # Один ключ на все попытки - шлюз может отбросить дубликат
+        headers = {"Idempotency-Key": uuid.uuid4().hex}
+        attempt_timeout = retry_policy.get_attempt_timeout(model_id)
+        retry_stats.record(model_id, 'requests')
+        attempt = 0
+        
+        while True:
+            attempt += 1
+            retry_stats.record(model_id, 'attempts')
+            remaining = deadline - loop.time()
+            sock_read = min(attempt_timeout, remaining) if retry_ambiguous else remaining
+            timeout = aiohttp.ClientTimeout(total=remaining, sock_read=sock_read)
+            response = None
+            retry_after = None
+            
+            if isinstance(payload, JsonStreamBody):
+                # Тело отдается по частям, длина известна заранее - без chunked-кодирования
+                body = {"data": payload.chunks(), "headers": {**headers, "Content-Length": str(payload.content_length())}}
+            else:
+                body = {"json": payload, "headers": headers}
+            
+            try:
+                response = await session.post(
+                    f"{self.base_url}/chat/completions",
+                    timeout=timeout,
+                    **body
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                retryable = retry_policy.is_retryable_error(e, retry_ambiguous)
+            else:
+                if response.status == 200:
+                    break
+                error = None
+                retryable = retry_policy.is_retryable_status(response.status, retry_ambiguous)
+                retry_after = retry_policy.parse_retry_after(response.headers.get("Retry-After"))
+            
+            if not retryable:
+                break
+            
+            delay = retry_policy.backoff(attempt, retry_after)
+            if attempt >= retry_policy.max_attempts or loop.time() + delay >= deadline:
+                retry_stats.record(model_id, 'giveups')
+                break
+            
+            logger.warning(f"RouterAI {model_id} attempt {attempt} failed ({response.status if response else error!r}), retry in {delay:.2f}s")
+            if response is not None:
+                response.release()
+            await asyncio.sleep(delay)
+        
+        if response is None:
+            raise error
+        
+        if response.status == 200 and attempt > 1:
+            retry_stats.record(model_id, 'recovered')
+        
+        try:
+            yield response
+        finally:
+            response.release()
+    
+    def build_payload(self, model_id, message, conversation_history=None, extra_data=None, stream=False):
         payload = {
             "model": model_id,
             "messages": [
@@ -22,14 +145,43 @@ class RouterAIService:
                     "content": message
                 }
             ],
-            "stream": False
+            "stream": stream
         }
         
+        if stream:
+            # Просим прислать usage в последнем чанке
+            payload["stream_options"] = {"include_usage": True}
+        
         if conversation_history:
             payload["messages"] = conversation_history + payload["messages"]
         
-        if extra_data and "image" in extra_data:
-            payload["messages"][0]["content"] = [
+        if extra_data and "image_file" in extra_data:
+            # Файл не читается целиком: base64 подставляется при отправке (см. build_body)
+            payload["messages"][-1]["content"] = [
+                {
+                    "type": "text",
+                    "text": message
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": MEDIA_MARKER
+                    }
+                }
+            ]
+        elif extra_data and "images" in extra_data:
+            # Несколько изображений, например кадры видео
+            payload["messages"][-1]["content"] = [{"type": "text", "text": message}] + [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{extra_data.get('image_mime', 'image/jpeg')};base64,{image}"
+                    }
+                }
+                for image in extra_data["images"]
+            ]
+        elif extra_data and "image" in extra_data:
+            payload["messages"][-1]["content"] = [
                 {
                     "type": "text",
                     "text": message
@@ -37,44 +189,178 @@ class RouterAIService:
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{extra_data['image']}"
+                        "url": f"data:{extra_data.get('image_mime', 'image/jpeg')};base64,{extra_data['image']}"
                     }
                 }
             ]
         
+        return payload
+    
+    def build_body(self, payload, extra_data=None):
+        if extra_data and "image_file" in extra_data:
+            mime = extra_data.get('image_mime', 'image/jpeg')
+            return JsonStreamBody(payload, MEDIA_MARKER, extra_data["image_file"], prefix=f"data:{mime};base64,")
+        return payload
+    
+    async def get_cached(self, model_id, message, conversation_history=None, extra_data=None):
+        """Ответ из кеша: сначала точное совпадение, затем похожий однократный запрос"""
+        cache_key = response_cache.key_for(model_id, message, conversation_history, extra_data)
+        if cache_key:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        if semantic_cache.cacheable(model_id, message, conversation_history, extra_data):
+            return semantic_cache.get(model_id, message)
+        return None
+    
+    async def put_cached(self, model_id, message, conversation_history, extra_data, response):
+        cache_key = response_cache.key_for(model_id, message, conversation_history, extra_data)
+        if cache_key:
+            await response_cache.put(cache_key, model_id, response)
+        
+        if semantic_cache.cacheable(model_id, message, conversation_history, extra_data):
+            semantic_cache.put(model_id, message, response)
+    
+    async def send_message(self, model_id, message, conversation_history=None, extra_data=None):
+        cached = await self.get_cached(model_id, message, conversation_history, extra_data)
+        if cached is not None:
+            return {"success": True, "response": cached, "usage": {}, "cached": True}
+        
+        if hedge_policy.enabled(model_id):
+            result = await self.send_hedged(model_id, message, conversation_history, extra_data)
+        else:
+            result = await self.request_message(model_id, message, conversation_history, extra_data)
+        
+        if result['success']:
+            await self.put_cached(model_id, message, conversation_history, extra_data, result['response'])
+        return result
+    
+    async def send_hedged(self, model_id, message, conversation_history=None, extra_data=None):
+        """Если ответа нет дольше p95 модели - отправляет такой же запрос еще раз,
+        берет первый успешный ответ и отменяет второй запрос"""
+        loop = asyncio.get_running_loop()
+        stats = hedge_policy.get_stats(model_id)
+        stats.requests += 1
+        started = loop.time()
+        
+        primary = asyncio.create_task(self.request_message(model_id, message, conversation_history, extra_data))
+        hedge_policy.track_latency(stats, primary, started)
+        pending = {primary}
+        hedge = None
+        result = None
         try:
-            timeout = aiohttp.ClientTimeout(total=120)
+            done, pending = await asyncio.wait(pending, timeout=hedge_policy.hedge_delay(stats))
+            if not done and hedge_policy.can_hedge(stats):
+                stats.hedged += 1
+                hedge = asyncio.create_task(self.request_message(model_id, message, conversation_history, extra_data))
+                hedge_policy.track_latency(stats, hedge, loop.time(), primary=False)
+                pending.add(hedge)
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    f"{self.base_url}/chat/completions",
-                    json=payload,
-                    headers=self.headers
-                ) as response:
-                    
-                    if response.status == 200:
-                        data = await response.json()
-                        if "choices" in data and len(data["choices"]) > 0:
-                            response_content = data["choices"][0].get("message", {}).get("content", "")
-                            cleaned_response = self.clean_response(response_content)
-                            
-                            return {
-                                "success": True,
-                                "response": cleaned_response,
-                                "usage": data.get("usage", {})
-                            }
-                        else:
-                            return {
-                                "success": False,
-                                "error": "Invalid response format from AI"
-                            }
+            while done or pending:
+                if not done:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                task = done.pop()
+                result = task.result()
+                if result['success']:
+                    if task is hedge:
+                        stats.hedge_wins += 1
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        stats.latency.add(loop.time() - started)
+        if hedge is not None and result['success']:
+            # Проигравший запрос успел потратить как минимум prompt-токены
+            stats.extra_tokens += result.get('usage', {}).get('prompt_tokens', 0)
+        return result
+    
+    async def open_hedged_stream(self, model_id, open_stream):
+        """Открывает стрим с хеджированием до первого события.
+        
+        open_stream() создает новый генератор событий stream_events. Если первое событие
+        не пришло за p95 модели, открывается второй такой же стрим; продолжается тот,
+        что ответил первым, второй закрывается. Возвращает (первое событие, генератор).
+        """
+        loop = asyncio.get_running_loop()
+        stats = hedge_policy.get_stats(model_id, stream=True)
+        stats.requests += 1
+        started = loop.time()
+        
+        async def first_event(stream):
+            try:
+                return await stream.__anext__()
+            except StopAsyncIteration:
+                return {"success": False, "error": "Invalid response format from AI"}
+        
+        primary_stream = open_stream()
+        primary = asyncio.create_task(first_event(primary_stream))
+        hedge_policy.track_latency(stats, primary, started)
+        streams = {primary: primary_stream}
+        pending = {primary}
+        hedge = None
+        winner = None
+        event = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_policy.hedge_delay(stats))
+            if not done and hedge_policy.can_hedge(stats):
+                stats.hedged += 1
+                hedge_stream = open_stream()
+                hedge = asyncio.create_task(first_event(hedge_stream))
+                hedge_policy.track_latency(stats, hedge, loop.time(), primary=False)
+                streams[hedge] = hedge_stream
+                pending.add(hedge)
+            
+            while done or pending:
+                if not done:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = done.pop()
+                event = winner.result()
+                if event.get('success', True):
+                    if winner is hedge:
+                        stats.hedge_wins += 1
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task, stream in streams.items():
+                if task is not winner:
+                    await stream.aclose()
+        
+        stats.latency.add(loop.time() - started)
+        return event, streams[winner]
+    
+    async def request_message(self, model_id, message, conversation_history=None, extra_data=None):
+        payload = self.build_body(self.build_payload(model_id, message, conversation_history, extra_data), extra_data)
+        
+        try:
+            async with self.open_completion(model_id, payload, 120) as response:
+                
+                if response.status == 200:
+                    data = await response.json()
+                    if "choices" in data and len(data["choices"]) > 0:
+                        response_content = data["choices"][0].get("message", {}).get("content", "")
+                        cleaned_response = self.clean_response(response_content)
+                        
+                        return {
+                            "success": True,
+                            "response": cleaned_response,
+                            "usage": data.get("usage", {})
+                        }
                     else:
-                        error_text = await response.text()
                         return {
                             "success": False,
-                            "error": f"RouterAI API error: {response.status}"
+                            "error": "Invalid response format from AI"
                         }
-                        
+                else:
+                    error_text = await response.text()
+                    return {
+                        "success": False,
+                        "error": f"RouterAI API error: {response.status}"
+                    }
+                    
         except asyncio.TimeoutError:
             return {
                 "success": False,
@@ -86,6 +372,110 @@ class RouterAIService:
                 "error": f"Connection error: {str(e)}"
             }
     
+    async def stream_message(self, model_id, message, conversation_history=None, extra_data=None):
+        """Потоковый ответ: отдает {"delta": ...} по мере генерации, в конце - итог как у send_message.
+        
+        Для моделей с хеджированием дублируется открытие стрима (до первого события).
+        """
+        cached = await self.get_cached(model_id, message, conversation_history, extra_data)
+        if cached is not None:
+            yield {"success": True, "response": cached, "usage": {}, "cached": True}
+            return
+        
+        def open_stream():
+            payload = self.build_body(self.build_payload(model_id, message, conversation_history, extra_data, stream=True), extra_data)
+            return self.stream_events(model_id, payload)
+        
+        if hedge_policy.enabled(model_id):
+            first, events = await self.open_hedged_stream(model_id, open_stream)
+            stream = prepend_event(first, events)
+        else:
+            events = stream = open_stream()
+        
+        chunks = []
+        usage = {}
+        try:
+            async for event in stream:
+                if "delta" in event:
+                    chunks.append(event["delta"])
+                    yield event
+                elif "usage" in event:
+                    usage = event["usage"]
+                else:
+                    # Ошибка запроса
+                    yield event
+                    return
+        finally:
+            await events.aclose()
+        
+        if not chunks:
+            yield {
+                "success": False,
+                "error": "Invalid response format from AI"
+            }
+            return
+        
+        response_text = self.clean_response("".join(chunks))
+        await self.put_cached(model_id, message, conversation_history, extra_data, response_text)
+        
+        yield {
+            "success": True,
+            "response": response_text,
+            "usage": usage
+        }
+    
+    async def stream_events(self, model_id, payload):
+        """События SSE-ответа: {"delta": ...}, {"usage": ...} или итог с ошибкой"""
+        try:
+            # До первого байта стрима генерация не оплачена - неоднозначные сбои можно повторить
+            async with self.open_completion(model_id, payload, 120, retry_ambiguous=True) as response:
+                
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"RouterAI {model_id} stream error {response.status}: {error_text[:500]}")
+                    yield {
+                        "success": False,
+                        "error": f"RouterAI API error: {response.status}"
+                    }
+                    return
+                
+                # Server-Sent Events: строки вида "data: {...}", конец - "data: [DONE]"
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8', errors='ignore').strip()
+                    if not line.startswith("data:"):
+                        continue
+                    
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    
+                    try:
+                        event = json.loads(data)
+                    except ValueError:
+                        continue
+                    
+                    if event.get("usage"):
+                        yield {"usage": event["usage"]}
+                    
+                    choices = event.get("choices") or []
+                    if not choices:
+                        continue
+                    
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield {"delta": delta}
+                
+        except asyncio.TimeoutError:
+            yield {
+                "success": False,
+                "error": "Request timeout (120 seconds)"
+            }
+        except Exception as e:
+            yield {
+                "success": False,
+                "error": f"Connection error: {str(e)}"
+            }
+    
     async def generate_image(self, prompt, model_id=None):
         """Генерация изображения через RouterAI"""
         if model_id is None:
@@ -109,76 +499,70 @@ class RouterAIService:
         }
         
         try:
-            timeout = aiohttp.ClientTimeout(total=180)
-            
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    f"{self.base_url}/chat/completions",
-                    json=payload,
-                    headers=self.headers
-                ) as response:
+            # Генерация дорогая: неоднозначные сбои (таймаут, 5xx) не повторяем
+            async with self.open_completion(model_id, payload, 180) as response:
+                
+                if response.status == 200:
+                    data = await response.json()
                     
-                    if response.status == 200:
-                        data = await response.json()
+                    # Проверяем разные форматы ответа
+                    if "choices" in data and len(data["choices"]) > 0:
+                        choice = data["choices"][0]
                         
-                        # Проверяем разные форматы ответа
-                        if "choices" in data and len(data["choices"]) > 0:
-                            choice = data["choices"][0]
+                        if "message" in choice:
+                            message_content = choice["message"].get("content", "")
                             
-                            if "message" in choice:
-                                message_content = choice["message"].get("content", "")
+                            # Пытаемся найти base64 изображение в ответе
+                            if isinstance(message_content, str):
+                                # Ищем base64 данные в тексте
+                                import base64
+                                import re
                                 
-                                # Пытаемся найти base64 изображение в ответе
-                                if isinstance(message_content, str):
-                                    # Ищем base64 данные в тексте
-                                    import base64
-                                    import re
-                                    
-                                    # Паттерн для base64 изображения
-                                    base64_pattern = r'data:image\/[^;]+;base64,([^\"]+)'
-                                    match = re.search(base64_pattern, message_content)
-                                    
-                                    if match:
-                                        base64_data = match.group(1)
-                                        return {
-                                            "success": True,
-                                            "image_data": base64_data,
-                                            "response": f"Изображение сгенерировано: {prompt}"
-                                        }
-                                    else:
-                                        # Если нет изображения, возвращаем текстовый ответ
-                                        return {
-                                            "success": True,
-                                            "image_data": None,
-                                            "response": message_content
-                                        }
-                                elif isinstance(message_content, list):
-                                    # Мультимодальный ответ
-                                    for item in message_content:
-                                        if isinstance(item, dict) and item.get("type") == "image_url":
-                                            image_url = item.get("image_url", {})
-                                            if isinstance(image_url, dict):
-                                                url = image_url.get("url", "")
-                                                if url.startswith("data:image"):
-                                                    base64_data = url.split(",")[1]
-                                                    return {
-                                                        "success": True,
-                                                        "image_data": base64_data,
-                                                        "response": f"Изображение сгенерировано: {prompt}"
-                                                    }
-                        
-                        return {
-                            "success": False,
-                            "error": "Модель не вернула изображение в ожидаемом формате"
-                        }
-                        
-                    else:
-                        error_text = await response.text()
-                        return {
-                            "success": False,
-                            "error": f"API error: {response.status} - {error_text}"
-                        }
-                        
+                                # Паттерн для base64 изображения
+                                base64_pattern = r'data:image\/[^;]+;base64,([^\"]+)'
+                                match = re.search(base64_pattern, message_content)
+                                
+                                if match:
+                                    base64_data = match.group(1)
+                                    return {
+                                        "success": True,
+                                        "image_data": base64_data,
+                                        "response": f"Изображение сгенерировано: {prompt}"
+                                    }
+                                else:
+                                    # Если нет изображения, возвращаем текстовый ответ
+                                    return {
+                                        "success": True,
+                                        "image_data": None,
+                                        "response": message_content
+                                    }
+                            elif isinstance(message_content, list):
+                                # Мультимодальный ответ
+                                for item in message_content:
+                                    if isinstance(item, dict) and item.get("type") == "image_url":
+                                        image_url = item.get("image_url", {})
+                                        if isinstance(image_url, dict):
+                                            url = image_url.get("url", "")
+                                            if url.startswith("data:image"):
+                                                base64_data = url.split(",")[1]
+                                                return {
+                                                    "success": True,
+                                                    "image_data": base64_data,
+                                                    "response": f"Изображение сгенерировано: {prompt}"
+                                                }
+                    
+                    return {
+                        "success": False,
+                        "error": "Модель не вернула изображение в ожидаемом формате"
+                    }
+                    
+                else:
+                    error_text = await response.text()
+                    return {
+                        "success": False,
+                        "error": f"API error: {response.status} - {error_text}"
+                    }
+                    
         except asyncio.TimeoutError:
             return {
                 "success": False,
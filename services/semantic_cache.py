@@ -0,0 +1,167 @@
+import re
+import sys
+import math
+import time
+import zlib
+import heapq
+import itertools
+from collections import OrderedDict, Counter
+from config import Config
+
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def vectorize(text, dimensions):
+    """Hashing-векторизатор: слова и символьные триграммы, L2-нормированный разреженный вектор.
+    
+    Триграммы дают устойчивость к опечаткам и окончаниям, слова - к перестановкам.
+    crc32 вместо hash(): значения не зависят от PYTHONHASHSEED.
+    """
+    words = WORD_PATTERN.findall(text.casefold())
+    features = Counter()
+    for word in words:
+        features[zlib.crc32(word.encode('utf-8')) % dimensions] += 1.0
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            features[zlib.crc32(padded[i:i + 3].encode('utf-8')) % dimensions] += 0.5
+    
+    norm = math.sqrt(sum(weight * weight for weight in features.values()))
+    if not norm:
+        return {}
+    return {feature: weight / norm for feature, weight in features.items()}
+
+class SemanticEntry:
+    __slots__ = ('model_id', 'vector', 'response', 'expires_at', 'size')
+    
+    def __init__(self, model_id, vector, response, expires_at):
+        self.model_id = model_id
+        self.vector = vector
+        self.response = response
+        self.expires_at = expires_at
+        # Примерная память: словарь вектора, ответ и ссылки в инвертированном индексе
+        self.size = sys.getsizeof(vector) + sys.getsizeof(response) + 100 * len(vector)
+
+class SemanticCache:
+    """Кеш ответов на похожие однократные запросы.
+    
+    Приближенный поиск ближайшего соседа по инвертированному индексу признаков:
+    кандидаты берутся из списков max_features самых редких признаков запроса
+    (частые, длиннее max_postings, пропускаются), точный косинус считается только
+    для candidates лучших из них. Поиск синхронный, поэтому его объем ограничен:
+    около миллисекунды на индекс в несколько тысяч записей.
+    """
+    
+    def __init__(self, models, threshold, dimensions, max_entries, max_bytes, ttl, max_postings, max_features, candidates):
+        self.models = models
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_postings = max_postings
+        self.max_features = max_features
+        self.candidates = candidates
+        self.entries = OrderedDict()
+        self.postings = {}  # (model_id, признак) -> set(entry_id)
+        self.ids = itertools.count()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+    
+    def cacheable(self, model_id, message, conversation_history=None, extra_data=None):
+        # Только однократные текстовые запросы: с историей смысл вопроса зависит от контекста
+        return model_id in self.models and isinstance(message, str) and not conversation_history and not extra_data
+    
+    def search(self, model_id, vector):
+        """Лучшая запись модели: (entry_id, similarity) или (None, 0.0)"""
+        postings = []
+        for feature, weight in vector.items():
+            posting = self.postings.get((model_id, feature))
+            if posting and len(posting) <= self.max_postings:
+                postings.append((len(posting), feature, weight, posting))
+        
+        # Частичная сумма по редким признакам - только для отбора кандидатов
+        scores = {}
+        for _, feature, weight, posting in heapq.nsmallest(self.max_features, postings, key=lambda item: item[0]):
+            for entry_id in posting:
+                scores[entry_id] = scores.get(entry_id, 0.0) + weight * self.entries[entry_id].vector[feature]
+        
+        best_id, best = None, 0.0
+        for entry_id in heapq.nlargest(self.candidates, scores, key=scores.get):
+            entry_vector = self.entries[entry_id].vector
+            similarity = sum(weight * entry_vector.get(feature, 0.0) for feature, weight in vector.items())
+            if similarity > best:
+                best_id, best = entry_id, similarity
+        return best_id, best
+    
+    def get(self, model_id, message):
+        vector = vectorize(message, self.dimensions)
+        if not vector:
+            self.misses += 1
+            return None
+        
+        entry_id, similarity = self.search(model_id, vector)
+        if entry_id is not None and similarity >= self.threshold:
+            entry = self.entries[entry_id]
+            if entry.expires_at >= time.time():
+                self.entries.move_to_end(entry_id)
+                self.hits += 1
+                return entry.response
+            self.remove(entry_id)
+        
+        self.misses += 1
+        return None
+    
+    def put(self, model_id, message, response):
+        vector = vectorize(message, self.dimensions)
+        if not vector:
+            return
+        
+        # Почти такой же запрос уже есть - обновляем его вместо дубля
+        entry_id, similarity = self.search(model_id, vector)
+        if entry_id is not None and similarity >= self.threshold:
+            self.remove(entry_id)
+        
+        entry_id = next(self.ids)
+        entry = SemanticEntry(model_id, vector, response, time.time() + self.ttl)
+        self.entries[entry_id] = entry
+        self.bytes += entry.size
+        for feature in vector:
+            self.postings.setdefault((model_id, feature), set()).add(entry_id)
+        
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            self.remove(next(iter(self.entries)))
+            self.evicted += 1
+    
+    def remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        self.bytes -= entry.size
+        for feature in entry.vector:
+            key = (entry.model_id, feature)
+            posting = self.postings[key]
+            posting.discard(entry_id)
+            if not posting:
+                del self.postings[key]
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted': self.evicted,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+semantic_cache = SemanticCache(
+    models=Config.SEMANTIC_CACHE_MODELS,
+    threshold=Config.SEMANTIC_CACHE_THRESHOLD,
+    dimensions=Config.SEMANTIC_CACHE_DIMENSIONS,
+    max_entries=Config.SEMANTIC_CACHE_MAX_ENTRIES,
+    max_bytes=Config.SEMANTIC_CACHE_MAX_BYTES,
+    ttl=Config.SEMANTIC_CACHE_TTL,
+    max_postings=Config.SEMANTIC_CACHE_MAX_POSTINGS,
+    max_features=Config.SEMANTIC_CACHE_MAX_FEATURES,
+    candidates=Config.SEMANTIC_CACHE_CANDIDATES
+)
@@ -0,0 +1,164 @@
+import os
+import shutil
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from config import Config
+from services.media import download_to_file
+
+logger = logging.getLogger(__name__)
+
+def select_keyframes(paths, max_frames):
+    """Выбирает кадры со сменой сцены: первый кадр и max_frames - 1 кадров с наибольшим
+    отличием от предыдущего (средняя разница яркости на миниатюре 32x32).
+    Выполняется в отдельном процессе. Возвращает байты JPEG в исходном порядке."""
+    previous = None
+    scores = []
+    for index, path in enumerate(paths):
+        with Image.open(path) as frame:
+            pixels = list(frame.convert("L").resize((32, 32)).getdata())
+        if previous is None:
+            score = float("inf")
+        else:
+            score = sum(abs(a - b) for a, b in zip(pixels, previous)) / len(pixels)
+        scores.append((score, index))
+        previous = pixels
+    
+    chosen = sorted(index for _, index in sorted(scores, reverse=True)[:max_frames])
+    frames = []
+    for index in chosen:
+        with open(paths[index], "rb") as f:
+            frames.append(f.read())
+    return frames
+
+class VideoPipeline:
+    """Ключевые кадры видео для моделей с supports_video.
+    
+    Кадры-кандидаты равномерно достает ffmpeg (уже уменьшенными), смену сцены
+    оценивает пул процессов. Без ffmpeg или для слишком большого файла используется
+    превью, которое Telegram присылает вместе с видео. Результат кешируется по file_unique_id.
+    """
+    
+    def __init__(self, ffmpeg, max_size, max_frames, candidates, max_dimension, timeout, workers, cache_bytes):
+        self.ffmpeg = shutil.which(ffmpeg) if ffmpeg else None
+        self.max_size = max_size
+        self.max_frames = max_frames
+        self.candidates = candidates
+        self.max_dimension = max_dimension
+        self.timeout = timeout
+        self.workers = workers
+        self.executor = None
+        self.cache = OrderedDict()
+        self.cache_bytes = cache_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.extracted = 0
+        self.thumbnails = 0
+        self.failed = 0
+        if not self.ffmpeg:
+            logger.warning("ffmpeg not found, video analysis will use Telegram thumbnails only")
+    
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+    
+    async def get_frames(self, bot, video):
+        """Список JPEG-кадров (bytes), может быть пустым"""
+        frames = self.cache.get(video.file_unique_id)
+        if frames is not None:
+            self.cache.move_to_end(video.file_unique_id)
+            self.hits += 1
+            return frames
+        
+        frames = []
+        if self.ffmpeg and (video.file_size or 0) <= self.max_size:
+            try:
+                frames = await self.extract(bot, video)
+                self.extracted += 1
+            except Exception as e:
+                logger.warning(f"Keyframe extraction failed: {e}")
+                self.failed += 1
+        
+        if not frames and video.thumbnail:
+            try:
+                frames = [await self.download_bytes(bot, video.thumbnail.file_id)]
+                self.thumbnails += 1
+            except Exception as e:
+                logger.warning(f"Video thumbnail download failed: {e}")
+        
+        if frames:
+            self.remember(video.file_unique_id, frames)
+        return frames
+    
+    async def download_bytes(self, bot, file_id):
+        file = await bot.get_file(file_id)
+        result = await bot.download_file(file.file_path)
+        return result.read()
+    
+    async def extract(self, bot, video):
+        with tempfile.TemporaryDirectory(prefix="video-") as workdir:
+            path = os.path.join(workdir, "video")
+            file = await bot.get_file(video.file_id)
+            with open(path, "wb") as destination:
+                await download_to_file(bot, file.file_path, destination)
+            
+            # Кандидаты равномерно по длительности, сразу уменьшенные под модель
+            interval = max((video.duration or 1) / self.candidates, 0.2)
+            scale = (f"scale=w='min(iw,{self.max_dimension})':h='min(ih,{self.max_dimension})'"
+                     f":force_original_aspect_ratio=decrease")
+            process = await asyncio.create_subprocess_exec(
+                self.ffmpeg, "-hide_banner", "-loglevel", "error", "-i", path,
+                "-vf", f"fps=1/{interval:.3f},{scale}", "-frames:v", str(self.candidates),
+                "-q:v", "4", os.path.join(workdir, "frame_%03d.jpg"),
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                process.kill()
+                await process.wait()
+                raise
+            if process.returncode != 0:
+                raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='ignore')[-300:]}")
+            
+            paths = sorted(os.path.join(workdir, name) for name in os.listdir(workdir) if name.startswith("frame_"))
+            if not paths:
+                return []
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.get_executor(), select_keyframes, paths, self.max_frames)
+    
+    def remember(self, key, frames):
+        self.cache[key] = frames
+        self.bytes += sum(len(frame) for frame in frames)
+        while self.bytes > self.cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.bytes -= sum(len(frame) for frame in evicted)
+    
+    def stats(self):
+        return {
+            'extracted': self.extracted,
+            'thumbnails': self.thumbnails,
+            'failed': self.failed,
+            'cache_hits': self.hits,
+            'cached': len(self.cache),
+            'cache_bytes': self.bytes
+        }
+    
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+video_pipeline = VideoPipeline(
+    ffmpeg=Config.FFMPEG_BINARY,
+    max_size=Config.VIDEO_MAX_SIZE,
+    max_frames=Config.VIDEO_MAX_FRAMES,
+    candidates=Config.VIDEO_CANDIDATE_FRAMES,
+    max_dimension=Config.VIDEO_FRAME_MAX_DIMENSION,
+    timeout=Config.VIDEO_EXTRACT_TIMEOUT,
+    workers=Config.VIDEO_WORKERS,
+    cache_bytes=Config.VIDEO_FRAME_CACHE_BYTES
+)
@@ -0,0 +1,74 @@
+import re
+import math
+from functools import lru_cache
+from config import Config
+
+# Служебные токены на каждое сообщение в chat/completions (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+WORD_PATTERN = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+def count_tokens(text):
+    """Быстрая оценка числа токенов без токенизатора модели.
+    
+    Латиница в BPE-словарях дает ~4 символа на токен, кириллица и прочие
+    алфавиты - ~2.5, знаки препинания - отдельный токен. Без кеша - для
+    длинных текстов вроде документов.
+    """
+    if not text:
+        return 0
+    
+    tokens = 0
+    for word in WORD_PATTERN.findall(text):
+        if word.isascii():
+            tokens += math.ceil(len(word) / 4)
+        else:
+            tokens += math.ceil(len(word) / 2.5)
+    return tokens
+
+@lru_cache(maxsize=4096)
+def estimate_tokens(text):
+    """count_tokens с кешем для сообщений и истории, которые оцениваются повторно"""
+    return count_tokens(text)
+
+def estimate_message_tokens(content):
+    if isinstance(content, str):
+        return estimate_tokens(content) + MESSAGE_OVERHEAD
+    
+    # Мультимодальный content: считаем только текстовые части
+    tokens = MESSAGE_OVERHEAD
+    for part in content or []:
+        if isinstance(part, dict) and part.get("type") == "text":
+            tokens += estimate_tokens(part.get("text", ""))
+    return tokens
+
+def get_history_budget(model_id):
+    """Бюджет токенов на историю диалога для модели"""
+    return Config.HISTORY_TOKEN_BUDGETS.get(model_id, Config.DEFAULT_HISTORY_TOKEN_BUDGET)
+
+class TokenCalibration:
+    """Сравнение оценки prompt-токенов с usage.prompt_tokens по моделям"""
+    
+    def __init__(self):
+        self.models = {}
+    
+    def record(self, model_id, estimated, actual):
+        if not actual:
+            return
+        
+        stats = self.models.setdefault(model_id, {'requests': 0, 'estimated': 0, 'actual': 0})
+        stats['requests'] += 1
+        stats['estimated'] += estimated
+        stats['actual'] += actual
+    
+    def ratio(self, model_id):
+        """Во сколько раз реальное число токенов больше оценки"""
+        stats = self.models.get(model_id)
+        if not stats or not stats['estimated']:
+            return 1.0
+        return stats['actual'] / stats['estimated']
+    
+    def stats(self):
+        return {model_id: dict(stats, ratio=self.ratio(model_id)) for model_id, stats in self.models.items()}
+
+token_calibration = TokenCalibration()
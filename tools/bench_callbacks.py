@@ -0,0 +1,69 @@
+"""Микробенчмарк маршрутизации callback-запросов.
+
+Сравнивает CallbackRouter (словарь по коду действия) с прежней цепочкой
+фильтров F.data == ... / F.data.startswith(...), которые aiogram проверял
+по очереди для каждого callback. Запуск: python tools/bench_callbacks.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import catalog
+from callbacks import CallbackRouter, pack, pack_model
+
+# Порядок регистрации обработчиков в main.py до перехода на роутер
+LEGACY_FILTERS = [
+    ("==", "legal_docs"), ("startswith", "doc_"), ("==", "back_to_menu"),
+    ("startswith", "info_"), ("startswith", "plan_info_"), ("startswith", "api_info_"),
+    ("startswith", "model_"), ("startswith", "sub_"), ("startswith", "api_"),
+    ("startswith", "paid_"), ("==", "share_ref"),
+]
+
+def legacy_route(data):
+    for index, (kind, value) in enumerate(LEGACY_FILTERS):
+        if (kind == "==" and data == value) or (kind == "startswith" and data.startswith(value)):
+            prefix = value if kind == "startswith" else ""
+            return index, data.replace(prefix, "") if prefix else None
+    return None, None
+
+async def handler(callback, arg):
+    pass
+
+def build_router():
+    router = CallbackRouter()
+    for code, legacy, model_arg in [
+        ("l", "legal_docs", False), ("d", "doc_", False), ("b", "back_to_menu", False),
+        ("mi", "info_", True), ("pi", "plan_info_", False), ("ai", "api_info_", True),
+        ("m", "model_", True), ("p", "sub_", False), ("a", "api_", True),
+        ("pd", "paid_", False), ("s", "share_ref", False),
+    ]:
+        router.action(code, legacy=legacy, model_arg=model_arg)(handler)
+    return router
+
+def main():
+    model_id = "google/gemini-3-pro-preview"
+    payment_id = "0b6c1a8e-4d0f-4a57-9a59-1f0e0d3c2b1a"
+    
+    new_payloads = [
+        pack_model("m", model_id), pack_model("ai", model_id), pack("pi", "quantum"),
+        pack("pd", payment_id), pack("s"), pack("b"),
+    ]
+    old_payloads = [
+        f"model_{model_id}", f"api_info_{model_id}", "plan_info_quantum",
+        f"paid_{payment_id}", "share_ref", "back_to_menu",
+    ]
+    
+    router = build_router()
+    number = 200000
+    
+    print(f"Models in catalog: {len(catalog.models)}")
+    print(f"{'payload':<45} {'old, ns':>10} {'new, ns':>10} {'bytes old/new':>15}")
+    for old, new in zip(old_payloads, new_payloads):
+        old_ns = timeit.timeit(lambda: legacy_route(old), number=number) / number * 1e9
+        new_ns = timeit.timeit(lambda: router.resolve(new), number=number) / number * 1e9
+        print(f"{new:<45} {old_ns:>10.0f} {new_ns:>10.0f} {len(old):>7}/{len(new):<7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Пиковая память на отправку медиафайла в RouterAI (tracemalloc).
+
+Сравнивает прежний путь (download_file в BytesIO -> b64encode -> str -> json) с потоковым:
+скачивание по частям во временный файл и JsonStreamBody, кодирующий base64 по кускам.
+Скачивание имитируется копированием файла кусками MEDIA_CHUNK_SIZE.
+Запуск: python tools/bench_media_memory.py [размер файла в МБ]
+"""
+import io
+import os
+import sys
+import json
+import base64
+import asyncio
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from services.media import JsonStreamBody, spooled_file, new_marker
+
+def copy_in_chunks(source, destination):
+    source.seek(0)
+    while True:
+        chunk = source.read(Config.MEDIA_CHUNK_SIZE)
+        if not chunk:
+            break
+        destination.write(chunk)
+    destination.seek(0)
+
+def make_payload(url):
+    return {
+        "model": "google/gemma-3-4b-it",
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "Опиши это изображение"},
+            {"type": "image_url", "image_url": {"url": url}}
+        ]}],
+        "stream": False
+    }
+
+def measure(func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, result
+
+def legacy_path(source):
+    buffer = io.BytesIO()
+    copy_in_chunks(source, buffer)
+    image_data = base64.b64encode(buffer.read()).decode('utf-8')
+    # aiohttp json= сериализует payload в строку и кодирует в bytes
+    body = json.dumps(make_payload(f"data:image/jpeg;base64,{image_data}")).encode('utf-8')
+    return len(body)
+
+def streaming_path(source):
+    async def consume(body):
+        sent = 0
+        async for chunk in body.chunks():
+            sent += len(chunk)
+        return sent
+    
+    with spooled_file() as destination:
+        copy_in_chunks(source, destination)
+        marker = new_marker()
+        body = JsonStreamBody(make_payload(marker), marker, destination, prefix="data:image/jpeg;base64,")
+        sent = asyncio.run(consume(body))
+        assert sent == body.content_length()
+        return sent
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 8 * 1024 * 1024
+    with tempfile.TemporaryFile() as source:
+        for _ in range(size // (1024 * 1024)):
+            source.write(os.urandom(1024 * 1024))
+        source.write(os.urandom(size % (1024 * 1024)))
+        
+        print(f"File: {size / 1024 / 1024:.1f} MB, chunk: {Config.MEDIA_CHUNK_SIZE // 1024} KB, "
+              f"spool: {Config.MEDIA_SPOOL_MAX_SIZE // 1024} KB")
+        for name, func in (("legacy", legacy_path), ("streaming", streaming_path)):
+            peak, body_size = measure(func, source)
+            print(f"{name:<10} peak {peak / 1024 / 1024:>7.2f} MB ({peak / size:.2f}x file), body {body_size / 1024 / 1024:.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Офлайн-оценка семантического кеша на записанных запросах.
+
+Входной файл - JSONL, по строке на запрос в порядке поступления:
+    {"prompt": "как написать сочинение?", "group": "essay"}
+group - метка смысла: запросы с одинаковой group взаимозаменяемы (годится один ответ).
+Запросы проигрываются через SemanticCache: промах кладет запрос в кеш, попадание
+считается верным, если найденная запись из той же группы.
+
+Запуск: python tools/eval_semantic_cache.py prompts.jsonl [--thresholds 0.8 0.85 0.9 0.95]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from services.semantic_cache import SemanticCache
+
+MODEL_ID = "eval"
+
+def load_prompts(path):
+    prompts = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            prompts.append((item["prompt"], str(item["group"])))
+    return prompts
+
+def evaluate(prompts, threshold):
+    cache = SemanticCache(
+        models=[MODEL_ID],
+        threshold=threshold,
+        dimensions=Config.SEMANTIC_CACHE_DIMENSIONS,
+        max_entries=Config.SEMANTIC_CACHE_MAX_ENTRIES,
+        max_bytes=Config.SEMANTIC_CACHE_MAX_BYTES,
+        ttl=Config.SEMANTIC_CACHE_TTL,
+        max_postings=Config.SEMANTIC_CACHE_MAX_POSTINGS,
+        max_features=Config.SEMANTIC_CACHE_MAX_FEATURES,
+        candidates=Config.SEMANTIC_CACHE_CANDIDATES
+    )
+    
+    seen_groups = set()
+    hits = false_hits = possible = 0
+    started = time.perf_counter()
+    for prompt, group in prompts:
+        if group in seen_groups:
+            possible += 1
+        
+        # В качестве "ответа" храним группу - так сразу видно, верно ли попадание
+        cached = cache.get(MODEL_ID, prompt)
+        if cached is None:
+            cache.put(MODEL_ID, prompt, group)
+        else:
+            hits += 1
+            if cached != group:
+                false_hits += 1
+        seen_groups.add(group)
+    elapsed = time.perf_counter() - started
+    
+    return {
+        'hit_rate': hits / len(prompts),
+        'false_hit_rate': false_hits / hits if hits else 0.0,
+        'recall': (hits - false_hits) / possible if possible else 0.0,
+        'us_per_prompt': elapsed / len(prompts) * 1e6,
+        'bytes': cache.bytes
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.75, 0.8, 0.85, 0.9, 0.95])
+    args = parser.parse_args()
+    
+    prompts = load_prompts(args.path)
+    if not prompts:
+        print("No prompts")
+        return
+    
+    print(f"Prompts: {len(prompts)}, groups: {len({group for _, group in prompts})}")
+    print(f"{'threshold':>9} {'hit rate':>9} {'false hits':>11} {'recall':>7} {'us/prompt':>10} {'index, KB':>10}")
+    for threshold in args.thresholds:
+        result = evaluate(prompts, threshold)
+        print(f"{threshold:>9.2f} {result['hit_rate']:>9.1%} {result['false_hit_rate']:>11.1%} "
+              f"{result['recall']:>7.1%} {result['us_per_prompt']:>10.0f} {result['bytes'] / 1024:>10.0f}")
+
+if __name__ == "__main__":
+    main()